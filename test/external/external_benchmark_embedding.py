@@ -0,0 +1,27 @@
+import time
+from tinygrad import Tensor, TinyJit, dtypes, nn
+from tinygrad.helpers import getenv
+
+# the token embedding of a prefill with a llama3 vocab, before the indexing reduce was kept whole it was split in partial sums over the vocab
+def old_embedding(w:Tensor, idx:Tensor, split:int) -> Tensor:
+  V, D = w.shape
+  ar = Tensor.arange(V, dtype="int32").reshape(split, V//split, 1)
+  partial = (ar == idx.reshape(-1, 1, 1, 1)).where(w.reshape(split, V//split, D), 0).sum(2, dtype=w.dtype).contiguous()
+  return partial.sum(1, dtype=w.dtype).reshape(*idx.shape, D)
+
+if __name__ == "__main__":
+  V, D, CNT = getenv("VOCAB", 128256), getenv("DIM", 2048), getenv("CNT", 10)
+  emb = nn.Embedding(V, D)
+  emb.weight = emb.weight.cast(dtypes.half if getenv("HALF", 1) else dtypes.float).contiguous().realize()
+  for T in [int(x) for x in getenv("T", "1,128,512").split(",")]:
+    outs, idx = [], Tensor.randint(1, T, high=V).realize()
+    for name, fxn in [("split", lambda x: old_embedding(emb.weight, x, 256).realize()), ("indexed", lambda x: emb(x).realize())]:
+      jit = TinyJit(fxn)
+      # the first replay after the capture is slow
+      for _ in range(4): jit(Tensor.randint(1, T, high=V).realize()).numpy()
+      st = time.perf_counter()
+      for _ in range(CNT): out = jit(idx).numpy()
+      et = (time.perf_counter() - st) / CNT
+      outs.append(out)
+      print(f"{T:5d} tokens {name:8s} {et*1e3:8.3f} ms")
+    assert (outs[0] == outs[1]).all(), "output mismatch"
@@ -0,0 +1,29 @@
+# per kernel launch overhead of a jit replay, without graphs so every kernel is launched from python
+# DEVICES=NULL,CPU KERNELS=100 python3 test/external/external_benchmark_jit_launch.py
+import time
+from tinygrad import Tensor, TinyJit, Device, Context
+from tinygrad.helpers import getenv, GlobalCounters
+
+def bench(device:str, kernels:int, cnt:int=20):
+  @TinyJit
+  def f(a:Tensor) -> Tensor:
+    for i in range(kernels): a = (a+i).contiguous()
+    return a
+  a = Tensor.ones(16, device=device).contiguous().realize()
+  with Context(JIT=2):
+    for _ in range(3): f(a)
+    Device[device].synchronize()
+    tms = []
+    for _ in range(cnt):
+      GlobalCounters.reset()
+      st = time.perf_counter()
+      f(a)
+      tms.append(time.perf_counter() - st)
+      assert GlobalCounters.kernel_count == kernels
+    Device[device].synchronize()
+  return min(tms)/kernels, sorted(tms)[len(tms)//2]/kernels
+
+if __name__ == "__main__":
+  for device in getenv("DEVICES", "NULL,CPU").split(","):
+    best, median = bench(device, getenv("KERNELS", 100))
+    print(f"{device:6s} launch overhead {best*1e6:7.2f} us/kernel (median {median*1e6:7.2f} us)")
@@ -0,0 +1,84 @@
+import json, queue, subprocess, time, random, pathlib
+from tinygrad import Tensor, Device, nn
+from tinygrad.helpers import getenv, GlobalCounters
+from tinygrad.apps.llm import Transformer, GenerationEngine, Sequence, models
+
+# the continuous batching engine over a sweep of prompt lengths and batch sizes, with time to first token, inter-token latency percentiles,
+# prefill and decode tok/s, peak memory and kernel counts, written as JSON with JSON=path.
+# MODEL=llama3.2:1b loads the gguf, without it the model has the shape of llama3.2:1b and random weights, NULL=1 times only the overhead.
+# PROMPTS=16,128,512 BATCH=1,4 STEPS=32 ROUNDS=2
+
+# the shape of llama3.2:1b
+CONFIG = dict(num_blocks=16, dim=2048, hidden_dim=8192, n_heads=32, n_kv_heads=8, norm_eps=1e-5, vocab_size=128256, head_dim=64, rope_theta=500000.0)
+
+class StampedQueue(queue.Queue):
+  """The out queue of a sequence, with the time every token was put."""
+  def __init__(self):
+    super().__init__()
+    self.times: list[float] = []
+  def put(self, item, block=True, timeout=None):
+    if item is not None: self.times.append(time.perf_counter())
+    super().put(item, block, timeout)
+
+def percentiles(x:list[float]) -> dict[str, float]:
+  s = sorted(x)
+  return {f"p{p}": s[min(len(s)-1, int(len(s)*p/100))]*1e3 for p in (50, 95, 99)} if s else {}
+
+def run_round(engine:GenerationEngine, prompt_len:int, batch:int, steps:int, rng:random.Random) -> dict:
+  vocab = engine.model.output.weight.shape[0]
+  seqs = [Sequence([rng.randrange(vocab) for _ in range(prompt_len)], StampedQueue()) for _ in range(batch)]
+  GlobalCounters.reset()
+  peak = GlobalCounters.mem_used
+  st = time.perf_counter()
+  for s in seqs: engine.waiting.put(s)
+  # the engine runs on this thread, a step admits and prefills the waiting sequences and decodes one token of all the running ones
+  # the kernels per decode step count only the steps after every sequence is prefilled, not the admission or the drain below
+  first_kernels, decode_start, decode_steps = None, None, 0
+  while any(len(s.out.times) < steps for s in seqs):
+    engine.step()
+    peak = max(peak, GlobalCounters.mem_used)
+    if first_kernels is None: first_kernels = GlobalCounters.kernel_count
+    if decode_start is None:
+      if all(s.out.times for s in seqs): decode_start = GlobalCounters.kernel_count
+    else: decode_steps += 1
+  et, decode_kernels = time.perf_counter(), GlobalCounters.kernel_count - (decode_start or GlobalCounters.kernel_count)
+  for s in seqs: s.cancelled = True
+  while any(engine.slots) or engine.pending: engine.step()
+  first = [s.out.times[0] for s in seqs]
+  # decode tok/s counts the tokens after every sequence has its first one
+  decode_tokens = sum(t > max(first) for s in seqs for t in s.out.times[:steps])
+  itl = [b-a for s in seqs for a,b in zip(s.out.times[:steps-1], s.out.times[1:steps])]
+  return {"prompt_len": prompt_len, "batch": batch, "steps": steps,
+          "ttft_ms": {"mean": sum(f-st for f in first)/batch*1e3, **percentiles([f-st for f in first])},
+          "itl_ms": {"mean": sum(itl)/max(len(itl), 1)*1e3, **percentiles(itl)},
+          "prefill_tok_s": prompt_len*batch / (max(first)-st),
+          "decode_tok_s": decode_tokens / (et-max(first)) if et > max(first) else 0.0,
+          "peak_mem_mb": peak/1e6,
+          "first_step_kernels": first_kernels, "decode_kernels_per_step": decode_kernels / max(decode_steps, 1)}
+
+if __name__ == "__main__":
+  prompt_lens, batches = [int(x) for x in getenv("PROMPTS", "16,128,512").split(",")], [int(x) for x in getenv("BATCH", "1,4").split(",")]
+  steps, rounds = getenv("STEPS", 32), getenv("ROUNDS", 2)
+  max_context = max(prompt_lens) + steps + 1
+  if (name:=getenv("MODEL", "")):
+    model, _ = Transformer.from_gguf(Tensor.from_url(models[name]), max_context)
+  else:
+    Tensor.manual_seed(0)
+    model = Transformer(**CONFIG, max_context=max_context)
+    for p in nn.state.get_parameters(model): p.replace(p.half().contiguous())
+    Tensor.realize(*nn.state.get_parameters(model))
+  try: commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=pathlib.Path(__file__).parent, text=True).strip()
+  except Exception: commit = None
+  rng, results = random.Random(0), []
+  for batch in batches:
+    engine = GenerationEngine(model, max_batch=batch, eos_id=-1)
+    for prompt_len in prompt_lens:
+      # the first round captures the jits and compiles the kernels
+      for _ in range(rounds): r = run_round(engine, prompt_len, batch, steps, rng)
+      results.append(r)
+      print(f"prompt {prompt_len:5d} batch {batch:3d}: ttft {r['ttft_ms']['p50']:8.2f} ms, "
+            f"itl p50 {r['itl_ms']['p50']:7.2f} p95 {r['itl_ms']['p95']:7.2f} p99 {r['itl_ms']['p99']:7.2f} ms, "
+            f"prefill {r['prefill_tok_s']:8.1f} tok/s, decode {r['decode_tok_s']:7.1f} tok/s, "
+            f"peak {r['peak_mem_mb']:8.1f} MB, kernels {r['first_step_kernels']} + {r['decode_kernels_per_step']:.0f}/step")
+  out = {"device": Device.DEFAULT, "model": name or "random", "commit": commit, "results": results}
+  if (path:=getenv("JSON", "")): pathlib.Path(path).write_text(json.dumps(out, indent=2))
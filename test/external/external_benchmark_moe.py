@@ -0,0 +1,30 @@
+import time
+from tinygrad import Tensor, TinyJit, dtypes
+from tinygrad.helpers import getenv
+import tinygrad.apps.llm as llm
+
+# prefill of one olmoe block, the expert weights gathered per token against the tokens grouped by expert
+if __name__ == "__main__":
+  DIM, HIDDEN, HEADS, EXPERTS, K = getenv("DIM", 2048), getenv("HIDDEN", 1024), getenv("HEADS", 16), getenv("EXPERTS", 64), getenv("K", 8)
+  T, CNT = getenv("T", 128), getenv("CNT", 5)
+  dtype = dtypes.half if getenv("HALF", 1) else dtypes.float
+
+  Tensor.manual_seed(0)
+  block = llm.TransformerBlock(DIM, HIDDEN, HEADS, HEADS, 1e-5, DIM//HEADS, 10000.0, max_context=T, num_experts=EXPERTS, num_experts_per_tok=K)
+  for w in (block.ffn_gate_exps, block.ffn_up_exps, block.ffn_down_exps): w.weight = (Tensor.randn(*w.weight.shape) * 0.02).cast(dtype).realize()
+  block.ffn_gate_inp.weight = Tensor.randn(EXPERTS, DIM).cast(dtype).realize()
+  x = Tensor.randn(1, T, DIM, dtype=dtype).realize()
+  expert_bytes = sum(w.weight.nbytes() for w in (block.ffn_gate_exps, block.ffn_up_exps, block.ffn_down_exps))
+  print(f"{T} tokens, {EXPERTS} experts of {expert_bytes/EXPERTS/1e6:.1f} MB, top {K}")
+
+  outs = []
+  for tile in (0, getenv("MOE_TILE", 16)):
+    llm.MOE_TILE = tile
+    ffn = TinyJit(lambda x: block._feed_forward(x).realize())
+    for _ in range(3): ffn(x)
+    st = time.perf_counter()
+    for _ in range(CNT): out = ffn(x).numpy()
+    et = (time.perf_counter() - st) / CNT
+    outs.append(out)
+    print(f"{'gather' if tile == 0 else f'grouped tile {tile}':16s} {et*1e3:8.2f} ms, {T/et:8.1f} tok/s")
+  print(f"max diff {abs(outs[0].astype('float32') - outs[1].astype('float32')).max():.2e}")
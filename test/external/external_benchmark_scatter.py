@@ -0,0 +1,33 @@
+import time
+from tinygrad import Tensor, GlobalCounters
+from tinygrad.helpers import getenv, Context
+
+# scatter_reduce into a WIDTH wide dim, the one-hot masked reduce against the kernel that stores along the index,
+# with the bytes of the buffers the schedule allocates, the memory traffic and the ops of one call, GRAD=1 adds the backward of src
+# ROWS lines of WIDTH, then one line of ROWS*WIDTH where the walk along the index is a single thread. the native kernel is forced with
+# SCATTER_NATIVE=1, by default it's only used for a scatter with at least SCATTER_NATIVE lines
+if __name__ == "__main__":
+  ROWS, WIDTH, CNT, GRAD = getenv("ROWS", 16), getenv("WIDTH", 100_000), getenv("CNT", 5), getenv("GRAD", 0)
+  for xshape in [(ROWS, WIDTH), (ROWS*WIDTH,)]:
+    for N in [int(x) for x in getenv("N", "64,1024").split(",")]:
+      x, idx = Tensor.rand(*xshape).realize(), Tensor.randint(*xshape[:-1], N, high=xshape[-1]).realize()
+      src = Tensor.rand(*idx.shape).realize()
+      def run() -> list[Tensor]:
+        s = src.detach().requires_grad_(GRAD)
+        out = x.scatter_reduce(-1, idx, s, getenv("REDUCE", "sum"))
+        if GRAD: out.square().sum().backward()
+        return [out, s.grad] if GRAD else [out]
+      outs = []
+      for native in (0, 1):
+        with Context(SCATTER_NATIVE=native):
+          bufs = {id(b):b for si in Tensor.schedule(*run()) for b in si.bufs if b is not None and not b.is_allocated()}
+          alloc = sum(b.nbytes for b in bufs.values())
+          GlobalCounters.reset()
+          outs.append([t.numpy() for t in run()])
+          ops, mem = GlobalCounters.global_ops, GlobalCounters.global_mem
+          st = time.perf_counter()
+          for _ in range(CNT): [t.numpy() for t in run()]
+          et = (time.perf_counter() - st) / CNT
+        print(f"{'x'.join(map(str, xshape)):>10s} <- {N:5d} {'native' if native else 'one-hot':8s} {et*1e3:9.2f} ms, allocated {alloc/1e6:7.2f} MB, "
+              f"moved {mem/1e6:8.2f} MB, {ops/1e6:10.2f} MOPs")
+      assert all(abs(a - b).max() < 1e-4 for a,b in zip(*outs)), "output mismatch"
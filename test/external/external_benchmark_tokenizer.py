@@ -0,0 +1,59 @@
+import base64, pathlib, sys, time, re, unicodedata
+from tinygrad.apps.llm import SimpleTokenizer
+from tinygrad.helpers import fetch, getenv
+
+# the encoder before the merge heap and the word cache, rescans every pair after each merge
+def old_encode_word(tok:SimpleTokenizer, word:bytes) -> list[int]:
+  if (early_token:=tok._normal_tokens.get(word)) is not None: return [early_token]
+  parts = [bytes([b]) for b in word]
+  while True:
+    i = min([(sys.maxsize, -1)] + [(tok._normal_tokens.get(parts[j]+parts[j+1], sys.maxsize), j) for j in range(len(parts)-1)])[1]
+    if i == -1: break
+    parts[i:i+2] = [parts[i] + parts[i+1]]
+  return [tok._normal_tokens[p] for p in parts]
+# the word split before the unicode classes were written as ranges
+def old_split_to_word() -> re.Pattern:
+  def ucat_range(pre: str): return "".join(re.escape(chr(cp)) for cp in range(0x323b0) if unicodedata.category(chr(cp)).startswith(pre))
+  r_ws, r_p_N, r_p_L = r"\t\n\x0b\x0c\r\x85" + ucat_range("Z"), ucat_range("N"), ucat_range("L")
+  return re.compile("(?i:'s|'t|'re|'ve|'m|'ll|'d)|" + \
+    f"[^\\r\\n{r_p_N}{r_p_L}]?[{r_p_L}]+|[{r_p_N}]{{1,3}}| ?[^{r_ws}{r_p_N}{r_p_L}]+[\\r\\n]*|[{r_ws}]*[\\r\\n]+|[{r_ws}]+(?![^{r_ws}])|[{r_ws}]+")
+def old_encode(tok:SimpleTokenizer, split:re.Pattern, text:str) -> list[int]:
+  tokens: list[int] = []
+  pos = 0
+  for match in tok._split_to_sentence.finditer(text):
+    tokens.extend(w for word in split.findall(text[pos:match.start(0)]) for w in old_encode_word(tok, word.encode()))
+    tokens.append(tok._special_tokens[text[match.start(0):match.end(0)]])
+    pos = match.end(0)
+  return tokens + [w for word in split.findall(text[pos:]) for w in old_encode_word(tok, word.encode())]
+
+def llama_tok() -> SimpleTokenizer:
+  model_file = fetch("https://huggingface.co/bofenghuang/Meta-Llama-3-8B/resolve/main/original/tokenizer.model")
+  bs = [*range(33, 127), *range(161, 173), *range(174, 256)]
+  byte_encoder = {b:chr(b) for b in bs} | {b:chr(256+i) for i,b in enumerate(b for b in range(256) if b not in bs)}
+  str_vocab = [line.split(maxsplit=1) for line in pathlib.Path(model_file).read_text().splitlines() if line]
+  normal_tokens = {''.join(byte_encoder[x] for x in base64.b64decode(stok)): int(srank) for stok, srank in str_vocab}
+  return SimpleTokenizer(normal_tokens, {"<|begin_of_text|>": len(normal_tokens), "<|end_of_text|>": len(normal_tokens)+1})
+
+if __name__ == "__main__":
+  tok = llama_tok()
+  # source code as the corpus, with some long unbroken words that the old encoder is quadratic in and a sweep over unicode for the word split
+  root = pathlib.Path(__file__).parents[2] / "tinygrad"
+  texts = [p.read_text() for p in sorted(root.rglob("*.py"))][:getenv("FILES", 200)] + ["x"*1000, "0"*3000 + "ab"*500]
+  texts.append("".join(chr(cp) for cp in range(32, 0x323b0, 31) if unicodedata.category(chr(cp)) != "Cs"))
+  nbytes = sum(len(t.encode()) for t in texts)
+  print(f"{len(texts)} texts, {nbytes/1e6:.2f} MB")
+
+  split = old_split_to_word()
+  st = time.perf_counter()
+  ref = [old_encode(tok, split, t) for t in texts]
+  print(f"old:              {time.perf_counter()-st:7.2f} s")
+  for name, fxn in [("new cold", lambda: [tok.encode(t) for t in texts]), ("new warm", lambda: [tok.encode(t) for t in texts]),
+                    ("threads", lambda: tok.encode_batch(texts, workers=getenv("WORKERS", 4))),
+                    ("processes", lambda: tok.encode_batch(texts, workers=getenv("WORKERS", 4), processes=True))]:
+    if name == "new cold": tok._encode_word.cache_clear()
+    st = time.perf_counter()
+    out = fxn()
+    et = time.perf_counter()-st
+    assert out == ref, f"{name} output mismatch"
+    print(f"{name+':':18s}{et:7.2f} s, {nbytes/et/1e6:6.2f} MB/s")
+  print("word cache:", tok._encode_word.cache_info())
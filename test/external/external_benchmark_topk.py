@@ -0,0 +1,20 @@
+import time
+from tinygrad import Tensor, TinyJit, dtypes
+from tinygrad.helpers import getenv
+
+# topk of sampling over a qwen3 vocab, the radix select against a full sort shrunk to k, and the full sort carrying the indices
+# before the sort carried the indices they were recovered with a vocab x vocab mask, 23 GB for one row of this vocab
+if __name__ == "__main__":
+  V, K, CNT = getenv("VOCAB", 151936), getenv("K", 50), getenv("CNT", 10)
+  for BS in [int(x) for x in getenv("BS", "1,8").split(",")]:
+    outs, x = [], Tensor.randn(BS, V, dtype=dtypes.half if getenv("HALF", 0) else dtypes.float).realize()
+    for name, fxn in [("sort", lambda t: [y.shrink_to(BS, K).realize() for y in t.sort(-1, descending=True)]),
+                      ("topk", lambda t: [y.realize() for y in t.topk(K)])]:
+      jit = TinyJit(fxn)
+      for _ in range(3): jit(x.clone().realize())
+      st = time.perf_counter()
+      for _ in range(CNT): out = [y.numpy() for y in jit(x)]
+      et = (time.perf_counter() - st) / CNT
+      outs.append(out)
+      print(f"{BS:3d}x{V} top {K} {name:5s} {et*1e3:9.2f} ms")
+    assert all((a == b).all() for a,b in zip(*outs)), "output mismatch"
@@ -163,5 +163,79 @@ class TestIndexing(unittest.TestCase):
   # at least the arange is being fused
   def test_llama_embedding_opt(self): self.test_llama_embedding(0, 1_736_704_000)
 
+  def test_large_vocab_index(self):
+    # a vocab above REDUCEOP_SPLIT_THRESHOLD isn't split into partial reduces, every lookup is one load
+    emb = nn.Embedding(128256, 8)
+    emb.weight.realize()
+    x = Tensor([1, 2, 128255, 70000], dtype=dtypes.int32).realize()
+    expected = emb.weight.numpy()[x.numpy()]
+    for fxn in (lambda: emb(x), lambda: emb.weight[x], lambda: emb.weight.gather(0, x.reshape(4, 1).expand(4, 8)),
+                lambda: emb.weight.T.gather(1, x.reshape(1, 4).expand(8, 4)).T):
+      with Context(SPLIT_REDUCEOP=1):
+        GlobalCounters.reset()
+        out = fxn().realize()
+        self.assertEqual(GlobalCounters.kernel_count, 1)
+        self.assertEqual(GlobalCounters.global_ops, 0)
+      np.testing.assert_equal(out.numpy(), expected)
+
+  def test_large_vocab_compare_reduce(self):
+    # a reduce that uses the compare but doesn't select one element with it is still split
+    x, idx = Tensor.randn(2, 128256).realize(), Tensor([[5], [70000]], dtype=dtypes.int32).realize()
+    xn, hit = x.numpy(), np.arange(128256) == np.array([[5], [70000]])
+    for fxn, expected in [(lambda: (x*(idx != Tensor.arange(128256))).sum(-1), (xn*~hit).sum(-1)),
+                          (lambda: (idx == Tensor.arange(128256)).where(0, x).sum(-1), (xn*~hit).sum(-1)),
+                          (lambda: (x + (idx == Tensor.arange(128256))).sum(-1), xn.sum(-1)+1)]:
+      with Context(SPLIT_REDUCEOP=1):
+        GlobalCounters.reset()
+        out = fxn().realize()
+        self.assertEqual(GlobalCounters.kernel_count, 2)
+      np.testing.assert_allclose(out.numpy(), expected, atol=1e-2)
+    with Context(SPLIT_REDUCEOP=1):
+      GlobalCounters.reset()
+      out = (x*(idx == Tensor.arange(128256))).sum(-1).realize()
+      self.assertEqual(GlobalCounters.kernel_count, 1)
+    np.testing.assert_equal(out.numpy(), xn[[0, 1], [5, 70000]])
+
+  def test_scatter_reduce_wide(self):
+    # scatter stores along the index, no one-hot mask over the 100k wide dim
+    x, idx, src = Tensor.rand(4, 100_000).realize(), Tensor.randint(4, 64, high=100_000).realize(), Tensor.rand(4, 64).realize()
+    idx[:, 1] = idx[:, 0]
+    idx.realize()
+    rows = np.arange(4).reshape(4, 1)
+    for reduce, ufunc in [("sum", np.add), ("prod", np.multiply), ("amax", np.maximum), ("amin", np.minimum)]:
+      GlobalCounters.reset()
+      with Context(SCATTER_NATIVE=1): out = x.scatter_reduce(1, idx, src, reduce).realize()
+      # a parallel copy of x and the kernel
+      self.assertEqual(GlobalCounters.kernel_count, 2)
+      self.assertLess(GlobalCounters.global_ops, 4*64*8)
+      expected = x.numpy()
+      ufunc.at(expected, (rows, idx.numpy()), src.numpy())
+      np.testing.assert_allclose(out.numpy(), expected, rtol=1e-6)
+
+  def test_scatter_native_lines(self):
+    # one thread walks each line, so a scatter with fewer lines than SCATTER_NATIVE like the 1-D one of masked_select stays the one-hot reduce
+    idx = Tensor.randint(2048, 4, high=8).realize()
+    for x, index, native in [(Tensor.zeros(2048, 8), idx, True), (Tensor.zeros(2048*8), idx.flatten(), False)]:
+      with Context(SCATTER_NATIVE=1024):
+        out = x.contiguous().scatter_reduce(-1, index, Tensor.ones(*index.shape), "sum")
+        names = [si.ast.arg.name for si in out.schedule() if si.ast.op is Ops.SINK and si.ast.arg is not None]
+      self.assertEqual(any(n.startswith("scatter_") for n in names), native, names)
+
+  def test_scatter_matches_one_hot(self):
+    x, src = Tensor.rand(5, 6, 7).realize(), Tensor.rand(5, 9, 7).realize()
+    # repeated and out of bounds indices
+    idx = Tensor(np.random.default_rng(0).integers(-1, 7, (4, 9, 3))).realize()
+    for reduce in [None, "sum", "prod", "mean", "amax", "amin"]:
+      for include_self in ([True] if reduce is None else [True, False]):
+        outs = []
+        for native in (1, 0):
+          with Context(SCATTER_NATIVE=native):
+            a, b = Tensor(x.numpy(), requires_grad=True), Tensor(src.numpy(), requires_grad=True)
+            out = a.scatter(1, idx, b) if reduce is None else a.scatter_reduce(1, idx, b, reduce, include_self=include_self)
+            (out.square() * Tensor.arange(out.numel()).reshape(out.shape)).sum().backward()
+            Tensor.realize(out, a.grad, b.grad)
+            outs.append([t.numpy() for t in (out, a.grad, b.grad)])
+        for native, one_hot in zip(*outs): np.testing.assert_allclose(native, one_hot, rtol=1e-5, err_msg=f"{reduce=} {include_self=}")
+
 if __name__ == "__main__":
   unittest.main()
@@ -165,6 +165,14 @@ class TestCustomKernel(unittest.TestCase):
     b_p1 = Tensor.custom_kernel(tst, b, fxn=custom_add_one_kernel)[0]
     self.assertTrue((b_p1 == 3).all().item())
 
+  def test_shared_input(self):
+    a = Tensor.arange(4).realize()
+    x = Tensor.arange(16).reshape(4, 4).realize()
+    b = Tensor.empty_like(a).custom_kernel(a, fxn=custom_add_one_kernel)[0]
+    # a is also indexed by another consumer of the kernel output
+    out = x[a, b.clip(0, 3)]
+    self.assertListEqual(out.tolist(), [1, 6, 11, 15])
+
   def test_sum(self):
     a = Tensor([1.0, 2, 3, 4, 5])
     tst = Tensor.empty(1)
@@ -1,15 +1,16 @@
 #!/usr/bin/env python
-import unittest, functools
+import unittest, functools, tempfile
 import numpy as np
 
 from hypothesis import given, settings, strategies as strat
 from test.helpers import assert_jit_cache_len, not_support_multi_device, needs_second_gpu
 from tinygrad.tensor import Tensor
-from tinygrad.engine.jit import TinyJit, JitError, GraphRunner, MultiGraphRunner, graph_class
+from tinygrad.engine.jit import TinyJit, JitError, GraphRunner, MultiGraphRunner, graph_class, export_jit, load_jit, JitLaunch
 from tinygrad.engine.realize import CompiledRunner, BufferCopy, BufferXfer
 from tinygrad.device import Device
 from tinygrad.helpers import Context, JIT, GlobalCounters, getenv
 from tinygrad.dtype import dtypes
+from tinygrad import Variable
 from extra.models.unet import ResBlock
 
 def _simple_test(add, extract=lambda x: x, N=10):
@@ -824,6 +825,111 @@ class TestJitGraphSplit(unittest.TestCase):
       multigraph=[self.ji_graph(2), self.ji_copy(), self.ji_comp()],
       hcqgraph=[self.ji_graph(4)])
 
+class TestJitMultiCapture(unittest.TestCase):
+  def test_multiple_shapes(self):
+    @TinyJit
+    def add(a, b): return (a+b).realize()
+    add.max_captures = 2
+    for n in [4, 8, 4, 8, 4, 8, 4]:
+      a, b = Tensor.randn(n, 3), Tensor.randn(n, 3)
+      np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-4, rtol=1e-5)
+    self.assertEqual(len(add._captures), 2)
+    self.assertEqual(sorted((s.hits, s.misses) for s in add.stats.values()), [(1, 2), (2, 2)])
+
+  def test_lru_eviction(self):
+    add = TinyJit(lambda a: (a+1).realize(), max_captures=2)
+    for n in [2, 2, 2, 3, 3, 3, 4, 4, 4]: add(Tensor.randn(n))
+    self.assertEqual(len(add._captures), 2)
+    self.assertEqual(add.evictions, 1)
+    # the stats go with the capture, so they don't grow with every signature seen
+    self.assertEqual(set(add.stats), set(add._captures))
+    # the evicted shape has to warm up and capture again
+    a = Tensor.randn(2)
+    np.testing.assert_allclose(add(a).numpy(), a.numpy()+1, atol=1e-5)
+    self.assertIsNone(add.captured)
+
+  def test_buckets(self):
+    add = TinyJit(lambda a: (a*2).realize(), max_captures=2, buckets=(8, 16))
+    for n in [3, 5, 7, 8, 2]:
+      a = Tensor.randn(n, 4)
+      out = add(a)
+      self.assertEqual(out.shape, (8, 4))
+      np.testing.assert_allclose(out[:n].numpy(), a.numpy()*2, atol=1e-5)
+      np.testing.assert_equal(out[n:].numpy(), 0)
+    self.assertEqual(len(add._captures), 1)
+    self.assertEqual(add.captured.expected_input_info[0][0].shape, (8, 4))
+    self.assertEqual(add(Tensor.randn(12, 4)).shape, (16, 4))
+
+  def test_single_capture_still_raises(self):
+    add = TinyJit(lambda a: (a+1).realize(), buckets=(8,))
+    for _ in range(3): add(Tensor.randn(5))
+    with self.assertRaises(JitError): add(Tensor.randn(9))
+
+class TestJitLaunchPlan(unittest.TestCase):
+  def test_launch_plan(self):
+    @TinyJit
+    def f(a:Tensor, v:Variable) -> Tensor: return ((a+v).contiguous()*2).realize()
+    with Context(JIT=2):
+      for i in range(5):
+        vi = Variable("v", 1, 10).bind(i+1)
+        a = Tensor.arange(4).float().realize()
+        GlobalCounters.reset()
+        self.assertListEqual(f(a, vi).tolist(), [(x+i+1)*2 for x in range(4)])
+        self.assertEqual(GlobalCounters.kernel_count, 2)
+    self.assertTrue(any(isinstance(l, JitLaunch) for l in f.captured._plan))
+
+class TestJitExport(unittest.TestCase):
+  def setUp(self):
+    self.backup_compiler = Device[Device.DEFAULT].compiler.compile_cached
+    self.fn = tempfile.mktemp()
+  def tearDown(self): Device[Device.DEFAULT].compiler.compile_cached = self.backup_compiler
+
+  def test_export_load(self):
+    w, b = Tensor.randn(8, 4).realize(), Tensor.randn(4).realize()
+    state = Tensor.zeros(4).contiguous().realize()
+    @TinyJit
+    def f(x):
+      out = ((x @ w).relu() + b).realize()
+      state.assign(state + out.sum(0)).realize()
+      return out, state
+    for _ in range(3): f(Tensor.randn(3, 8).realize())
+    export_jit(f, self.fn)
+    expected_state = orig_state = state.numpy()
+
+    # no compiles on load or replay
+    Device[Device.DEFAULT].compiler.compile_cached = None
+    g = load_jit(self.fn)
+    for _ in range(2):
+      x = Tensor.randn(3, 8).realize()
+      out, st = g(x)
+      expected = np.maximum(x.numpy() @ w.numpy(), 0) + b.numpy()
+      expected_state = expected_state + expected.sum(0)
+      np.testing.assert_allclose(out.numpy(), expected, atol=1e-5, rtol=1e-5)
+      np.testing.assert_allclose(st.numpy(), expected_state, atol=1e-4, rtol=1e-5)
+    # the loaded jit has its own copy of the state
+    np.testing.assert_equal(state.numpy(), orig_state)
+
+  def test_export_slice_assign(self):
+    # a kv cache is written a position at a time, the positions that aren't written are kept in the export
+    cache = Tensor.arange(8).contiguous().realize()
+    @TinyJit
+    def f(x, pos):
+      cache[pos:pos+1].assign(x).realize()
+      return cache.contiguous()
+    vpos = Variable("pos", 0, 7)
+    for i in range(3): f(Tensor([100+i]), vpos.bind(i))
+    export_jit(f, self.fn)
+    self.assertListEqual(f(Tensor([200]), vpos.bind(5)).tolist(), [100,101,102,3,4,200,6,7])
+    cache.assign(Tensor.arange(8).contiguous()).realize()
+    self.assertListEqual(load_jit(self.fn)(Tensor([200]), vpos.bind(5)).tolist(), [100,101,102,3,4,200,6,7])
+
+  def test_export_uncaptured(self):
+    with self.assertRaises(JitError): export_jit(TinyJit(lambda x: x+1), self.fn)
+
+  def test_load_bad_file(self):
+    with open(self.fn, "wb") as f: f.write(b"\x00"*64)
+    with self.assertRaises(JitError): load_jit(self.fn)
+
 class TestJitRandom(unittest.TestCase):
   def test_jit_rangeify(self):
     tst = {0:[], 1:[]}
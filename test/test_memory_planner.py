@@ -1,7 +1,9 @@
 import unittest
-from tinygrad import dtypes, Device
+from unittest.mock import patch
+from tinygrad import dtypes, Device, Tensor
 from tinygrad.device import Buffer
-from tinygrad.engine.memory import _internal_memory_planner
+from tinygrad.engine import memory
+from tinygrad.engine.memory import _internal_memory_planner, MemoryPlanStep
 
 global_map = {}
 def b(i, base=None, offset=0, pin=False, size=16):
@@ -134,5 +136,32 @@ class TestMemoryPlanner(unittest.TestCase):
     ]
     check_assign(bs)
 
+class TestMemoryPlanStep(unittest.TestCase):
+  def _step(self, x:Tensor, n:int) -> Tensor:
+    # the intermediates of each realize are planned
+    for i in range(n): x = (((x+i).contiguous()*2).contiguous()-1).contiguous().realize()
+    return x
+
+  def test_shared_buffers(self):
+    x = Tensor.arange(1024).float().contiguous().realize()
+    with MemoryPlanStep() as step:
+      out = self._step(x, 4)
+    self.assertEqual(step.schedules, 4)
+    self.assertEqual(len(step.buffers), 0)
+    self.assertLess(step.allocated, step.planned)
+    self.assertListEqual(out.tolist(), self._step(x, 4).tolist())
+
+  def test_planned_once(self):
+    x = Tensor.arange(1024).float().contiguous().realize()
+    with MemoryPlanStep(), patch.object(memory, "_internal_memory_planner", wraps=_internal_memory_planner) as planner:
+      self._step(x, 4)
+    self.assertEqual(planner.call_count, 4)
+
+  def test_nested(self):
+    with MemoryPlanStep() as outer:
+      with MemoryPlanStep() as inner: self.assertIs(MemoryPlanStep.active, inner)
+      self.assertIs(MemoryPlanStep.active, outer)
+    self.assertIsNone(MemoryPlanStep.active)
+
 if __name__ == "__main__":
   unittest.main()
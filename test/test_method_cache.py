@@ -1,5 +1,7 @@
 import unittest
-from tinygrad import Tensor, Device, Variable
+import numpy as np
+from tinygrad import Tensor, Device, Variable, Context
+from tinygrad.engine.realize import method_cache
 from examples.gpt2 import Transformer
 from tinygrad.nn.state import get_state_dict
 
@@ -30,6 +32,25 @@ class TestMethodCache(unittest.TestCase):
     Device[Device.DEFAULT].compiler.compile_cached = None
     ((c+d)+(a+b)).realize()
 
+  def test_bounded_methodcache(self):
+    method_cache.clear()
+    with Context(METHOD_CACHE_SIZE=4):
+      for i in range(5): (Tensor.ones(3+i).contiguous()*2).realize()
+    st = method_cache.stats()
+    self.assertLessEqual(st.entries, 4)
+    self.assertGreater(st.evictions, 0)
+    # a runner is stored under its device key and its base device key, its lib is counted once
+    self.assertEqual(st.nbytes, sum(len(r.p.lib) for r in {id(r):r for r in method_cache.values()}.values()))
+
+  def test_parallel_compile(self):
+    method_cache.clear()
+    a = Tensor.arange(16).float().reshape(4, 4).contiguous().realize()
+    outs = [(a*(i+1)).sum(axis=i%2).contiguous() for i in range(4)]
+    # all kernels are compiled in the pool, not in this process
+    Device[Device.DEFAULT].compiler.compile_cached = None
+    with Context(PARALLEL_COMPILE=2): Tensor.realize(*outs)
+    for i,o in enumerate(outs): self.assertListEqual(o.tolist(), (np.arange(16).reshape(4, 4)*(i+1)).sum(axis=i%2).tolist())
+
   @unittest.skip("incorrect use of transformer")
   def test_small_transformer(self):
     args_tiny = {"dim": 16, "n_heads": 8, "n_layers": 8, "norm_eps": 1e-05, "vocab_size": 10}
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import unittest, os, subprocess
 from tinygrad import Tensor
-from tinygrad.device import Device, Compiler, enumerate_devices_str
+from tinygrad.device import Device, Compiler, LRUAllocator, enumerate_devices_str, size_class
 from tinygrad.helpers import diskcache_get, diskcache_put, getenv, Context, WIN, CI
 
 class TestDevice(unittest.TestCase):
@@ -100,6 +100,93 @@ class TestCompiler(unittest.TestCase):
       a = Tensor([0.,1.], device=Device.DEFAULT).realize()
       (a + 1).realize()
 
+class MockBuf:
+  def __init__(self, size, base=None, offset=0): self.size, self.base, self.offset = size, base, offset
+
+class MockAllocator(LRUAllocator):
+  def __init__(self, **kwargs):
+    self.allocated: list[MockBuf] = []
+    self.freed: list[MockBuf] = []
+    super().__init__(None, **kwargs)
+  def _alloc(self, size, options):
+    self.allocated.append(ret:=MockBuf(size))
+    return ret
+  def _free(self, opaque, options): self.freed.append(opaque)
+  def _offset(self, buf, size, offset): return MockBuf(size, buf, offset)
+
+class TestLRUAllocator(unittest.TestCase):
+  def test_size_class(self):
+    self.assertEqual(size_class(1000, 0), 1000)
+    self.assertEqual(size_class(1000, 1), 1024)
+    self.assertEqual(size_class(1000, 4), 1024)
+    self.assertEqual(size_class(1100, 4), 1280)
+    for sz in range(1, 5000): self.assertGreaterEqual(size_class(sz, 4), sz)
+
+  def test_size_class_reuse(self):
+    alc = MockAllocator()
+    with Context(LRU_SIZE_CLASS=4):
+      a = alc.alloc(1100)
+      self.assertEqual((a.size, a.base.size), (1100, 1280))
+      alc.free(a, 1100)
+      b = alc.alloc(1200)
+      self.assertIs(b.base, a.base)
+    st = alc.stats()
+    self.assertEqual((st.hits, st.misses, st.entries, st.nbytes), (1, 1, 0, 0))
+
+  def test_byte_cap_evicts_oldest(self):
+    alc = MockAllocator()
+    bufs = [alc.alloc(400_000+i) for i in range(4)]
+    with Context(LRU_MB=1):
+      for i,b in enumerate(bufs): alc.free(b, 400_000+i)
+    self.assertEqual([b.size for b in alc.freed], [400_000, 400_001])
+    st = alc.stats()
+    self.assertEqual((st.evictions, st.entries, st.nbytes), (2, 2, 800_005))
+    alc.free_cache()
+    self.assertEqual(alc.stats().nbytes, 0)
+    self.assertEqual(len(alc.freed), 4)
+
+  def test_size_class_device(self):
+    with Context(LRU_SIZE_CLASS=2):
+      for n in (33, 47, 61):
+        t = Tensor.arange(n).contiguous().realize()
+        self.assertListEqual(t.tolist(), list(range(n)))
+        self.assertListEqual((t+1).tolist(), list(range(1, n+1)))
+
+class TestArena(unittest.TestCase):
+  def test_suballocate(self):
+    alc = MockAllocator(supports_arena=True)
+    with Context(ARENA=1, LRU=0):
+      bufs = [alc.alloc(1000) for _ in range(100)]
+      self.assertEqual([b.size for b in alc.allocated], [1<<20])
+      self.assertTrue(all(b.base is alc.allocated[0] and b.offset % 0x100 == 0 for b in bufs))
+      self.assertEqual(len({b.offset for b in bufs}), 100)
+      # too big for the arena
+      alc.alloc(1<<19)
+      self.assertEqual(len(alc.allocated), 2)
+      for b in bufs: alc.free(b, 1000)
+      self.assertEqual(alc.freed, [])
+
+  def test_release_empty_slab(self):
+    alc = MockAllocator(supports_arena=True)
+    with Context(ARENA=1, LRU=0):
+      bufs = [alc.alloc(200_000) for _ in range(8)]
+      self.assertEqual(len(alc.allocated), 2)
+      for b in bufs[:5]: alc.free(b, 200_000)
+      self.assertEqual(alc.freed, [alc.allocated[0]])
+      for b in bufs[5:]: alc.free(b, 200_000)
+      self.assertEqual(alc.freed, [alc.allocated[0]])
+
+  def test_unsupported(self):
+    alc = MockAllocator()
+    with Context(ARENA=1): alc.alloc(1000)
+    self.assertEqual([b.size for b in alc.allocated], [1000])
+
+  def test_arena_device(self):
+    with Context(ARENA=1):
+      for n in (33, 47, 1000):
+        t = Tensor.arange(n).contiguous().realize()
+        self.assertListEqual((t+1).tolist(), list(range(1, n+1)))
+
 class TestRunAsModule(unittest.TestCase):
   def test_module_runs(self):
     out = '\n'.join(enumerate_devices_str())
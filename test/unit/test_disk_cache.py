@@ -1,6 +1,6 @@
 import unittest
 import pickle
-from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear
+from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear, diskcache_prune
 
 def remote_get(table,q,k): q.put(diskcache_get(table, k))
 def remote_put(table,k,v): diskcache_put(table, k, v)
@@ -81,6 +81,15 @@ class DiskCache(unittest.TestCase):
     diskcache_put(table, "key", "test")
     self.assertEqual(diskcache_get(table, "key"), "test")
 
+  def test_prune(self):
+    table = "test_prune"
+    val = "x"*100
+    for i in range(4): diskcache_put(table, i, val)
+    # keeps the newest entries that fit
+    diskcache_prune(table, len(pickle.dumps(val))*2)
+    self.assertEqual([diskcache_get(table, i) for i in range(4)], [None, None, val, val])
+    diskcache_prune("faketable", 0)
+
   @unittest.skip("disabled by default because this drops cache table")
   def test_clear_cache(self):
     # clear cache to start
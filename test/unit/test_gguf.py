@@ -1,7 +1,8 @@
-import os, unittest, ctypes
+import os, unittest, ctypes, struct
 from tinygrad import dtypes, Tensor, fetch, Device
 from tinygrad.nn.state import ggml_data_to_tensor, gguf_load
 from tinygrad.device import is_dtype_supported
+from tinygrad.helpers import GlobalCounters
 import numpy as np
 import ggml
 
@@ -39,6 +40,15 @@ def ggml_tensor_to_numpy(tensor: ggml.ggml_tensor_p):
   output.dtype = np_type
   return np.lib.stride_tricks.as_strided(output, shape=shape, strides=strides), ctx
 
+def make_gguf(tensors: dict[str, tuple[bytes, tuple[int, ...], int]]) -> bytes:
+  def gguf_str(x: str) -> bytes: return struct.pack("<Q", len(x)) + x.encode()
+  infos, data = b"", b""
+  for name, (raw, dims, ggml_type) in tensors.items():
+    infos += gguf_str(name) + struct.pack("<I", len(dims)) + b"".join(struct.pack("<Q", d) for d in dims) + struct.pack("<iQ", ggml_type, len(data))
+    data += raw + b"\0" * (-len(raw) % 32)
+  header = b"GGUF" + struct.pack("<iqq", 3, len(tensors), 0) + infos
+  return header + b"\0" * (-len(header) % 32) + data
+
 @unittest.skipIf(any(not is_dtype_supported(t) for t in [ dtypes.uint8, dtypes.half ]), "Backend must support uint8 and half")
 # TODO: WEBGPU GGUF dequantization produces incorrect values
 @unittest.skipIf(Device.DEFAULT == "WEBGPU", "WEBGPU GGUF dequantization issue")
@@ -86,6 +96,17 @@ class TestGGUF(unittest.TestCase):
     # TODO: should this be exact equal? somehow failed on CI
     np.testing.assert_allclose(out.numpy(), expected, atol=0.0, rtol=1e-6)
 
+  def test_load_quantized(self):
+    q8_0 = b"".join(np.float16(0.5).tobytes() + np.arange(-16, 16, dtype=np.int8).tobytes() for _ in range(2))
+    f32 = np.arange(8, dtype=np.float32)
+    gguf_tensor = Tensor(np.frombuffer(bytearray(make_gguf({"q": (q8_0, (64,), 8), "f": (f32.tobytes(), (8,), 0)})), dtype=np.uint8)).realize()
+    _, expected = gguf_load(gguf_tensor)
+    mem_used = GlobalCounters.mem_used
+    _, tensors = gguf_load(gguf_tensor, quantized=True)
+    # only the blocks are in memory, the dequantization is lazy
+    self.assertEqual(GlobalCounters.mem_used - mem_used, len(q8_0) + f32.nbytes)
+    for k,v in expected.items(): np.testing.assert_equal(tensors[k].numpy(), v.numpy())
+
   def test_expected_failure_unknown_type(self):
     with self.assertRaises(ValueError):
       ggml_data_to_tensor(Tensor.empty(512, dtype=dtypes.uint8), 256, 1337)
@@ -110,6 +131,7 @@ class TestGGUF(unittest.TestCase):
     model_size = os.stat(fp).st_size
     gguf_tensor = Tensor.empty(model_size, dtype=dtypes.uint8, device=f"disk:{fp}").to(Device.DEFAULT)
     kv_data, tensors = gguf_load(gguf_tensor)
+    _, quantized_tensors = gguf_load(gguf_tensor, quantized=True)
 
     gguf_params = ggml.gguf_init_params(ctx=self.ctx, no_alloc=False)
     gguf_ctx = ggml.gguf_init_from_file(str(fp).encode("utf8"), gguf_params)
@@ -121,6 +143,7 @@ class TestGGUF(unittest.TestCase):
       ggml_tensor_numpy, temp_ctx = ggml_tensor_to_numpy(ggml_tensor)
       tensor = tensors.get(tensor_name.decode("utf-8"))
       np.testing.assert_equal(tensor.numpy(), ggml_tensor_numpy)
+      np.testing.assert_equal(quantized_tensors[tensor_name.decode("utf-8")].numpy(), ggml_tensor_numpy)
       if temp_ctx is not None: ggml.ggml_free(temp_ctx)
 
     for gguf_key_id in range(ggml.gguf_get_n_kv(gguf_ctx)):
@@ -2,7 +2,7 @@ import ctypes, gzip, unittest, timeit, pickle
 from tinygrad import Variable
 from tinygrad.helpers import Context, ContextVar, argfix, colored, word_wrap, is_numpy_ndarray, mv_address, get_contraction, count, all_same
 from tinygrad.helpers import merge_dicts, strip_parens, prod, round_up, fetch, fully_flatten, from_mv, to_mv, polyN, time_to_str, cdiv, cmod, getbits
-from tinygrad.helpers import ceildiv
+from tinygrad.helpers import ceildiv, LRUCache
 from tinygrad.tensor import Tensor, get_shape
 import numpy as np
 
@@ -158,6 +158,52 @@ class TestCount(unittest.TestCase):
     c2 = pickle.loads(pickle.dumps(c))
     self.assertEqual(next(c2), 3)
 
+class TestLRUCache(unittest.TestCase):
+  def setUp(self): self.entries, self.mb = ContextVar("TEST_LRU_ENTRIES", 0), ContextVar("TEST_LRU_MB", 0)
+  def tearDown(self): del ContextVar._cache["TEST_LRU_ENTRIES"], ContextVar._cache["TEST_LRU_MB"]
+
+  def test_unbounded(self):
+    c = LRUCache(self.entries)
+    for i in range(100): c[i] = i
+    self.assertEqual(len(c), 100)
+
+  def test_evict_lru(self):
+    c = LRUCache(self.entries)
+    with Context(TEST_LRU_ENTRIES=2):
+      c[1], c[2] = "a", "b"
+      self.assertEqual(c.get(1), "a")
+      c[3] = "c"
+    self.assertEqual(list(c.keys()), [1, 3])
+    self.assertIsNone(c.get(2))
+    st = c.stats()
+    self.assertEqual((st.hits, st.misses, st.evictions, st.entries), (1, 1, 1, 2))
+
+  def test_evict_bytes(self):
+    c = LRUCache(self.entries, self.mb, sizeof=len)
+    with Context(TEST_LRU_MB=1):
+      c["a"], c["b"] = b"x"*600_000, b"x"*300_000
+      self.assertEqual(c.stats().nbytes, 900_000)
+      c["c"] = b"x"*200_000
+    self.assertEqual(list(c.keys()), ["b", "c"])
+    self.assertEqual(c.stats().nbytes, 500_000)
+    c["c"] = b"x"
+    self.assertEqual(c.stats().nbytes, 300_001)
+    c.clear()
+    self.assertEqual(c.stats().nbytes, 0)
+
+  def test_shared_value_bytes(self):
+    # the method cache stores a runner under its device key and its base device key
+    c = LRUCache(self.entries, self.mb, sizeof=len)
+    with Context(TEST_LRU_MB=1):
+      c["a"] = c["a_base"] = b"x"*600_000
+      self.assertEqual(c.stats().nbytes, 600_000)
+      c["b"] = b"x"*300_000
+      self.assertEqual(c.stats().evictions, 0)
+      # the bytes of a value go once its last key is evicted
+      c["c"] = b"x"*200_000
+      self.assertEqual((c.stats().evictions, c.stats().nbytes), (2, 500_000))
+    self.assertEqual(list(c.keys()), ["b", "c"])
+
 @unittest.skip("no fetch tests because they need internet")
 class TestFetch(unittest.TestCase):
   def test_fetch_bad_http(self):
@@ -1,4 +1,5 @@
 import unittest
+from unittest.mock import patch
 import numpy as np
 from tinygrad import Tensor
 
@@ -49,5 +50,20 @@ class TestMoEFeedForward(unittest.TestCase):
     expected = 1 + (Tensor([1.0]).silu().item() + Tensor([3.0]).silu().item()) / 2
     np.testing.assert_allclose(out.numpy(), expected, rtol=1e-2)
 
+  def test_moe_grouped_matches_gather(self):
+    from tinygrad.apps.llm import TransformerBlock
+    Tensor.manual_seed(0)
+    dim, hidden, n_heads = 16, 32, 2
+    num_experts, k = 8, 2
+    block = TransformerBlock(dim, hidden, n_heads, n_heads, norm_eps=1e-5, head_dim=dim//n_heads,
+                             rope_theta=10000, max_context=16, num_experts=num_experts, num_experts_per_tok=k)
+    for w in (block.ffn_gate_exps, block.ffn_up_exps, block.ffn_down_exps): w.weight = Tensor.randn(*w.weight.shape) * 0.1
+    block.ffn_gate_inp.weight = Tensor.randn(num_experts, dim)
+
+    # 2*17 tokens route 68 pairs, tiles of 4 rows take the grouped path and pad the last tile of most experts
+    h = Tensor.randn(2, 17, dim).realize()
+    with patch("tinygrad.apps.llm.MOE_TILE", 0): expected = block._feed_forward(h).numpy()
+    with patch("tinygrad.apps.llm.MOE_TILE", 4): np.testing.assert_allclose(block._feed_forward(h).numpy(), expected, atol=1e-5, rtol=1e-5)
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,6 +1,8 @@
-import unittest, threading, time
+import unittest, threading, time, itertools
+import numpy as np
 from unittest.mock import Mock, patch
-from tinygrad import Tensor
+from tinygrad import Tensor, dtypes
+from tinygrad.helpers import CacheStats
 
 class TestTransformerGenerate(unittest.TestCase):
   def test_start_pos_parameter_is_used(self):
@@ -11,8 +13,8 @@ class TestTransformerGenerate(unittest.TestCase):
                         norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
 
     captured_inputs = []
-    def mock_call(self, tokens, start_pos):
-      captured_inputs.append((tokens.shape, start_pos if isinstance(start_pos, int) else start_pos.bind_val))
+    def mock_call(self, tokens, start_pos, sampling=None):
+      captured_inputs.append((tokens.shape, start_pos if isinstance(start_pos, int) else start_pos.val))
       return Tensor([[42]])  # return a fake next token
 
     with patch.object(Transformer, '__call__', mock_call):
@@ -25,6 +27,231 @@ class TestTransformerGenerate(unittest.TestCase):
     self.assertEqual(captured_inputs[0][0][-1], 2)  # shape should be (1, 2)
     self.assertEqual(captured_inputs[0][1], 3)  # start_pos should be 3, not 0
 
+  def test_chunked_prefill(self):
+    from tinygrad.apps.llm import Transformer
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=64)
+    def run(prompt, chunk):
+      model.reset_cache(1)
+      model.prefill_chunk = chunk
+      gen = model.generate(list(prompt))
+      return [next(gen) for _ in range(4)]
+    for n in (8, 21, 29, 35):
+      prompt = [(i*7) % 100 for i in range(n)]
+      # the last chunk overlaps the one before unless the prompt is a multiple of the chunk size
+      expected = run(prompt, 0)
+      self.assertEqual(run(prompt, 8), expected)
+    # 35 tokens are 5 chunks, the jit is replayed after the first two
+    self.assertEqual(model.prefill_jit.cnt, 5)
+
+  def test_async_generate(self):
+    from tinygrad.apps.llm import Transformer
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    def run(sync_every):
+      model.reset_cache(1)
+      tokens = [1, 2, 3]
+      out = list(model.generate(tokens, sync_every=sync_every))
+      self.assertEqual(tokens, [1, 2, 3] + out)
+      return out
+    # tokens are read back in chunks up to max_context, the last chunk is short
+    self.assertEqual(len(expected:=run(1)), 29)
+    for n in (3, 8, 3): self.assertEqual(run(n), expected)
+    # the jit that keeps the tokens is the model's, captured once per sync_every and replayed by the later calls
+    self.assertEqual(len(model.keep_jit._captures), 3)
+    self.assertGreater(sum(s.hits for s in model.keep_jit.stats.values()), 29)
+
+  def test_sampled_generate(self):
+    from tinygrad.apps.llm import Transformer, SamplingParams
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    def run(params=None):
+      model.reset_cache(1)
+      return list(itertools.islice(model.generate([1, 2, 3], params=params), 10))
+    greedy = run()
+    # top_k 1 samples on the device but only keeps the greedy token
+    self.assertEqual(run(SamplingParams(temperature=1.0, top_k=1)), greedy)
+    self.assertEqual(run(SamplingParams(temperature=1.0, seed=5)), sampled:=run(SamplingParams(temperature=1.0, seed=5)))
+    self.assertNotEqual(sampled, greedy)
+    self.assertNotEqual(run(SamplingParams(temperature=1.0, seed=6)), sampled)
+    # a high penalty on the last tokens stops the greedy tokens from repeating
+    self.assertEqual(len(set(run(SamplingParams(repetition_penalty=100.0)))), 10)
+
+  def test_sample_top_k_near_ties(self):
+    from tinygrad.apps.llm import SamplingParams, sampling_inputs, sample
+    # 12 logits a float step apart, a search of the cutoff can't tell them apart and keeps all of them. a row per seed
+    rows = [[5.0 + 4e-7*i for i in range(12)] + [0.0]*88, [5.0]*12 + [0.0]*88]
+    for k in (1, 3):
+      params = [SamplingParams(temperature=1.0, top_k=k, seed=seed) for seed in range(64) for _ in rows]
+      toks = sample(Tensor(rows*64), *sampling_inputs(params, [[1]]*len(params)))[:, 0].reshape(64, 2).numpy()
+      # the k largest of the first row, and the k lowest ids of the equal logits of the second like topk
+      self.assertEqual(set(toks[:, 0]) | set(range(12-k, 12)), set(range(12-k, 12)))
+      self.assertEqual(set(toks[:, 1]), set(range(k)))
+
+  def test_quantized_kv_cache(self):
+    from tinygrad.apps.llm import Transformer
+    def make(kv_dtype=None):
+      Tensor.manual_seed(0)
+      return Transformer(num_blocks=2, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2, norm_eps=1e-5, vocab_size=100, head_dim=32,
+                         rope_theta=10000.0, max_context=32, kv_dtype=kv_dtype)
+    prompt = [(i*7) % 100 for i in range(12)]
+    (ref:=make()).reset_cache(1)
+    (q:=make("int8")).reset_cache(1)
+    self.assertEqual(q.blk[0].cache_kv.dtype, dtypes.int8)
+    self.assertEqual(q.blk[0].cache_kv_scale.shape, (2, 1, 2, 32, 1))
+    # the cache is written by the prefill of the first tokens and read back quantized by the rest
+    for m in (ref, q): m._logits(Tensor([prompt[:8]]), 0).realize()
+    np.testing.assert_allclose(q._logits(Tensor([prompt[8:]]), 8).numpy(), ref._logits(Tensor([prompt[8:]]), 8).numpy(), atol=5e-2, rtol=5e-2)
+    for m in (ref, q): m.reset_cache(1)
+    self.assertEqual(list(itertools.islice(q.generate(list(prompt)), 8)), list(itertools.islice(ref.generate(list(prompt)), 8)))
+
+  def test_half_weights(self):
+    from tinygrad.apps.llm import Transformer
+    from tinygrad.nn.state import get_state_dict
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    for v in get_state_dict(model).values(): v.replace(v.half()).realize()
+    # the cache is in the dtype of the weights, the k and v from rope are float
+    model.reset_cache(1)
+    self.assertEqual(model.blk[0].cache_kv.dtype, dtypes.half)
+    self.assertEqual(len(list(itertools.islice(model.generate([1, 2, 3]), 4))), 4)
+
+  def test_speculative_matches_generate(self):
+    from tinygrad.apps.llm import Transformer, SpeculativeDecoder
+    def make(seed, dim, num_blocks):
+      Tensor.manual_seed(seed)
+      return Transformer(num_blocks=num_blocks, dim=dim, hidden_dim=2*dim, n_heads=2, n_kv_heads=2,
+                         norm_eps=1e-5, vocab_size=100, head_dim=dim//2, rope_theta=10000.0, max_context=48)
+    target = make(0, 64, 2)
+    expected = list(target.generate([1, 2, 3]))
+    # the target as its own draft accepts everything, a random draft close to nothing, the tokens are the same
+    for draft, acceptance in ((target, 1.0), (make(1, 32, 1), None)):
+      target.reset_cache(1)
+      draft.reset_cache(1)
+      spec = SpeculativeDecoder(target, draft, k=4)
+      self.assertEqual(list(spec.generate([1, 2, 3])), expected)
+      if acceptance is not None: self.assertEqual(spec.acceptance, acceptance)
+      self.assertGreater(spec.proposed, 0)
+
+class TestGenerationEngine(unittest.TestCase):
+  def _check_batched_matches_sequential(self, steps, params=(None,)*4, kv_dtype=None, **kwargs):
+    from tinygrad.apps.llm import Transformer, GenerationEngine
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32, kv_dtype=kv_dtype)
+    prompts = [[1, 2, 3], [4, 5, 6, 7, 8], [9], [10, 11]]
+    expected = []
+    for p,sp in zip(prompts, params):
+      model.reset_cache(1)
+      gen = model.generate(list(p), params=sp)
+      expected.append([next(gen) for _ in range(steps)])
+
+    # 2 slots for 4 requests, so sequences are admitted while others are decoding
+    engine = GenerationEngine(model, max_batch=2, eos_id=-1, **kwargs)
+    self.assertEqual(self._run(engine, prompts, steps, params), expected)
+    return engine
+
+  def _run(self, engine, prompts, steps, params=None) -> list[list[int]]:
+    # the clients read steps tokens each while the engine is stepped on the test thread, until every sequence has left its slot
+    out: list[list[int]] = [[] for _ in prompts]
+    def client(i):
+      for tok in engine.generate(prompts[i], None if params is None else params[i]):
+        out[i].append(tok)
+        if len(out[i]) == steps: break
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(len(prompts))]
+    for t in threads: t.start()
+    while any(t.is_alive() for t in threads) or any(engine.slots) or engine.pending or not engine.waiting.empty(): engine.step()
+    return out
+
+  def test_batched_matches_sequential(self): self._check_batched_matches_sequential(6)
+
+  def test_sampled_matches_sequential(self):
+    # the seed and the position pick the noise, so a sampled request gets the same tokens next to greedy ones in any slot
+    from tinygrad.apps.llm import SamplingParams
+    self._check_batched_matches_sequential(6, params=[SamplingParams(temperature=1.0, seed=1), None,
+                                                      SamplingParams(temperature=0.7, top_p=0.9, seed=2), SamplingParams(repetition_penalty=2.0)])
+
+  def test_quantized_kv_matches_sequential(self):
+    # the paged cache quantizes every position the same way as the dense one
+    engine = self._check_batched_matches_sequential(6, kv_dtype="int8", block_size=4)
+    self.assertEqual(engine.model.blk[0].cache_pages_scale.shape[-1], 1)
+
+  def test_half_weights_paged(self):
+    from tinygrad.apps.llm import Transformer, GenerationEngine
+    from tinygrad.nn.state import get_state_dict
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    for v in get_state_dict(model).values(): v.replace(v.half()).realize()
+    model.reset_cache(1)
+    expected = list(itertools.islice(model.generate([1, 2, 3, 4, 5]), 4))
+    # the prefill writes the float k and v from rope into the half cache pages
+    engine = GenerationEngine(model, max_batch=1, eos_id=-1, block_size=4)
+    self.assertEqual(model.blk[0].cache_pages.dtype, dtypes.half)
+    self.assertEqual(self._run(engine, [[1, 2, 3, 4, 5]], 4), [expected])
+
+  def test_paged_preempt(self):
+    # 8 blocks of 4 fit one full context, two sequences of 17 positions need 10 so the newest gets preempted and prefilled again
+    engine = self._check_batched_matches_sequential(12, num_blocks=8, block_size=4)
+    self.assertEqual(len(engine.pool.free), 8)
+
+  def test_prefix_cache(self):
+    from tinygrad.apps.llm import Transformer, GenerationEngine
+    Tensor.manual_seed(0)
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    p1, p2 = list(range(1, 11)), list(range(1, 10)) + [50, 51]
+    expected = []
+    for p in (p1, p2):
+      model.reset_cache(1)
+      gen = model.generate(list(p))
+      expected.append([next(gen) for _ in range(4)])
+
+    engine = GenerationEngine(model, max_batch=2, eos_id=-1, block_size=4, prefix_cache_mb=1)
+    self.assertEqual(self._run(engine, [p1], 4), expected[:1])
+    # the first 8 tokens of p2 are the first 2 blocks of p1, they stay cached after p1 is done
+    self.assertEqual(self._run(engine, [p2], 4), expected[1:])
+    self.assertEqual(engine.pool.stats().hits, 8)
+    self.assertEqual(engine.pool.stats().misses, 10+3)
+
+  def test_kv_pool(self):
+    from tinygrad.apps.llm import Transformer, KVPool
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    pool = KVPool(model, 4, 8)
+    self.assertEqual(model.blk[0].cache_pages.shape, (2, 5, 2, 8, 32))
+    a, b = [], []
+    self.assertTrue(pool.reserve(a, 9))
+    self.assertTrue(pool.reserve(a, 16))
+    self.assertEqual(len(a), 2)
+    self.assertFalse(pool.reserve(b, 17))
+    self.assertEqual(b, [])
+    pool.release(a)
+    self.assertTrue(pool.reserve(b, 17))
+    self.assertEqual(len(pool.free), 1)
+
+  def test_kv_pool_prefix(self):
+    from tinygrad.apps.llm import Transformer, KVPool
+    model = Transformer(num_blocks=1, dim=64, hidden_dim=128, n_heads=2, n_kv_heads=2,
+                        norm_eps=1e-5, vocab_size=100, head_dim=32, rope_theta=10000.0, max_context=32)
+    pool, ids = KVPool(model, 4, 2, cache_blocks=2), [1, 2, 3, 4, 5]
+    self.assertTrue(pool.reserve(a:=[], 5))
+    pool.insert(ids, a, 5)
+    self.assertEqual(len(pool.cached), 2)
+    # at least one token is left to prefill
+    m1, m2 = pool.match([1, 2, 3, 4]), pool.match([1, 2, 3, 4, 9])
+    self.assertEqual((m1, m2), (a[:1], a[:2]))
+    self.assertEqual(pool.match([1, 9, 3, 4, 5]), [])
+    for t in (a, m1, m2): pool.release(t)
+    # the full blocks stay cached while idle, they are evicted when the pool runs out of free blocks
+    self.assertEqual((len(pool.free), len(pool.idle)), (2, 2))
+    self.assertTrue(pool.reserve([], 8))
+    self.assertEqual((pool.evictions, len(pool.cached)), (2, 0))
+
 class TestLLMServer(unittest.TestCase):
   """Integration tests using the real OpenAI client."""
 
@@ -36,14 +263,15 @@ class TestLLMServer(unittest.TestCase):
     cls.mock_tok.decode = Mock(return_value="Hello")
     cls.mock_tok.end_turn = Mock(return_value=[998])
 
-    cls.mock_model = Mock()
-    cls.mock_model.generate = Mock(side_effect=lambda ids, **kwargs: iter([300, 301, 999]))
+    cls.mock_engine = Mock()
+    cls.mock_engine.generate = Mock(side_effect=lambda ids, **kwargs: iter([300, 301, 999]))
+    cls.mock_engine.pool.stats = Mock(return_value=CacheStats(0, 0, 0, 0, 0))
 
     cls.bos_id = 1
     cls.eos_id = 999
 
     import tinygrad.apps.llm as llm_module
-    llm_module.model = cls.mock_model
+    llm_module.engine = cls.mock_engine
     llm_module.tok = cls.mock_tok
     llm_module.bos_id = cls.bos_id
     llm_module.eos_id = cls.eos_id
@@ -46,5 +46,12 @@ class TestLLMTokenizer(unittest.TestCase):
   def test_llama_repeat(self): self._test_coding(self.llama_tok, "00000000000000000", [ 931, 931, 931, 931, 931, 410 ])
   def test_llama_pat(self): self._test_coding(self.llama_tok, "today\n  \n", [ 31213, 14211 ])
 
+  def test_llama_batch(self):
+    texts = ["hello world", "<|start_header_id|>user<|end_header_id|>\n\n", "00000000000000000", " например", "a"*500]
+    expected = [self.llama_tok.encode(text) for text in texts]
+    self.assertEqual(self.llama_tok.encode_batch(texts), expected)
+    self.assertEqual(self.llama_tok.encode_batch(texts, workers=2), expected)
+    self.assertEqual(self.llama_tok.encode_batch(texts, workers=2, processes=True), expected)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from tinygrad import Tensor, Context
+from tinygrad.engine.realize import lower_schedule, run_schedule, ExecItem
+
+class TestLowerSchedule(unittest.TestCase):
+  def test_lookahead_order(self):
+    a = Tensor.arange(16).contiguous().realize()
+    # the first run compiles on this thread, the second is lowered ahead on the background thread
+    (((a+1).contiguous()*2).contiguous().to("CPU:1")+3).realize()
+    sched = (((a+1).contiguous()*2).contiguous().to("CPU:1")+3).schedule()
+    asts = [si.ast for si in sched]
+    lowered = list(lower_schedule(sched, lookahead=2))
+    self.assertEqual(len(sched), 0)
+    self.assertListEqual([ei.ast for ei in lowered], asts)
+    self.assertTrue(all(ei.prg is not None for ei in lowered))
+
+  def test_run_schedule_lookahead(self):
+    a = Tensor.arange(16).contiguous().realize()
+    out = ((a+1).contiguous()*2).contiguous().to("CPU:1")+3
+    with Context(LOWER_AHEAD=2): run_schedule(out.schedule())
+    self.assertListEqual(out.tolist(), [(i+1)*2+3 for i in range(16)])
+
+  def test_lowering_error(self):
+    class BadItem(ExecItem):
+      def lower(self): raise RuntimeError("bad item")
+    sched = (Tensor.arange(16).contiguous()+1).schedule()
+    sched.append(BadItem(sched[0].ast, sched[0].bufs))
+    with self.assertRaisesRegex(RuntimeError, "bad item"): list(lower_schedule(sched, lookahead=2))
+
+  def test_stop_early(self):
+    sched = [si for i in range(8) for si in (Tensor.ones(4+i).contiguous()+i).schedule()]
+    n = len(sched)
+    gen = lower_schedule(sched, lookahead=1)
+    next(gen)
+    gen.close()
+    # the lowering thread stopped without consuming the rest of the schedule
+    self.assertTrue(0 < len(sched) < n)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,9 +1,10 @@
-import unittest
+import unittest, os
 import functools
+from unittest.mock import patch
 from tinygrad import Tensor, Variable, UOp, Context
-from tinygrad.helpers import cpu_events
+from tinygrad.helpers import cpu_events, getenv
 from tinygrad.uop.ops import KernelInfo
-from tinygrad.engine.schedule import schedule_cache
+from tinygrad.engine.schedule import schedule_cache, disk_schedule_get
 
 def custom_set0_kernel(A:UOp, num:int) -> UOp:
   return A[0].set(num).sink(arg=KernelInfo(f"custom_set0_{num}"))
@@ -101,5 +102,44 @@ class TestScheduleCache(unittest.TestCase):
       num_events_cache = len(cpu_events)
     self.assertLess(num_events_cache, num_events_no_cache)
 
+  def test_bounded_schedule_cache(self):
+    schedule_cache.clear()
+    with Context(SCACHE_SIZE=2):
+      for i in range(4): (Tensor.ones(4+i).contiguous()+1).realize()
+    self.assertEqual(len(schedule_cache), 2)
+    self.assertGreater(schedule_cache.stats().evictions, 0)
+
+  def test_disk_schedule_cache(self):
+    a = Tensor.arange(16).reshape(4, 4).contiguous().realize()
+    def run(): return (a.T @ a + 3).sum(axis=0).tolist()
+    with Context(DISK_SCACHE=100):
+      expected = run()
+      schedule_cache.clear()
+      self.assertEqual(run(), expected)
+      self.assertTrue(len(schedule_cache) > 0 and all(disk_schedule_get(k) is not None for k in schedule_cache))
+
+  def test_disk_schedule_cache_key(self):
+    a = Tensor.arange(16).reshape(4, 4).contiguous().realize()
+    with Context(DISK_SCACHE=100):
+      schedule_cache.clear()
+      (a.T @ a + 3).sum(axis=0).realize()
+      keys = list(schedule_cache)
+      self.assertTrue(len(keys) > 0 and all(disk_schedule_get(k) is not None for k in keys))
+      # a different split threshold or scheduler source can give different kernels for the same graph
+      with patch.dict(os.environ, {"REDUCEOP_SPLIT_THRESHOLD": "16"}):
+        getenv.cache_clear()
+        self.assertTrue(all(disk_schedule_get(k) is None for k in keys))
+      getenv.cache_clear()
+      with patch("tinygrad.engine.schedule._schedule_source_hash", return_value="edited"):
+        self.assertTrue(all(disk_schedule_get(k) is None for k in keys))
+
+  @Context(SPEC=0)
+  def test_disk_schedule_cache_skips_custom_kernel(self):
+    schedule_cache.clear()
+    with Context(DISK_SCACHE=100):
+      a = Tensor.custom_kernel(Tensor.empty(1), fxn=functools.partial(custom_set0_kernel, num=3))[0]
+      self.assertEqual(a.item(), 3)
+    self.assertTrue(any(disk_schedule_get(k) is None for k in schedule_cache))
+
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+from tinygrad import Tensor, GlobalCounters, dtypes, Device
+from tinygrad.device import is_dtype_supported
+from tinygrad.dtype import _to_np_dtype
+
+def np_stable_order(a:np.ndarray, dim:int, descending:bool) -> np.ndarray:
+  a = a.astype(np.float64 if a.dtype.kind == "f" else np.int64)
+  return np.argsort(-a if descending else a, axis=dim, kind="stable")
+
+class TestSort(unittest.TestCase):
+  def test_sort_stable(self):
+    rng = np.random.default_rng(0)
+    for shape, dim in [((37,), 0), ((5, 17, 3), 1), ((4, 100), -1)]:
+      for a in (rng.standard_normal(shape).astype(np.float32), rng.integers(0, 4, shape).astype(np.int32)):
+        for descending in (False, True):
+          vals, idx = Tensor(a).sort(dim, descending)
+          order = np_stable_order(a, dim, descending)
+          np.testing.assert_equal(idx.numpy(), order)
+          np.testing.assert_equal(vals.numpy(), np.take_along_axis(a, order, dim))
+
+  def test_sort_ops(self):
+    # the indices are carried through the network, no orig_len x orig_len mask
+    a = Tensor.randn(4096).realize()
+    GlobalCounters.reset()
+    Tensor.realize(*a.sort())
+    self.assertLess(GlobalCounters.global_ops, 4096*4096)
+
+class TestTopk(unittest.TestCase):
+  def _check(self, a:np.ndarray, k:int, dim:int, largest:bool):
+    order = np.take(np_stable_order(a, dim, largest), np.arange(k), axis=dim)
+    vals, idx = Tensor(a).topk(k, dim, largest)
+    np.testing.assert_equal(idx.numpy(), order, err_msg=f"{a.dtype} {a.shape} {k=} {dim=} {largest=}")
+    np.testing.assert_equal(vals.numpy(), np.take_along_axis(a, order, dim))
+    # unsorted returns the same elements
+    vals, idx = Tensor(a).topk(k, dim, largest, sorted_=False)
+    np.testing.assert_equal(np.sort(idx.numpy(), axis=dim), np.sort(order, axis=dim))
+
+  def test_topk_ties(self):
+    rng = np.random.default_rng(0)
+    for shape, dim in [((37,), 0), ((5, 6, 4), 0), ((5, 6, 4), 1), ((3, 50), -1)]:
+      for k in sorted({1, 3, shape[dim]}):
+        for largest in (True, False):
+          self._check(rng.integers(-3, 4, shape).astype(np.int32), k, dim, largest)
+          self._check(rng.integers(0, 3, shape).astype(np.uint8), k, dim, largest)
+          self._check(rng.integers(0, 2, shape).astype(bool), k, dim, largest)
+
+  def test_topk_floats(self):
+    rng = np.random.default_rng(1)
+    a = rng.standard_normal((4, 1000)).astype(np.float32)
+    a[:, ::7] = 0.5
+    a[0, 3] = -0.0
+    for dtype in (dtypes.float32, dtypes.half, dtypes.float64):
+      if not is_dtype_supported(dtype, Device.DEFAULT): continue
+      for largest in (True, False): self._check(a.astype(_to_np_dtype(dtype)), 20, -1, largest)
+
+  def test_topk_signed_zeros(self):
+    # -0.0 and 0.0 are equal, the ties are broken by the index whatever the sign
+    a = np.array([[0.0, -0.0, 1.0, -0.0, 0.0, -1.0, -0.0, 0.0]], dtype=np.float32)
+    for dtype in (dtypes.float32, dtypes.half):
+      if not is_dtype_supported(dtype, Device.DEFAULT): continue
+      for k in (2, 4, 7):
+        for largest in (True, False): self._check(a.astype(_to_np_dtype(dtype)), k, -1, largest)
+
+  def test_topk_vocab(self):
+    a = Tensor.randn(2, 151936).realize()
+    GlobalCounters.reset()
+    vals, idx = a.topk(50)
+    Tensor.realize(vals, idx)
+    # the selection is linear in the vocab, a sort of the rows is ~2000 ops per element
+    self.assertLess(GlobalCounters.global_ops, 2*151936*500)
+    order = np_stable_order(a.numpy(), -1, True)[:, :50]
+    np.testing.assert_equal(idx.numpy(), order)
+
+  def test_topk_zero(self):
+    vals, idx = Tensor.randn(3, 4).topk(0)
+    self.assertEqual((vals.shape, idx.shape), ((3, 0), (3, 0)))
+
+if __name__ == "__main__":
+  unittest.main()
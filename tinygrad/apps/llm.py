@@ -1,7 +1,12 @@
 from __future__ import annotations
-import sys, argparse, typing, re, unicodedata, json, uuid, time, functools
-from tinygrad import Tensor, nn, UOp, TinyJit, getenv
-from tinygrad.helpers import partition, DEBUG, Timing, GlobalCounters, stderr_log, colored
+import sys, argparse, typing, re, unicodedata, json, uuid, time, functools, queue, threading, socketserver, collections, itertools, heapq, random
+import concurrent.futures, multiprocessing
+from dataclasses import dataclass, field
+from tinygrad import Tensor, nn, UOp, TinyJit, getenv, dtypes
+from tinygrad.uop.ops import KernelInfo
+from tinygrad.dtype import DType, DTypeLike, to_dtype
+from tinygrad.device import is_dtype_supported
+from tinygrad.helpers import partition, DEBUG, Timing, GlobalCounters, stderr_log, colored, ceildiv, CacheStats, unwrap
 from tinygrad.viz.serve import TCPServerWithReuse, HTTPRequestHandler
 
 class SimpleTokenizer:
@@ -13,7 +18,11 @@ class SimpleTokenizer:
 
     # https://github.com/ggml-org/llama.cpp/blob/94933c8c2eeaa9a7983e3f6c08af76bd86724094/src/llama-vocab.cpp#L286
     # 0x323b0 is one past the max codepoint in unicode categories L/N/Z (0x323af is max L)
-    def ucat_range(pre: str): return "".join(re.escape(chr(cp)) for cp in range(0x323b0) if unicodedata.category(chr(cp)).startswith(pre))
+    # the classes are written as ranges, re matches a class with codepoints above 0xffff by scanning its items
+    def ucat_range(pre: str):
+      cps = [cp for cp in range(0x323b0) if unicodedata.category(chr(cp)).startswith(pre)]
+      runs = [[cp for _,cp in g] for _,g in itertools.groupby(enumerate(cps), lambda x: x[1]-x[0])]
+      return "".join(re.escape(chr(r[0])) + (f"-{re.escape(chr(r[-1]))}" if len(r) > 1 else "") for r in runs)
     r_ws, r_p_N, r_p_L = r"\t\n\x0b\x0c\r\x85" + ucat_range("Z"), ucat_range("N"), ucat_range("L")
     self._split_to_word = re.compile("(?i:'s|'t|'re|'ve|'m|'ll|'d)|" + \
       f"[^\\r\\n{r_p_N}{r_p_L}]?[{r_p_L}]+|[{r_p_N}]{{1,3}}| ?[^{r_ws}{r_p_N}{r_p_L}]+[\\r\\n]*|[{r_ws}]*[\\r\\n]+|[{r_ws}]+(?![^{r_ws}])|[{r_ws}]+")
@@ -31,15 +40,24 @@ class SimpleTokenizer:
     normal_tokens, special_tokens = partition(vocab, lambda e: kv["tokenizer.ggml.token_type"][e[1]] == 1)
     return SimpleTokenizer(dict(normal_tokens), dict(special_tokens), kv["tokenizer.ggml.pre"])
 
-  def _encode_word(self, word:bytes) -> list[int]:
-    if (early_token:=self._normal_tokens.get(word)) is not None: return [early_token]
-    parts = [bytes([b]) for b in word]
-    # greedily merge any parts that we can
-    while True:
-      i = min([(sys.maxsize, -1)] + [(self._normal_tokens.get(parts[j]+parts[j+1], sys.maxsize), j) for j in range(len(parts)-1)])[1]
-      if i == -1: break
-      parts[i:i+2] = [parts[i] + parts[i+1]]
-    try: return [self._normal_tokens[p] for p in parts]
+  @functools.lru_cache(maxsize=1<<16)  # noqa: B019
+  def _encode_word(self, word:bytes) -> tuple[int, ...]:
+    if (early_token:=self._normal_tokens.get(word)) is not None: return (early_token,)
+    # greedily merge the pair with the lowest token id, leftmost first. parts are word[i:nxt[i]], merged away parts have nxt -1
+    # heap entries are (token id, left, right, end of right) and are stale once either part changed
+    nxt, prv = list(range(1, len(word)+1)), list(range(-1, len(word)-1))
+    heap: list[tuple[int, int, int, int]] = []
+    def push(i:int):
+      if i >= 0 and (j:=nxt[i]) < len(word) and (tid:=self._normal_tokens.get(word[i:nxt[j]])) is not None: heapq.heappush(heap, (tid, i, j, nxt[j]))
+    for i in range(len(word)-1): push(i)
+    while heap:
+      _, i, j, end = heapq.heappop(heap)
+      if nxt[i] != j or nxt[j] != end: continue
+      nxt[i], nxt[j] = end, -1
+      if end < len(word): prv[end] = i
+      push(prv[i])
+      push(i)
+    try: return tuple(self._normal_tokens[word[i:nxt[i]]] for i in range(len(word)) if nxt[i] != -1)
     except KeyError: raise RuntimeError("token not found")
   def _encode_sentence(self, chunk:str) -> list[int]:
     return [tok for word in self._split_to_word.findall(chunk) for tok in self._encode_word(word.encode())]
@@ -50,6 +68,15 @@ class SimpleTokenizer:
       tokens.extend(self._encode_sentence(text[pos:match.start(0)]) + [self._special_tokens[text[match.start(0):match.end(0)]]])
       pos = match.end(0)
     return tokens + self._encode_sentence(text[pos:])
+  def encode_batch(self, texts:list[str], workers:int=0, processes=False) -> list[list[int]]:
+    """Encode many texts, on a pool of workers threads or processes if workers > 0. Threads share the word cache, processes don't share the GIL."""
+    if workers <= 0: return [self.encode(text) for text in texts]
+    if not processes:
+      with concurrent.futures.ThreadPoolExecutor(workers) as ex: return list(ex.map(self.encode, texts))
+    # the tokenizer is sent once to each process
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker_tokenizer,
+                                                initargs=(self,)) as ex:
+      return list(ex.map(_worker_encode, texts, chunksize=max(1, len(texts) // (4*workers))))
 
   def decode(self, ids:list[int]) -> str: return b''.join(self._tok2bytes[tid] for tid in ids).decode(errors='replace')
   def role(self, role:str):
@@ -61,6 +88,12 @@ class SimpleTokenizer:
     if self.preset == 'qwen2': return [eos_id] + self.encode("\n")
     return [eos_id]
 
+_worker_tokenizer: SimpleTokenizer|None = None
+def _init_worker_tokenizer(tok:SimpleTokenizer):
+  global _worker_tokenizer
+  _worker_tokenizer = tok
+def _worker_encode(text:str) -> list[int]: return unwrap(_worker_tokenizer).encode(text)
+
 @functools.cache
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0) -> Tensor:
   freqs = 1.0 / (theta ** (Tensor.arange(0, dim, 2)[:(dim // 2)] / dim))
@@ -74,22 +107,117 @@ class ExpertWeights:
   def __call__(self, sel:Tensor, x:Tensor) -> Tensor:
     # sel: (B, T, k), x: (B, T, 1, in) or (B, T, k, in) -> output: (B, T, k, out)
     return (x.unsqueeze(-2) @ self.weight[sel].transpose(-1, -2)).squeeze(-2)
+  def grouped(self, tile_expert:Tensor, x:Tensor) -> Tensor:
+    # tile_expert: (NT,), x: (NT, M, in) -> output: (NT, M, out), the rows of a tile all go to its expert
+    return x @ self.weight[tile_expert].transpose(-1, -2)
 
 def apply_rope(x:Tensor, freqs_cis:Tensor) -> Tensor:
+  # freqs_cis: (T, Hd) shared by the batch or (B, T, Hd) per row
   assert x.shape[-1] % 2 == 0
-  cos, sin = freqs_cis.reshape(1, 1, x.shape[2], -1).chunk(2, dim=-1)
+  cos, sin = freqs_cis.reshape(freqs_cis.shape[0] if freqs_cis.ndim == 3 else 1, 1, x.shape[2], -1).chunk(2, dim=-1)
   x1, x2 = x.chunk(2, dim=-1)
   return (x1 * cos - x2 * sin).cat(x2 * cos + x1 * sin, dim=-1)
 
+def causal_mask(T:int|UOp, start_pos:int|UOp, dtype, device) -> Tensor|None:
+  # NOTE: this mask is causal_lower_right, not the causal_upper_left generated by is_casual = True
+  if T == 1: return None
+  if isinstance(start_pos, int): return Tensor.full((1, 1, T, start_pos+T), float("-inf"), dtype=dtype, device=device).triu(start_pos+1)
+  # triu doesn't take a symbolic shape
+  return (Tensor.arange(start_pos+T, device=device) - Tensor.arange(T, device=device).reshape(T, 1) > start_pos).where(float("-inf"), 0) \
+    .cast(dtype).reshape(1, 1, T, -1)
+
+@dataclass(frozen=True)
+class SamplingParams:
+  """
+  How a request picks its tokens. temperature 0 is greedy, top_k 0 and top_p 1 keep every token, repetition_penalty applies to the last
+  REPEAT_LAST_N tokens, and the seed makes the sampled tokens the same on every run and in any batch.
+  """
+  temperature: float = 0.0
+  top_k: int = 0
+  top_p: float = 1.0
+  repetition_penalty: float = 1.0
+  seed: int = field(default_factory=lambda: random.getrandbits(32))
+  @property
+  def greedy(self) -> bool: return self.temperature == 0 and self.repetition_penalty == 1
+
+REPEAT_LAST_N = getenv("REPEAT_LAST_N", 64)
+# top_k is a tensor per row, sample selects the MAX_TOP_K largest logits of every row and a larger top_k is clamped to it
+MAX_TOP_K = getenv("MAX_TOP_K", 64)
+def sampling_inputs(params:typing.Sequence[SamplingParams], ids:typing.Sequence[list[int]]) -> tuple[Tensor, Tensor, Tensor]:
+  """The inputs of sample for rows sampling the token after ids, they are small so a jitted decode takes new values every step."""
+  return (Tensor([[p.temperature, min(p.top_k, MAX_TOP_K), p.top_p, p.repetition_penalty] for p in params], dtype="float32"),
+          # the rng counter is the position of the sampled token
+          Tensor([[p.seed, len(x)] for p,x in zip(params, ids)], dtype="uint32"),
+          Tensor([[-1] * (REPEAT_LAST_N - len(h:=x[-REPEAT_LAST_N:])) + h for x in ids], dtype="int32"))
+
+def _search(x:Tensor, ok:typing.Callable[[Tensor], Tensor], steps:int=4, n:int=32) -> Tensor:
+  # about the largest t between the min and the max of every row of x (B,V) with ok(t), ok takes (B,n+1) and is true at the min and monotone
+  # every step tries n+1 values at once and narrows the range n times, so t is within (max-min)/n**steps below the exact value
+  lo, hi = x.min(-1, keepdim=True), x.max(-1, keepdim=True)
+  for _ in range(steps):
+    t = lo + (hi - lo) * Tensor.arange(n+1, device=x.device) / n
+    i = (ok(t).sum(-1, keepdim=True) - 1).maximum(0)
+    lo, hi = t.gather(-1, i), t.gather(-1, (i+1).minimum(n))
+  return lo
+
+def sample(logits:Tensor, params:Tensor, rng:Tensor, history:Tensor) -> Tensor:
+  """
+  Pick the next token of every row of logits (B,V) on the device. The inputs are from sampling_inputs: params (B,4) is temperature, top_k,
+  top_p and repetition_penalty, rng (B,2) is seed and counter, history (B,W) is the last tokens. Returns the token ids (B,1).
+  """
+  B, V = logits.shape
+  temperature, top_k, top_p, penalty = [params[:, i:i+1] for i in range(4)]
+  logits = logits.float()
+  # CTRL repetition penalty, a token in history is less likely
+  seen = (history.unsqueeze(-1) == Tensor.arange(V, device=logits.device)).any(1)
+  logits = seen.where((logits > 0).where(logits / penalty, logits * penalty), logits)
+  logits = logits / (temperature == 0).where(1, temperature)
+  # top_k keeps the k largest logits, of equal logits the lowest token ids like topk, so never more than k tokens
+  vals, idx = logits.topk(K:=min(typing.cast(int, V), MAX_TOP_K))
+  kth = (top_k.cast("int32") - 1).clip(0, K-1)
+  kth_val, kth_idx = vals.gather(-1, kth), idx.gather(-1, kth)
+  keep = (logits > kth_val) | ((logits == kth_val) & (Tensor.arange(V, device=logits.device) <= kth_idx))
+  logits = ((top_k <= 0) | keep).where(logits, -float("inf"))
+  # then top_p keeps the most likely tokens that cover top_p of the probability, the cutoff is searched so tokens within
+  # (max-min)/32**4 of probability below the exact one are kept too. every step of the search reads probs 33 times
+  probs = logits.softmax(-1).contiguous()
+  cut = (top_p < 1).where(_search(probs, lambda t: (probs.unsqueeze(1) >= t.unsqueeze(-1)).where(probs.unsqueeze(1), 0).sum(-1) >= top_p), 0)
+  logits = (probs >= cut).where(logits, -float("inf"))
+  # the gumbel max trick draws from softmax(logits) with an argmax, the noise is threefry of the seed at (counter, token)
+  ctr = (rng[:, 1:2].cast("uint64") << 32) | Tensor.arange(V, device=logits.device).cast("uint64").reshape(1, V)
+  bits = ctr._apply_uop(UOp.threefry, rng[:, 0:1].cast("uint64").expand(B, V))
+  u = ((bits >> 40).cast("float32") + 0.5) / (1 << 24)
+  return (logits - (temperature == 0).where(0, (-u.log()).log())).argmax(-1, keepdim=True).cast("int32")
+
+# rows in a tile of the grouped expert matmul, 0 always gathers the expert weights per token
+MOE_TILE = getenv("MOE_TILE", 16)
+# the largest value of a quantized kv cache dtype, the scale of a head at a position maps its largest abs value to it
+KV_QMAX = {dtypes.int8: 127, dtypes.fp8e4m3: 448, dtypes.fp8e5m2: 57344}
+
+def _page_store_kernel(c:UOp, x:UOp, blk:UOp, off:UOp) -> UOp:
+  # c is (2, num_blocks, KvH, block_size, Hd) and x is (2, B, KvH, T, Hd), position t of row b is stored at offset off[b,t] of block blk[b,t]
+  i, b, h, t, d = [UOp.range(s, n) for n,s in enumerate(x.shape)]
+  store = c[i, blk[b, t].cast(dtypes.index), h, off[b, t].cast(dtypes.index), d].store(x[i, b, h, t, d])
+  return store.end(i, b, h, t, d).sink(arg=KernelInfo(name=f"page_store_{'_'.join(map(str, x.shape))}"))
+
+def _page_load_kernel(out:UOp, c:UOp, table:UOp) -> UOp:
+  # out is (2, B, KvH, MB, block_size, Hd), block m of row b is block table[b,m] of c
+  i, b, h, m, o, d = [UOp.range(s, n) for n,s in enumerate(out.shape)]
+  load = out[i, b, h, m, o, d].store(c[i, table[b, m].cast(dtypes.index), h, o, d])
+  return load.end(i, b, h, m, o, d).sink(arg=KernelInfo(name=f"page_load_{'_'.join(map(str, out.shape))}"))
+
 class TransformerBlock:
   def __init__(self, dim:int, hidden_dim:int, n_heads:int, n_kv_heads:int, norm_eps:float, head_dim:int, rope_theta:float,
-               max_context:int=0, qk_norm:int=0, num_experts:int=0, num_experts_per_tok:int=0):
+               max_context:int=0, qk_norm:int=0, num_experts:int=0, num_experts_per_tok:int=0, kv_dtype:DTypeLike|None=None):
     self.n_heads      = n_heads
     self.n_kv_heads   = n_kv_heads
     self.head_dim     = head_dim
     self.rope_theta   = rope_theta
     self.max_context  = max_context
     self.qk_norm      = qk_norm
+    # with kv_dtype, the kv cache is stored quantized with a float32 scale per head and position
+    self.kv_dtype     = None if kv_dtype is None else to_dtype(kv_dtype)
+    if self.kv_dtype is not None and self.kv_dtype not in KV_QMAX: raise ValueError(f"kv_dtype must be one of {list(KV_QMAX)}, got {self.kv_dtype}")
 
     # --- attention projections (all linear, bias-free) ------------------
     q_proj_out       = self.head_dim * n_heads
@@ -106,7 +234,7 @@ class TransformerBlock:
 
     # --- feed-forward (MoE or dense) -------------------------------------
     if num_experts > 0:
-      self.num_experts_per_tok = num_experts_per_tok
+      self.num_experts, self.num_experts_per_tok = num_experts, num_experts_per_tok
       self.ffn_gate_inp = nn.Linear(dim, num_experts, bias=False)  # router
       self.ffn_gate_exps = ExpertWeights(num_experts, dim, hidden_dim)
       self.ffn_up_exps = ExpertWeights(num_experts, dim, hidden_dim)
@@ -116,7 +244,62 @@ class TransformerBlock:
       self.ffn_up      = nn.Linear(dim, hidden_dim, bias=False)
       self.ffn_down    = nn.Linear(hidden_dim, dim, bias=False)
 
-  def _attention(self, x:Tensor, start_pos:int|UOp) -> Tensor:
+  def _planes(self, name:str) -> list[Tensor]:
+    # the tensors of the cache called name, a quantized cache has its scales in name_scale
+    return [getattr(self, name)] + ([getattr(self, name+"_scale")] if self.kv_dtype is not None else [])
+
+  def _quantize(self, kv:Tensor) -> list[Tensor]:
+    # kv (..., Hd) as the planes of the cache
+    if self.kv_dtype is None: return [kv]
+    scale = kv.float().abs().max(-1, keepdim=True) / KV_QMAX[self.kv_dtype]
+    q = kv.float() / scale.maximum(1e-12)
+    return [(q.round() if dtypes.is_int(self.kv_dtype) else q).cast(self.kv_dtype), scale]
+
+  @staticmethod
+  def _dequantize(planes:list[Tensor], dtype:DType) -> Tensor:
+    # lazy, so it's done inside the attention kernel as the cache is read
+    return planes[0] if len(planes) == 1 else (planes[0].float() * planes[1]).cast(dtype)
+
+  def _dense_kv(self, k:Tensor, v:Tensor, start_pos:int|UOp) -> tuple[Tensor, Tensor, Tensor|None]:
+    B, T = k.shape[0], k.shape[2]
+    # TODO: remove these kv cache realizes
+    if not hasattr(self, "cache_kv"): self.reset_cache(typing.cast(int, B), k.dtype, k.device)
+    caches = self._planes("cache_kv")
+    # rope upcasts k and v, they are stored in the dtype of the cache as in the paged path
+    Tensor.realize(*[c[:, :, :, start_pos:start_pos+T, :].assign(x.cast(c.dtype)) for c,x in zip(caches, self._quantize(Tensor.stack(k, v)))])
+    kv = self._dequantize([c[:, :, :, 0:start_pos+T, :] for c in caches], k.dtype)
+    return kv[0], kv[1], causal_mask(T, start_pos, k.dtype, k.device)
+
+  @staticmethod
+  def _store_pages(caches:list[Tensor], planes:list[Tensor], blk:Tensor, off:Tensor) -> list[Tensor]:
+    # only the slots of the new positions are written, in place. rope upcasts k and v, they are stored in the dtype of the cache pages
+    ret = [c.custom_kernel(x.cast(c.dtype), blk, off, fxn=_page_store_kernel)[0] for c,x in zip(caches, planes)]
+    Tensor.realize(*ret)
+    return ret
+
+  def _paged_kv(self, k:Tensor, v:Tensor, start_pos:int|UOp, table:list[int]|Tensor, pos:Tensor|None) -> tuple[Tensor, Tensor, Tensor|None]:
+    # cache_pages is (2, num_blocks, KvH, block_size, Hd), position p of a sequence is at offset p%block_size of block table[p//block_size]
+    caches, planes = self._planes("cache_pages"), self._quantize(Tensor.stack(k, v))
+    (B, _, T, _), bs = k.shape, typing.cast(int, caches[0].shape[3])
+    if isinstance(table, list):
+      # prefill of one sequence, the positions it covers are stored through the table and the blocks are read as slices
+      assert B == 1 and isinstance(start_pos, int), "paged prefill is one sequence from a python int start_pos"
+      ps = range(start_pos, start_pos+T)
+      caches = self._store_pages(caches, planes, Tensor([[table[p//bs] for p in ps]], dtype="int32"), Tensor([[p%bs for p in ps]], dtype="int32"))
+      kv = self._dequantize([Tensor.cat(*[c[:, b] for b in table[:ceildiv(start_pos+T, bs)]], dim=2)[:, :, 0:start_pos+T].unsqueeze(1)
+                             for c in caches], k.dtype)
+      return kv[0], kv[1], causal_mask(T, start_pos, k.dtype, k.device)
+    # batched decode, row b writes position pos[b] through its table row and reads all the blocks of it
+    assert pos is not None and T == 1, "paged decode is one token per row at pos"
+    caches = self._store_pages(caches, planes, table.gather(1, (pos // bs).reshape(B, 1)), (pos % bs).reshape(B, 1))
+    MB = table.shape[1]
+    # (2,B,KvH,MB*bs,Hd), only the blocks in the table are read
+    kv = self._dequantize([Tensor.empty(2, B, c.shape[2], MB, bs, c.shape[-1], dtype=c.dtype, device=c.device)
+                           .custom_kernel(c, table, fxn=_page_load_kernel)[0].reshape(2, B, -1, MB*bs, c.shape[-1]) for c in caches], k.dtype)
+    mask = (Tensor.arange(MB*bs) <= pos.reshape(B, 1, 1, 1)).where(0, float("-inf")).cast(k.dtype)
+    return kv[0], kv[1], mask
+
+  def _attention(self, x:Tensor, start_pos:int|UOp, table:list[int]|Tensor|None=None, pos:Tensor|None=None) -> Tensor:
     x_norm = self.attn_norm(x)                       # (B,T,D)
     q, k, v = self.attn_q(x_norm), self.attn_k(x_norm), self.attn_v(x_norm)
     if self.qk_norm and self.qk_norm != self.head_dim: q, k = self.attn_q_norm(q), self.attn_k_norm(k)
@@ -127,19 +310,13 @@ class TransformerBlock:
     v = v.reshape(B, T, self.n_kv_heads, self.head_dim).transpose(1, 2)  # (B,KvH,T,Hd)
     if self.qk_norm == self.head_dim: q, k = self.attn_q_norm(q), self.attn_k_norm(k)
 
-    freqs_cis = precompute_freqs_cis(self.head_dim, self.max_context, self.rope_theta)[start_pos:start_pos+T]
+    # with pos, every row of the batch decodes one token at its own position
+    freqs_cis = precompute_freqs_cis(self.head_dim, self.max_context, self.rope_theta)
+    freqs_cis = freqs_cis[start_pos:start_pos+T] if pos is None else freqs_cis[pos].unsqueeze(1)
     q = apply_rope(q, freqs_cis)
     k = apply_rope(k, freqs_cis)
 
-    # TODO: remove these kv cache realizes
-    if not hasattr(self, "cache_kv"):
-      self.cache_kv = Tensor.zeros(2, B, self.n_kv_heads, self.max_context, self.head_dim, dtype=k.dtype, device=k.device).contiguous().realize()
-    self.cache_kv[:, :, :, start_pos:start_pos+T, :].assign(Tensor.stack(k, v)).realize()
-    k = self.cache_kv[0, :, :, 0:start_pos+T, :]
-    v = self.cache_kv[1, :, :, 0:start_pos+T, :]
-
-    # NOTE: this mask is causal_lower_right, not the causal_upper_left generated by is_casual = True
-    mask = Tensor.full((1, 1, T, start_pos+T), float("-inf"), dtype=x.dtype, device=x.device).triu(start_pos+1) if T > 1 else None
+    k, v, mask = self._dense_kv(k, v, start_pos) if table is None else self._paged_kv(k, v, start_pos, table, pos)
     attn = q.scaled_dot_product_attention(k, v, attn_mask=mask, enable_gqa=True)     # (B,H,T,Hd)
     attn = attn.transpose(1, 2).reshape(B, T, -1)                                    # back to (B,T,D)
     attn = self.attn_output(attn)
@@ -150,40 +327,109 @@ class TransformerBlock:
     if hasattr(self, 'ffn_gate_exps'):
       x = h_norm.unsqueeze(2)  # (B, T, 1, D) - add expert dim for broadcasting
       probs, sel = self.ffn_gate_inp(h_norm).softmax(-1).topk(self.num_experts_per_tok)  # (B, T, k) each
+      # with enough tokens per expert, prefill groups the tokens by expert and reads every expert once per tile
+      if MOE_TILE and sel.numel() >= self.num_experts * MOE_TILE // 2: return h + self._grouped_experts(h_norm, probs, sel)
       x_down = self.ffn_down_exps(sel, self.ffn_gate_exps(sel, x).silu() * self.ffn_up_exps(sel, x))  # (B, T, k, D)
       return h + (x_down * probs.unsqueeze(-1)).sum(axis=2)  # (B, T, D)
     # TODO: remove the need for this contiguous
     gated  = self.ffn_gate(h_norm).silu().contiguous() * self.ffn_up(h_norm)
     return h + self.ffn_down(gated)
 
-  def __call__(self, x: Tensor, start_pos: int|UOp):
-    return self._feed_forward(self._attention(x, start_pos)).contiguous()
+  def _grouped_experts(self, x:Tensor, probs:Tensor, sel:Tensor) -> Tensor:
+    # the (token, expert) pairs are sorted by expert into tiles of MOE_TILE rows and every tile is one matmul with the weights of its expert.
+    # an expert pads its last tile, so there are at most ceil(pairs/MOE_TILE) + num_experts tiles
+    B, T, D = x.shape
+    E, k, M = self.num_experts, self.num_experts_per_tok, MOE_TILE
+    A, NT = B*T*k, ceildiv(B*T*k, M) + E
+    expert = sel.reshape(A)
+    onehot = (expert.unsqueeze(-1) == Tensor.arange(E, device=x.device)).cast("int32")  # (A, E)
+    tiles = (onehot.sum(0) + M - 1) // M
+    first = tiles.cumsum(0) - tiles                                                        # first tile of every expert
+    row = first[expert] * M + ((onehot.cumsum(0) - onehot) * onehot).sum(-1)               # (A,) row of every pair, in order within its expert
+    tile_expert = (Tensor.arange(NT, device=x.device).unsqueeze(-1) >= first + tiles).sum(-1).minimum(E-1)
+    # the token of every row, padding rows compute token 0 and aren't read back
+    token = (row == Tensor.arange(NT*M, device=x.device).unsqueeze(-1)).where(Tensor.arange(A, device=x.device) // k, 0).sum(-1)
+    xt = x.reshape(B*T, D)[token].reshape(NT, M, D)
+    h = self.ffn_gate_exps.grouped(tile_expert, xt).silu() * self.ffn_up_exps.grouped(tile_expert, xt)
+    out = self.ffn_down_exps.grouped(tile_expert, h).reshape(NT*M, D)[row]                 # (A, D)
+    return (out * probs.reshape(A, 1)).reshape(B, T, k, D).sum(2)
+
+  def _make_cache(self, name:str, shape:tuple[int, ...], dtype, device):
+    if self.kv_dtype is not None and not is_dtype_supported(self.kv_dtype, device): raise ValueError(f"{device} doesn't support {self.kv_dtype}")
+    setattr(self, name, Tensor.zeros(*shape, self.head_dim, dtype=self.kv_dtype or dtype, device=device).contiguous().realize())
+    if self.kv_dtype is not None: setattr(self, name+"_scale", Tensor.zeros(*shape, 1, dtype="float32", device=device).contiguous().realize())
+
+  def reset_cache(self, batch_size:int, dtype, device):
+    self._make_cache("cache_kv", (2, batch_size, self.n_kv_heads, self.max_context), dtype, device)
+
+  def init_pages(self, num_blocks:int, block_size:int):
+    self._make_cache("cache_pages", (2, num_blocks, self.n_kv_heads, block_size), self.attn_k.weight.dtype, self.attn_k.weight.device)
+
+  def __call__(self, x: Tensor, start_pos: int|UOp, table:list[int]|Tensor|None=None, pos:Tensor|None=None):
+    return self._feed_forward(self._attention(x, start_pos, table, pos)).contiguous()
 
 class Transformer:
   def __init__(self, *, num_blocks, dim, hidden_dim, n_heads, n_kv_heads, norm_eps, vocab_size, head_dim:int, rope_theta:float,
-               max_context:int=0, qk_norm:int=0, num_experts:int=0, num_experts_per_tok:int=0):
+               max_context:int=0, qk_norm:int=0, num_experts:int=0, num_experts_per_tok:int=0, kv_dtype:DTypeLike|None=None):
     self.blk = [TransformerBlock(dim, hidden_dim, n_heads, n_kv_heads, norm_eps, head_dim, rope_theta, max_context, qk_norm,
-                                 num_experts, num_experts_per_tok) for _ in range(num_blocks)]
+                                 num_experts, num_experts_per_tok, kv_dtype) for _ in range(num_blocks)]
     self.token_embd  = nn.Embedding(vocab_size, dim)
     self.output_norm = nn.RMSNorm(dim, norm_eps)
     self.output = nn.Linear(dim, vocab_size, bias=False)
     self.max_context = max_context
     # JIT is used if T=1 and start_pos is a UOp. TODO: make this not needed by including T in the JIT and making start_pos always a UOp
-    self.forward_jit = TinyJit(self.forward)
-
-  def forward(self, tokens:Tensor, start_pos:int|UOp) -> Tensor:
+    # single sequence decode and batched paged decode, each greedy or sampled
+    self.forward_jit = TinyJit(self.forward, max_captures=4)
+    # prompts are prefilled in chunks of prefill_chunk tokens at a symbolic start_pos, so every prompt length replays the same capture
+    self.prefill_chunk = getenv("PREFILL_CHUNK", 128)
+    self.prefill_jit = TinyJit(self.forward, max_captures=2)
+    # speculative decoding checks the draft tokens with one forward of all of them
+    self.verify_jit = TinyJit(self.forward_all)
+    # generate keeps the token of every step on the device, a capture per sync_every
+    self.keep_jit = TinyJit(self._keep, max_captures=4)
+
+  def _logits(self, tokens:Tensor, start_pos:int|UOp, table:list[int]|Tensor|None=None, pos:Tensor|None=None) -> Tensor:
     x = self.token_embd(tokens)                           # (B, T, D)
-    for block in self.blk: x = block(x, start_pos)
-    # TODO: add temperature
-    return self.output(self.output_norm(x))[:, -1, :].softmax(-1, dtype="float").argmax(-1, keepdim=True)
-
-  def __call__(self, tokens:Tensor, start_pos:int|UOp=0) -> Tensor:
-    return (self.forward_jit if getenv("JIT", 1) and tokens.shape[1] == 1 and isinstance(start_pos, UOp) else self.forward)(tokens, start_pos)
+    for block in self.blk: x = block(x, start_pos, table, pos)
+    return self.output(self.output_norm(x))
+
+  def forward(self, tokens:Tensor, start_pos:int|UOp, table:list[int]|Tensor|None=None, pos:Tensor|None=None,
+              sampling:tuple[Tensor, Tensor, Tensor]|None=None) -> Tensor:
+    logits = self._logits(tokens, start_pos, table, pos)[:, -1, :]
+    return logits.softmax(-1, dtype="float").argmax(-1, keepdim=True) if sampling is None else sample(logits, *sampling)
+
+  def forward_all(self, tokens:Tensor, start_pos:int|UOp) -> Tensor:
+    """The next token after every position of tokens (B,T), with the dense kv cache."""
+    return self._logits(tokens, start_pos).softmax(-1, dtype="float").argmax(-1)
+
+  def __call__(self, tokens:Tensor, start_pos:int|UOp=0, table:list[int]|Tensor|None=None, pos:Tensor|None=None,
+               sampling:tuple[Tensor, Tensor, Tensor]|None=None) -> Tensor:
+    """
+    Decode tokens (B,T) from start_pos with the dense kv cache. With table the paged kv cache is used, table is the block list of one
+    sequence for prefill, or a (B, max_blocks) Tensor with pos (B,) the position of every row for batched decode.
+    The next token is greedy, or drawn on the device with the sampling_inputs of every row.
+    """
+    if isinstance(table, Tensor): return (self.forward_jit if getenv("JIT", 1) else self.forward)(tokens, start_pos, table, pos, sampling=sampling)
+    fxn = self.forward_jit if getenv("JIT", 1) and tokens.shape[1] == 1 and isinstance(start_pos, UOp) else self.forward
+    return fxn(tokens, start_pos, table, sampling=sampling)
+
+  def reset_cache(self, batch_size:int):
+    """Make a dense kv cache with batch_size rows in every block, dropping the old one."""
+    for b in self.blk: b.reset_cache(batch_size, b.attn_k.weight.dtype, b.attn_k.weight.device)
+    self.forward_jit.reset()
+    self.prefill_jit.reset()
+    self.verify_jit.reset()
+
+  def init_pages(self, num_blocks:int, block_size:int):
+    """Make a paged kv cache of num_blocks blocks of block_size positions in every block, shared by the sequences through block tables."""
+    for b in self.blk: b.init_pages(num_blocks, block_size)
+    self.forward_jit.reset()
 
   @staticmethod
-  def from_gguf(gguf:Tensor, max_context:int|None=None, realize=True) -> tuple[Transformer, dict]:
+  def from_gguf(gguf:Tensor, max_context:int|None=None, realize=True, quantized=False, kv_dtype:DTypeLike|None=None) -> tuple[Transformer, dict]:
     # TODO: remove the need for copy to default device
-    kv, state_dict = nn.state.gguf_load(gguf.to(None))
+    # with quantized, the weights stay ggml blocks in memory and are dequantized inside the kernels, decode reads fewer bytes per token
+    kv, state_dict = nn.state.gguf_load(gguf.to(None), quantized=quantized)
 
     # all state items should be float16, not float32
     state_dict = {k:v.cast('float16') if getenv("HALF", 1) else v for k,v in state_dict.items()}
@@ -208,22 +454,256 @@ class Transformer:
                         head_dim=kv.get(f'{arch}.attention.key_length', kv[f'{arch}.embedding_length'] // n_heads),
                         rope_theta=kv[f'{arch}.rope.freq_base'], max_context=max_context,
                         qk_norm=int(state_dict['blk.0.attn_q_norm.weight'].shape[0]) if 'blk.0.attn_q_norm.weight' in state_dict else 0,
-                        num_experts=kv.get(f'{arch}.expert_count', 0), num_experts_per_tok=kv.get(f'{arch}.expert_used_count', 0))
+                        num_experts=kv.get(f'{arch}.expert_count', 0), num_experts_per_tok=kv.get(f'{arch}.expert_used_count', 0),
+                        kv_dtype=kv_dtype)
     nn.state.load_state_dict(model, state_dict, verbose=False, consume=True, realize=False)  # NOTE: rope_freqs.weight (32,) is unused
+    if quantized: return model, kv
     # NOTE: without this contiguous, it unpacks the weights from the model every time. we shouldn't need this, but for now it's faster
     for s in (params:=nn.state.get_parameters(model)): s.replace(s.contiguous())
     if realize: Tensor.realize(*params)
     return model, kv
 
-  def generate(self, tokens:list[int], start_pos=0):
+  def prefill(self, tokens:list[int], start_pos:int=0, sampling:tuple[Tensor, Tensor, Tensor]|None=None) -> Tensor:
+    """Write the kv of tokens[start_pos:] to the dense cache and return the next token."""
+    if not (C:=self.prefill_chunk) or len(tokens)-start_pos < C or not getenv("JIT", 1):
+      return self(Tensor([tokens[start_pos:]], dtype="int32"), start_pos, sampling=sampling)
+    v_prefill_pos = UOp.variable("prefill_pos", 0, self.max_context-C)
+    # the last chunk ends at the end of the prompt, it writes the same kv again where it overlaps the chunk before
+    for s in [*range(start_pos, len(tokens)-C, C), len(tokens)-C]:
+      t = self.prefill_jit(Tensor([tokens[s:s+C]], dtype="int32"), v_prefill_pos.bind(s), sampling=sampling)
+    return t
+
+  def generate(self, tokens:list[int], start_pos=0, params:SamplingParams|None=None, sync_every:int=getenv("SYNC_EVERY", 8)):
+    """
+    Yield the tokens after tokens, appending them, from the kv cache holding tokens[:start_pos]. The token of a step is the input of the next
+    one on the device and the steps are queued without waiting for them. Tokens are read back sync_every at a time, so the host waits for the
+    device once per sync_every tokens, and a consumer stopping at EOS leaves at most sync_every-1 steps unused.
+    """
     v_start_pos = UOp.variable("start_pos", 1, self.max_context-1)
     t = Tensor([tokens[start_pos:]], dtype="int32")
-    while len(tokens) < self.max_context:
-      t = self(t, v_start_pos.bind(start_pos) if getenv("SYM", 1) and start_pos != 0 and t.shape[-1] == 1 else start_pos)
-      next_id = int(t.item())
-      tokens.append(next_id)
-      start_pos = len(tokens) - 1
-      yield next_id
+    sampling = sampling_inputs([params], [tokens]) if params is not None and not params.greedy else None
+    if len(tokens) >= self.max_context: return
+    # the jit writes every token to the same buffer, they are kept on the device until they are read
+    ring = Tensor.zeros(1, sync_every, dtype="int32").contiguous().realize()
+    v_slot = UOp.variable("slot", 0, sync_every-1)
+    for i, L in enumerate(range(len(tokens), self.max_context)):
+      # the step at L writes the kv of position L-1 and makes the token at L, the last tokens for the repetition penalty stay on the device
+      if sampling is not None and i > 0:
+        sampling = (sampling[0], Tensor([[unwrap(params).seed, L]], dtype="uint32"), sampling[2][:, 1:].cat(t, dim=1))
+      if t.shape[-1] > 1: t = self.prefill(tokens, start_pos, sampling)
+      else: t = self(t, v_start_pos.bind(L-1) if getenv("SYM", 1) and L-1 != 0 else L-1, sampling=sampling)
+      self.keep_jit(ring, t, v_slot.bind(slot:=i % sync_every))
+      if slot < sync_every-1 and L < self.max_context-1: continue
+      for next_id in typing.cast(list, ring.tolist())[0][:slot+1]:
+        tokens.append(next_id)
+        yield next_id
+
+  @staticmethod
+  def _keep(ring:Tensor, t:Tensor, slot:UOp): ring[:, slot:slot+1].assign(t).realize()
+
+
+class SpeculativeDecoder:
+  """
+  Speculative decoding: the draft model proposes k tokens one at a time, then the target checks all of them in one forward. The accepted
+  tokens and the target's token after them are kept, so the output is the same as target.generate. Both models use their dense kv cache.
+  Rejected tokens need no rollback, their kv is past the last kept position and is written again before it's read.
+  """
+  def __init__(self, target:Transformer, draft:Transformer, k:int=4):
+    if target.output.weight.shape[0] != draft.output.weight.shape[0]: raise ValueError("the draft model needs the vocab of the target model")
+    self.target, self.draft, self.k = target, draft, k
+    self.proposed, self.accepted = 0, 0
+
+  @property
+  def acceptance(self) -> float: return self.accepted / max(self.proposed, 1)
+
+  def generate(self, tokens:list[int], start_pos=0) -> typing.Iterator[int]:
+    max_context = min(self.target.max_context, self.draft.max_context)
+    v_draft_pos = UOp.variable("start_pos", 1, self.draft.max_context-1)
+    v_verify_pos = UOp.variable("verify_pos", 1, self.target.max_context-1-self.k)
+    self.draft.prefill(tokens, start_pos).realize()
+    new = [int(self.target.prefill(tokens, start_pos).item())]
+    while True:
+      for next_id in new:
+        tokens.append(next_id)
+        yield next_id
+        if len(tokens) >= max_context: return
+      # the kv of the last token isn't in either cache yet, it's written from position L-1 by both models
+      if (L:=len(tokens)) + self.k > max_context: break
+      # the draft tokens stay on the device, they are read back once with the target's tokens
+      last = d = Tensor([[tokens[-1]]], dtype="int32")
+      drafts = [d:=self.draft(d, v_draft_pos.bind(L-1+i)).clone().realize() for i in range(self.k)]
+      x = Tensor.cat(last, *drafts, dim=1)
+      proposal, check = typing.cast(list, Tensor.cat(x, self.target.verify_jit(x, v_verify_pos.bind(L-1))).tolist())
+      n = next((i for i in range(self.k) if proposal[i+1] != check[i]), self.k)
+      self.proposed, self.accepted = self.proposed + self.k, self.accepted + n
+      # with every draft token kept, the draft hasn't written the kv of the last one
+      if n == self.k: self.draft(drafts[-1], v_draft_pos.bind(L-1+self.k)).realize()
+      new = proposal[1:n+1] + [check[n]]
+    # no room left to check k tokens, the target finishes alone
+    yield from self.target.generate(tokens, len(tokens)-1)
+
+class KVPool:
+  """
+  The blocks of a paged kv cache. A sequence holds a table of blocks with its positions in order, and full blocks are indexed by the hash of
+  their token prefix so a sequence starting with the same tokens reuses them. Blocks nobody holds stay cached in LRU order up to cache_blocks.
+  """
+  def __init__(self, model:Transformer, num_blocks:int, block_size:int, cache_blocks:int=0):
+    # one more block for scratch, it backs the padding of the tables and the free rows of a batch
+    model.init_pages(num_blocks+1, block_size)
+    self.num_blocks, self.block_size, self.scratch, self.cache_blocks = num_blocks, block_size, num_blocks, cache_blocks
+    self.free = list(range(num_blocks))
+    self.refs = [0] * num_blocks
+    # prefix hash -> (parent hash, tokens of the block, block), parents are checked on lookup so a hash collision is a miss
+    self.cached: dict[int, tuple[int|None, tuple[int, ...], int]] = {}
+    self.block_key: dict[int, int] = {}
+    self.idle: collections.OrderedDict[int, None] = collections.OrderedDict()
+    self.hits, self.misses, self.evictions = 0, 0, 0
+    self.block_nbytes = sum(c.nbytes() // c.shape[1] for b in model.blk for c in b._planes("cache_pages"))
+
+  def _prefix_keys(self, ids:list[int], nblocks:int) -> typing.Iterator[tuple[int|None, tuple[int, ...], int]]:
+    key: int|None = None
+    for i in range(nblocks):
+      toks = tuple(ids[i*self.block_size:(i+1)*self.block_size])
+      yield key, toks, (key:=hash((key, toks)))
+
+  def _evict(self):
+    block, _ = self.idle.popitem(last=False)
+    del self.cached[self.block_key.pop(block)]
+    self.free.append(block)
+    self.evictions += 1
+
+  def match(self, ids:list[int]) -> list[int]:
+    """The cached blocks holding the longest prefix of ids that leaves at least one token, each one is held by the caller."""
+    table: list[int] = []
+    for parent, toks, key in self._prefix_keys(ids, (len(ids)-1) // self.block_size):
+      if (e:=self.cached.get(key)) is None or e[:2] != (parent, toks): break
+      table.append(e[2])
+      self.refs[e[2]] += 1
+      self.idle.pop(e[2], None)
+    return table
+
+  def insert(self, ids:list[int], table:list[int], length:int):
+    """Index the full blocks of table, which hold the kv of the first length positions of ids."""
+    for (parent, toks, key), block in zip(self._prefix_keys(ids, length // self.block_size), table):
+      if key not in self.cached and block not in self.block_key: self.cached[key], self.block_key[block] = (parent, toks, block), key
+
+  def reserve(self, table:list[int], length:int) -> bool:
+    """Grow table to hold length positions, False if there aren't enough free or idle blocks."""
+    if (need:=ceildiv(length, self.block_size) - len(table)) > len(self.free) + len(self.idle): return False
+    while len(self.free) < need: self._evict()
+    for _ in range(max(need, 0)):
+      table.append(block:=self.free.pop())
+      self.refs[block] = 1
+    return True
+
+  def release(self, table:list[int]):
+    for block in table:
+      self.refs[block] -= 1
+      if self.refs[block] == 0:
+        if block in self.block_key: self.idle[block] = None
+        else: self.free.append(block)
+    table.clear()
+    while len(self.idle) > self.cache_blocks: self._evict()
+
+  def stats(self) -> CacheStats:
+    """Prefix cache stats, hits and misses count prompt tokens."""
+    return CacheStats(self.hits, self.misses, self.evictions, len(self.cached), len(self.cached) * self.block_nbytes)
+
+@dataclass(eq=False)
+class Sequence:
+  ids: list[int]      # the prompt and the generated tokens
+  out: queue.Queue    # generated tokens, then None when it's done
+  table: list[int] = field(default_factory=list)
+  slot: int = -1
+  admitted: int = 0
+  cancelled: bool = False
+  params: SamplingParams = field(default_factory=SamplingParams)
+
+class GenerationEngine:
+  """
+  Continuous batching over a paged kv cache. New requests are prefilled into free slots between steps, every step decodes one token for all
+  the running sequences at their own positions, and a sequence leaves its slot on EOS or when the context is full. A sequence takes blocks
+  of the pool as it grows, when they run out the newest sequence is preempted back to the queue and prefilled again later.
+  Prefill starts after the longest cached prefix of the prompt, prefix_cache_mb bounds the kv kept for prefixes no running sequence holds.
+  All the model calls happen on the thread running `run`.
+  """
+  def __init__(self, model:Transformer, max_batch:int, eos_id:int, num_blocks:int=0, block_size:int=16, prefix_cache_mb:float=0):
+    self.model, self.max_batch, self.eos_id = model, max_batch, eos_id
+    self.max_blocks = ceildiv(model.max_context, block_size)
+    if num_blocks and num_blocks < self.max_blocks: raise ValueError(f"{num_blocks=} can't hold one sequence of max_context {model.max_context}")
+    self.pool = KVPool(model, num_blocks or max_batch*self.max_blocks, block_size)
+    self.pool.cache_blocks = int(prefix_cache_mb*1e6) // self.pool.block_nbytes
+    self.waiting: queue.Queue[Sequence] = queue.Queue()
+    self.pending: collections.deque[Sequence] = collections.deque()
+    self.slots: list[Sequence|None] = [None] * max_batch
+    self.admit_count = itertools.count()
+
+  def generate(self, ids:list[int], params:SamplingParams|None=None) -> typing.Iterator[int]:
+    self.waiting.put(seq:=Sequence(list(ids), queue.Queue(), params=params or SamplingParams()))
+    try:
+      while (next_id:=seq.out.get()) is not None: yield next_id
+    finally: seq.cancelled = True
+
+  def _leave(self, seq:Sequence):
+    # the kv of the last token isn't written yet
+    self.pool.insert(seq.ids, seq.table, len(seq.ids)-1)
+    self.pool.release(seq.table)
+    self.slots[seq.slot], seq.slot = None, -1
+
+  def _emit(self, seq:Sequence, next_id:int):
+    seq.ids.append(next_id)
+    seq.out.put(next_id)
+    if next_id == self.eos_id or seq.cancelled or len(seq.ids) >= self.model.max_context:
+      seq.out.put(None)
+      self._leave(seq)
+
+  def _admit(self, seq:Sequence) -> bool:
+    if seq.cancelled or not 0 < len(seq.ids) < self.model.max_context:
+      seq.out.put(None)
+      return True
+    seq.table = self.pool.match(seq.ids)
+    start = len(seq.table) * self.pool.block_size
+    if not self.pool.reserve(seq.table, len(seq.ids)):
+      self.pool.release(seq.table)
+      return False
+    self.pool.hits, self.pool.misses = self.pool.hits + start, self.pool.misses + len(seq.ids) - start
+    seq.slot, seq.admitted = self.slots.index(None), next(self.admit_count)
+    self.slots[seq.slot] = seq
+    sampling = sampling_inputs([seq.params], [seq.ids]) if not seq.params.greedy else None
+    next_id = int(self.model(Tensor([seq.ids[start:]], dtype="int32"), start, seq.table, sampling=sampling).item())
+    self.pool.insert(seq.ids, seq.table, len(seq.ids))
+    self._emit(seq, next_id)
+    return True
+
+  def step(self):
+    while not self.waiting.empty(): self.pending.append(self.waiting.get())
+    while None in self.slots and self.pending and self._admit(self.pending[0]): self.pending.popleft()
+    # every running sequence needs a block for the position it writes, the newest give theirs up if the pool runs out
+    for s in sorted((s for s in self.slots if s is not None), key=lambda s: s.admitted):
+      while s.slot != -1 and not self.pool.reserve(s.table, len(s.ids)):
+        victim = max((x for x in self.slots if x is not None), key=lambda x: x.admitted)
+        self._leave(victim)
+        self.pending.appendleft(victim)
+    if not any(self.slots): return
+    # free slots decode a dummy token at position 0 of the scratch block
+    toks = [s.ids[-1] if s is not None else 0 for s in self.slots]
+    pos = [len(s.ids)-1 if s is not None else 0 for s in self.slots]
+    table = [(tbl:=s.table if s is not None else []) + [self.pool.scratch] * (self.max_blocks - len(tbl)) for s in self.slots]
+    # the batch samples on the device if any row does, greedy rows are temperature 0
+    sampling = None
+    if any(s is not None and not s.params.greedy for s in self.slots):
+      sampling = sampling_inputs(*zip(*[(s.params, s.ids) if s is not None else (SamplingParams(), []) for s in self.slots]))
+    out = self.model(Tensor(toks, dtype="int32").reshape(-1, 1), 0, Tensor(table, dtype="int32"), Tensor(pos, dtype="int32"), sampling).tolist()
+    for seq,o in zip(self.slots, typing.cast(list, out)):
+      if seq is not None: self._emit(seq, o[0])
+
+  def run(self):
+    while True:
+      # sleep until a request comes in
+      if not any(self.slots) and not self.pending: self.pending.append(self.waiting.get())
+      self.step()
+
+class ThreadingTCPServerWithReuse(socketserver.ThreadingMixIn, TCPServerWithReuse): daemon_threads = True
 
 models = {
   "llama3.2:1b": "https://huggingface.co/bartowski/Llama-3.2-1B-Instruct-GGUF/resolve/main/Llama-3.2-1B-Instruct-Q6_K.gguf",
@@ -279,14 +759,16 @@ CHAT_HTML = b'''<!DOCTYPE html><html><head><title>tinygrad chat</title><style>
 class Handler(HTTPRequestHandler):
   def log_request(self, code='-', size='-'): pass
   def do_GET(self): self.send_data(CHAT_HTML, content_type="text/html")
-  def run_model(self, ids:list[int], model_name:str, include_usage=False):
+  def run_model(self, ids:list[int], model_name:str, include_usage=False, params:SamplingParams|None=None):
     stderr_log(f"{self.path}  {colored('--', 'BLACK')}  in:{len(ids):5d}  {colored('--', 'BLACK')}  ")
     tmpl = {"id":f"chatcmpl-{uuid.uuid4().hex[:24]}", "object":"chat.completion.chunk", "created":int(time.time()), "model":model_name}
     yield {"choices": [{"index":0, "delta":{"role":"assistant","content":""}, "finish_reason":None}], **tmpl}
     out: list[int] = []
     st = time.perf_counter()
-    for next_id in model.generate(ids):
-      if len(out) == 0: stderr_log(f"prefill:{len(ids)/((pt:=time.perf_counter())-st):4.0f} tok/s  {colored('--', 'BLACK')}  ")
+    for next_id in engine.generate(ids, params):
+      if len(out) == 0:
+        stderr_log(f"prefill:{len(ids)/((pt:=time.perf_counter())-st):4.0f} tok/s  {colored('--', 'BLACK')}  ")
+        stderr_log(f"prefix hit:{100*(cs:=engine.pool.stats()).hits/max(cs.hits+cs.misses, 1):3.0f}%  {colored('--', 'BLACK')}  ")
       if next_id == eos_id: break
       out.append(next_id)
       yield {"choices": [{"index":0, "delta":{"content":tok.decode([next_id])}, "finish_reason":None}], **tmpl}
@@ -315,8 +797,12 @@ class Handler(HTTPRequestHandler):
         ids += tok.end_turn(eos_id)
       ids += tok.role("assistant")
 
+      # sampling is greedy unless the request asks for it, top_k and repetition_penalty are the vLLM extensions
+      params = SamplingParams(body.get("temperature") or 0.0, body.get("top_k") or 0, body.get("top_p") or 1.0, body.get("repetition_penalty") or 1.0,
+                              **({"seed": body["seed"]} if body.get("seed") is not None else {}))
+
       # reply
-      chunks = self.run_model(ids, body["model"], not body.get("stream") or body.get("stream_options",{}).get("include_usage", False))
+      chunks = self.run_model(ids, body["model"], not body.get("stream") or body.get("stream_options",{}).get("include_usage", False), params)
       if body.get("stream"): self.stream_json(chunks)
       else:
         out = []
@@ -330,21 +816,61 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("--model", choices=list(models.keys()), default=list(models.keys())[0], help="Model choice")
   parser.add_argument("--max_context", type=int, default=4096, help="Max Context Length")
+  parser.add_argument("--quantized", action="store_true", help="Keep the quantized weights packed and dequantize them inside the kernels")
+  parser.add_argument("--kv_dtype", choices=["int8", "fp8e4m3", "fp8e5m2"], help="Store the kv cache quantized, with a scale per head and position")
   parser.add_argument("--serve", nargs='?', type=int, const=11434, metavar="PORT", help="Run OpenAI compatible API (optional port, default 11434)")
+  parser.add_argument("--max_batch", type=int, default=4, help="Number of requests the server decodes together")
+  parser.add_argument("--kv_blocks", type=int, default=0, help="Blocks of 16 positions in the paged kv cache, 0 fits max_batch full contexts")
+  parser.add_argument("--prefix_cache_mb", type=float, default=512, help="MB of kv kept for prompt prefixes between requests")
   parser.add_argument("--benchmark", nargs='?', type=int, const=20, metavar="COUNT", help="Benchmark tok/s (optional count, default 20)")
+  parser.add_argument("--draft", choices=list(models.keys()), help="Draft model for speculative decoding, it needs the tokenizer of the model")
+  parser.add_argument("--draft_k", type=int, default=4, help="Tokens the draft model proposes per step")
+  parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature of the chat, 0 is greedy")
+  parser.add_argument("--top_k", type=int, default=0, help="Sample from the k most likely tokens, 0 is all, at most MAX_TOP_K")
+  parser.add_argument("--top_p", type=float, default=1.0, help="Sample from the most likely tokens covering top_p of the probability")
+  parser.add_argument("--repetition_penalty", type=float, default=1.0, help="Penalty of the tokens in the last REPEAT_LAST_N")
+  parser.add_argument("--seed", type=int, help="Seed of the sampling")
   args = parser.parse_args()
 
   # load the model
-  model, kv = Transformer.from_gguf(Tensor.from_url(models[args.model]), args.max_context)
+  model, kv = Transformer.from_gguf(Tensor.from_url(models[args.model]), args.max_context, quantized=args.quantized, kv_dtype=args.kv_dtype)
   if DEBUG >= 1: print(f"using model {args.model}")
+  spec: SpeculativeDecoder|None = None
+  if args.draft is not None:
+    draft = Transformer.from_gguf(Tensor.from_url(models[args.draft]), args.max_context, quantized=args.quantized)[0]
+    spec = SpeculativeDecoder(model, draft, args.draft_k)
 
   # do benchmark
   if args.benchmark:
     param_bytes = sum(x.nbytes() for x in nn.state.get_parameters(model))
-    gen = model.generate([0], 0)
+    # every token is read back to time it on its own
+    gen = model.generate([0], 0, sync_every=1)
     for _ in range(args.benchmark):
       GlobalCounters.reset()
       with Timing(on_exit=lambda x: f", {1e9/x:6.2f} tok/s, {GlobalCounters.global_mem/x:7.2f} GB/s, param {param_bytes/x:7.2f} GB/s"): next(gen)
+    gen = model.generate([0], 0)
+    for _ in range(2*(n:=getenv("SYNC_EVERY", 8))): next(gen)
+    with Timing(f"{args.benchmark} tokens read back {n} at a time in ", on_exit=lambda x: f", {args.benchmark*1e9/x:6.2f} tok/s"):
+      for _ in range(args.benchmark): next(gen)
+    if spec is not None:
+      # tokens come out of the verify step in bursts, so this times all of them after the jits are captured
+      gen = spec.generate([0], 0)
+      for _ in range(3*(args.draft_k+1)): next(gen)
+      spec.proposed = spec.accepted = 0
+      with Timing(f"{args.benchmark} tokens with draft {args.draft} in ",
+                  on_exit=lambda x: f", {args.benchmark*1e9/x:6.2f} tok/s, acceptance {spec.acceptance*100:3.0f}%"):
+        for _ in range(args.benchmark): next(gen)
+    if args.kv_dtype is not None:
+      # decode reads the whole kv cache every token, so a long context is timed with the cache in the weight dtype and in kv_dtype
+      for kv_dtype in (None, to_dtype(args.kv_dtype)):
+        for b in model.blk: b.kv_dtype = kv_dtype
+        model.reset_cache(1)
+        kv_bytes = sum(c.nbytes() for b in model.blk for c in b._planes("cache_kv"))
+        gen = model.generate(list(range(ctx:=min(getenv("KV_CONTEXT", 2048), args.max_context-3*args.benchmark))))
+        for _ in range(2*n): next(gen)
+        with Timing(f"{args.benchmark} tokens at context {ctx}, kv cache {kv_dtype or model.blk[0].attn_k.weight.dtype} {kv_bytes/1e6:7.1f} MB, in ",
+                    on_exit=lambda x: f", {args.benchmark*1e9/x:6.2f} tok/s"):
+          for _ in range(args.benchmark): next(gen)
     exit(0)
 
   # extract some metadata
@@ -353,8 +879,12 @@ if __name__ == "__main__":
   eos_id: int = kv['tokenizer.ggml.eos_token_id']
 
   # start server
-  if args.serve: TCPServerWithReuse(('', args.serve), Handler).serve_forever()
+  if args.serve:
+    engine = GenerationEngine(model, args.max_batch, eos_id, args.kv_blocks, prefix_cache_mb=args.prefix_cache_mb)
+    threading.Thread(target=engine.run, daemon=True).start()
+    ThreadingTCPServerWithReuse(('', args.serve), Handler).serve_forever()
 
+  params = SamplingParams(args.temperature, args.top_k, args.top_p, args.repetition_penalty, **({"seed": args.seed} if args.seed is not None else {}))
   ids: list[int] = [bos_id] if bos_id is not None else []
   while 1:
     start_pos = max(len(ids) - 1, 0)
@@ -362,7 +892,8 @@ if __name__ == "__main__":
       ids += tok.role("user") + tok.encode(input('>>> ')) + tok.end_turn(eos_id) + tok.role("assistant")
     except EOFError:
       break
-    for next_id in model.generate(ids, start_pos):
+    # speculative decoding keeps the greedy tokens of the model
+    for next_id in spec.generate(ids, start_pos) if spec is not None and params.greedy else model.generate(ids, start_pos, params):
       sys.stdout.write(tok.decode([next_id]) if next_id != eos_id else "\n\n")
       sys.stdout.flush()
       if next_id == eos_id: break
@@ -1,14 +1,15 @@
 from __future__ import annotations
 from dataclasses import dataclass, replace
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import Any, Generic, TypeVar, Iterator, Generator
 import importlib, inspect, functools, pathlib, os, platform, contextlib, sys, re, atexit, pickle, decimal
 from tinygrad.helpers import CI, OSX, LRU, getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, PROFILE, temp, colored
 from tinygrad.helpers import Context, CCACHE, ALLOW_DEVICE_USAGE, MAX_BUFFER_SIZE, cpu_events, ProfileEvent, ProfilePointEvent, dedup, ContextVar
 from tinygrad.helpers import unwrap_class_type, suppress_finalizing, select_first_inited, VIZ, CPU_LLVM, CPU_LVP, NV_PTX, CUDA_PTX, NV_NAK
-from tinygrad.helpers import EMULATED_DTYPES
+from tinygrad.helpers import EMULATED_DTYPES, LRU_SIZE_CLASS, LRU_MB, CacheStats, ARENA, round_up, unwrap
 from tinygrad.dtype import DType, ImageDType, PtrDType, dtypes, _to_np_dtype
 from tinygrad.renderer import Renderer
+from tinygrad.runtime.support.memory import TLSFAllocator
 
 # **************** Device ****************
 
@@ -221,19 +222,53 @@ DMARef = DMACPURef|DMAFdRef
 
 DeviceType = TypeVar('DeviceType', bound='Compiled')
 
+@dataclass(eq=False)
+class ArenaSlab:
+  opaque: Any
+  tlsf: TLSFAllocator
+  live: int = 0
+  def alloc(self, size:int) -> int|None:
+    try: off = self.tlsf.alloc(size)
+    except MemoryError: return None
+    self.live += 1
+    return off
+
 # TODO: size, dest, src are the same type. can we enforce this?
 class Allocator(Generic[DeviceType]):
-  def __init__(self, dev:DeviceType, supports_copy_from_disk:bool=True, supports_transfer:bool=True):
+  def __init__(self, dev:DeviceType, supports_copy_from_disk:bool=True, supports_transfer:bool=True, supports_arena:bool=False):
     self.dev: DeviceType = dev
     self.default_buffer_spec: BufferSpec = BufferSpec()
-    self.supports_copy_from_disk, self.supports_transfer = supports_copy_from_disk, supports_transfer
+    self.supports_copy_from_disk, self.supports_transfer, self.supports_arena = supports_copy_from_disk, supports_transfer, supports_arena
+    self.slabs: list[ArenaSlab] = []
+    self.arena_views: dict[int, tuple[Any, ArenaSlab, int]] = {}  # id(view) -> (view, slab, offset)
   # overridden in LRUAllocator
   def alloc(self, size:int, options:BufferSpec|None=None):
     assert size > 0, f"alloc size must be positive, getting {size}"
+    if ARENA and self.supports_arena and (options is None or options == self.default_buffer_spec) and size <= (slab_size:=ARENA.value<<20)//4:
+      return self._arena_alloc(size, slab_size)
     return self._alloc(size, options if options is not None else self.default_buffer_spec)
   def free(self, opaque, size:int, options:BufferSpec|None=None):
+    if (av:=self.arena_views.pop(id(opaque), None)) is not None and av[0] is opaque: return self._arena_free(av[1], av[2])
     self._free(opaque, options if options is not None else self.default_buffer_spec)
 
+  # the arena hands out _offset views of large slabs, with the space in each slab managed by a TLSFAllocator
+  def _arena_alloc(self, size:int, slab_size:int):
+    for slab in reversed(self.slabs):
+      if (off:=slab.alloc(round_up(size, 0x100))) is not None: break
+    else:
+      self.slabs.append(slab:=ArenaSlab(self._alloc(slab_size, self.default_buffer_spec), TLSFAllocator(slab_size, block_size=0x100, lv2_cnt=32)))
+      off = unwrap(slab.alloc(round_up(size, 0x100)))
+    view = self._offset(slab.opaque, size, off)  # type: ignore[attr-defined]
+    self.arena_views[id(view)] = (view, slab, off)
+    return view
+  def _arena_free(self, slab:ArenaSlab, off:int):
+    slab.tlsf.free(off)
+    slab.live -= 1
+    # the newest slab stays mapped even when empty, so alloc/free loops don't map and unmap it every time
+    if slab.live == 0 and slab is not self.slabs[-1]:
+      self.slabs.remove(slab)
+      self._free(slab.opaque, self.default_buffer_spec)
+
   # implemented by the runtime
   def _alloc(self, size:int, options:BufferSpec): raise NotImplementedError("need alloc")
   def _free(self, opaque, options:BufferSpec): pass  # if opaque is a Python object, you don't need a free
@@ -244,27 +279,65 @@ class Allocator(Generic[DeviceType]):
   # def _transfer(self, dest, src, sz:int, src_dev, dest_dev):
   def _encode_decode(self, bufout, bufin, desc, hist:list, shape:tuple[int,...], frame_pos:int): raise NotImplementedError("need encdec") # optional
 
+def size_class(size:int, classes:int) -> int:
+  """Round size up to one of `classes` geometrically spaced sizes per power of two."""
+  if classes <= 0 or size <= 1: return size
+  return -(-size // (step:=max((1 << ((size-1).bit_length()-1)) // classes, 1))) * step
+
 class LRUAllocator(Allocator, Generic[DeviceType]):
   """
   The LRU Allocator is responsible for caching buffers.
   It ensures that buffers are not freed until it is absolutely necessary, optimizing performance.
+  With LRU_SIZE_CLASS, allocations are rounded up to size classes so close sizes reuse each other's buffers. With LRU_MB, the least recently
+  freed buffers are released once the cache holds more than that.
   """
   def __init__(self, dev:DeviceType, **kwargs):
     self.cache: dict[tuple[int, BufferSpec|None], Any] = defaultdict(list)
+    self.lru: OrderedDict[int, tuple[tuple[int, BufferSpec|None], Any]] = OrderedDict()  # id(opaque) -> (cache key, opaque), oldest first
+    self.views: dict[int, tuple[Any, Any, int]] = {}  # id(view) -> (view, size class allocation, class size)
+    self.hits, self.misses, self.evictions, self.cached_bytes = 0, 0, 0, 0
     super().__init__(dev, **kwargs)
+  def _class_size(self, size:int, options:BufferSpec|None) -> int:
+    # the buffer gets a view of the size class allocation, so the runtime never sees the rounded size
+    if not LRU_SIZE_CLASS or not hasattr(self, '_offset'): return size
+    if options is not None and (options.image is not None or options.external_ptr is not None or options.nolru): return size
+    return size_class(size, LRU_SIZE_CLASS.value)
   def alloc(self, size:int, options:BufferSpec|None=None):
-    if len(c := self.cache[(size, options)]): return c.pop()
-    try: return super().alloc(size, options)
-    except (RuntimeError, MemoryError):
-      self.free_cache()
-      return super().alloc(size, options)
+    csize = self._class_size(size, options)
+    if len(c := self.cache[(csize, options)]):
+      self.hits, self.cached_bytes = self.hits + 1, self.cached_bytes - csize
+      del self.lru[id(opaque:=c.pop())]
+    else:
+      self.misses += 1
+      try: opaque = super().alloc(csize, options)
+      except (RuntimeError, MemoryError):
+        self.free_cache()
+        opaque = super().alloc(csize, options)
+    if csize == size: return opaque
+    view = self._offset(opaque, size, 0)  # type: ignore[attr-defined]
+    self.views[id(view)] = (view, opaque, csize)
+    return view
+  def _evict(self):
+    (sz, options), opaque = self.lru.popitem(last=False)[1]
+    c = self.cache[(sz, options)]
+    c.pop(next(i for i,x in enumerate(c) if x is opaque))
+    self.evictions, self.cached_bytes = self.evictions + 1, self.cached_bytes - sz
+    super().free(opaque, sz, options)
   def free_cache(self):
     for (sz,options),opaques in self.cache.items():
       for opaque in opaques: super().free(opaque, sz, options)
       opaques.clear()
+    self.lru.clear()
+    self.cached_bytes = 0
   def free(self, opaque:Any, size:int, options:BufferSpec|None=None):
-    if LRU and (options is None or not options.nolru): self.cache[(size, options)].append(opaque)
+    if (cls:=self.views.pop(id(opaque), None)) is not None and cls[0] is opaque: opaque, size = cls[1], cls[2]
+    if LRU and (options is None or not options.nolru):
+      self.cache[(size, options)].append(opaque)
+      self.lru[id(opaque)] = ((size, options), opaque)
+      self.cached_bytes += size
+      while LRU_MB and self.cached_bytes > LRU_MB.value*1e6: self._evict()
     else: super().free(opaque, size, options)
+  def stats(self) -> CacheStats: return CacheStats(self.hits, self.misses, self.evictions, len(self.lru), self.cached_bytes)
 
 # **************** for Compiled Devices ****************
 
@@ -1,10 +1,11 @@
 from typing import TypeVar, Generic, Callable, cast, Any
-import functools, collections
+import functools, collections, pickle, struct, mmap, io
 from tinygrad.tensor import Tensor
-from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, JIT_BATCH_SIZE, dedup, partition, unwrap
+from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, JIT_BATCH_SIZE, dedup, partition, unwrap, round_up
+from tinygrad.helpers import GlobalCounters, PROFILE, all_int
 from tinygrad.device import Buffer, Compiled, Device, MultiBuffer
 from tinygrad.dtype import DType
-from tinygrad.uop.ops import UOp, Variable, sym_infer, Ops
+from tinygrad.uop.ops import UOp, Variable, sym_infer, Ops, buffers
 from tinygrad.engine.realize import ExecItem, capturing, ViewOp, BufferCopy, BufferXfer, EncDec, CompiledRunner, Runner, Estimates
 from tinygrad.engine.memory import _internal_memory_planner
 from tinygrad.nn.state import get_parameters
@@ -166,6 +167,39 @@ def update_depends(depends:set[Buffer|None], jit_cache:list[ExecItem]):
   for ei in jit_cache:
     if any(b in depends for b in ei.bufs): depends.update(get_out_buffers_for_ei(ei))
 
+class JitLaunch:
+  """A CompiledRunner launch in a jit replay with the buffer order, fixed vars and launch dims resolved once, so a launch only fills in the inputs and
+  the variables."""
+  def __init__(self, ei:ExecItem, input_slots:dict[int, int]):
+    prg, p = cast(CompiledRunner, ei.prg), cast(CompiledRunner, ei.prg).p
+    self.fxn = prg._prg
+    self.bufs = [None if i in input_slots else unwrap(ei.bufs[i])._buf for i in p.globals]
+    self.inputs = [(pos, input_slots[i]) for pos,i in enumerate(p.globals) if i in input_slots]
+    # each val is a fixed int (None for runtime vars) or the name of the variable to read from var_vals
+    self.vals: list[int|str|None] = [None if k.expr in p.runtimevars else ei.fixedvars.get(k.expr, k.expr) for k in p.vars]
+    self.static_vals = None if any(isinstance(v, str) for v in self.vals) else tuple(self.vals)
+    self.p, self.ops, self.mem = p, p.estimates.ops, p.estimates.mem
+    self.dims = None
+    if all_int(p.global_size) and (p.local_size is None or all_int(p.local_size)):
+      self.dims = (tuple(p.global_size), tuple(p.local_size) if p.local_size else None)
+    self.static_stats = isinstance(self.ops, int) and isinstance(self.mem, int)
+
+  def __call__(self, input_buffers:list[Buffer], var_vals:dict[str, int]):
+    for pos, idx in self.inputs: self.bufs[pos] = input_buffers[idx]._buf
+    vals = self.static_vals if self.static_vals is not None else tuple(var_vals[v] if isinstance(v, str) else v for v in self.vals)
+    if (dims:=self.dims) is None:
+      global_size, local_size = self.p.launch_dims(var_vals)
+      dims = (tuple(global_size), tuple(local_size) if local_size else None)
+    et = self.fxn(*self.bufs, global_size=dims[0], local_size=dims[1], vals=vals, wait=False)
+    GlobalCounters.kernel_count += 1
+    if self.static_stats:
+      GlobalCounters.global_ops += cast(int, self.ops)
+      GlobalCounters.global_mem += cast(int, self.mem)
+    else:
+      GlobalCounters.global_ops += sym_infer(self.ops, var_vals)
+      GlobalCounters.global_mem += sym_infer(self.mem, var_vals)
+    if et is not None: GlobalCounters.time_sum_s += et
+
 ReturnType = TypeVar('ReturnType')
 @dataclass
 class CapturedJit(Generic[ReturnType]):
@@ -184,6 +218,7 @@ class CapturedJit(Generic[ReturnType]):
     self._jit_cache: list[ExecItem] = self.jit_cache
     self._input_replace: dict[tuple[int, int], int] = self.input_replace
     self._first_run = True
+    self._plan: list[JitLaunch|ExecItem]|None = None
     # precompute read-after-write hazard detection
     self._output_to_writer = {b: j for j, ei in enumerate(self.jit_cache) for b in get_out_buffers_for_ei(ei)}
     self._input_to_max_reader: dict[int, int] = {}
@@ -210,6 +245,11 @@ class CapturedJit(Generic[ReturnType]):
       if old.is_allocated(): new.ensure_allocated().copyin(old.as_buffer())
     self.__post_init__()
 
+  def _launch_plan(self) -> list[JitLaunch|ExecItem]:
+    input_slots: dict[int, dict[int, int]] = {}
+    for (j,i),idx in self._input_replace.items(): input_slots.setdefault(j, {})[i] = idx
+    return [JitLaunch(ei, input_slots.get(j, {})) if type(ei.prg) is CompiledRunner else ei for j,ei in enumerate(self._jit_cache)]
+
   # jit exec
   def __call__(self, input_buffers:list[Buffer], var_vals:dict[str, int]) -> ReturnType:
     # assign inputs
@@ -242,7 +282,14 @@ class CapturedJit(Generic[ReturnType]):
       self._first_run = False
 
     if DEBUG >= 1 and len(self._jit_cache) >= 10: print(f"jit execs {len(self._jit_cache)} kernels")
-    for ei in self._jit_cache: ei.run(var_vals, jit=True)
+    # the first replay runs the ExecItems (local sizes are picked there) and builds the launch plan, DEBUG and PROFILE always use the ExecItems
+    if self._plan is None or DEBUG >= 2 or PROFILE:
+      for ei in self._jit_cache: ei.run(var_vals, jit=True)
+      if self._plan is None: self._plan = self._launch_plan()
+    else:
+      for l in self._plan:
+        if isinstance(l, JitLaunch): l(input_buffers, var_vals)
+        else: l.run(var_vals, jit=True)
     self._clear_inputs()
     return self.ret
 
@@ -266,14 +313,38 @@ def _prepare_jit_inputs(args, kwargs):
   expected_input_info = [(x[0], tuple(sorted(x[1].keys(), key=lambda v: v.expr)), x[2], x[3]) for x in inputs]
   return input_buffers, var_vals, names, expected_input_info
 
+def _pad_to_bucket(x, buckets:tuple[int, ...]):
+  # zero pad the first axis of a Tensor up to the smallest bucket that fits it
+  if x.__class__ is not Tensor or x.ndim == 0 or not isinstance(x.shape[0], int): return x
+  if (b:=next((b for b in buckets if b >= x.shape[0]), None)) is None or b == x.shape[0]: return x
+  return x.pad(((0, b-x.shape[0]),)+(None,)*(x.ndim-1)).contiguous()
+
+JitSignature = tuple[tuple[int|str, ...], tuple[tuple[UOp, tuple[Variable, ...], DType, str], ...]]
+
+@dataclass
+class JitSignatureStats:
+  hits: int = 0       # calls replayed from a CapturedJit
+  misses: int = 0     # calls that ran the function (warmup or capture)
+
 class TinyJit(Generic[ReturnType]):
-  def __init__(self, fxn:Callable[..., ReturnType]|None, captured:CapturedJit|None=None, prune=False, optimize=False):
+  def __init__(self, fxn:Callable[..., ReturnType]|None, captured:CapturedJit|None=None, prune=False, optimize=False,
+               max_captures:int=1, buckets:tuple[int, ...]|None=None):
     assert fxn or captured, "need either a function or a CapturedJit"
+    assert max_captures >= 1, "max_captures must be at least 1"
     self.fxn = fxn
     self.captured: CapturedJit|None = captured
     self.cnt: int = 2 if self.fxn is None else 0
     self.prune = prune
     self.optimize = optimize
+    # with max_captures > 1, a CapturedJit is kept per input signature (names, shapes, dtypes, devices) and evicted in LRU order
+    # buckets zero pads the first axis of Tensor args up to the smallest bucket that fits, so close shapes share a capture
+    self.max_captures, self.buckets = max_captures, tuple(sorted(buckets)) if buckets is not None else None
+    self._captures: collections.OrderedDict[JitSignature, tuple[int, CapturedJit|None]] = collections.OrderedDict()
+    # the stats of a signature are dropped with its capture, evictions counts the captures dropped
+    self.stats: dict[JitSignature, JitSignatureStats] = {}
+    self.evictions = 0
+    if captured is not None and max_captures > 1:
+      self._captures[(tuple(captured.expected_names), tuple(captured.expected_input_info))] = (self.cnt, captured)
 
   def add_buffer(self, b:Buffer) -> Buffer:
     if found:=self._buffer_replace.get(b, None): return found
@@ -291,6 +362,25 @@ class TinyJit(Generic[ReturnType]):
     assert self.fxn is not None, "can't reset without function"
     self.cnt = 0
     self.captured = None
+    self._captures.clear()
+    self.stats.clear()
+    self.evictions = 0
+
+  def _select_capture(self, sig:JitSignature):
+    # make the state for this signature the active one (cnt and captured)
+    if (state:=self._captures.get(sig)) is None:
+      if self.fxn is None: raise JitError(f"args mismatch in JIT: no capture for signature {sig}")
+      state = (0, None)
+    self.cnt, self.captured = state
+
+  def _store_capture(self, sig:JitSignature):
+    self._captures[sig] = (self.cnt, self.captured)
+    self._captures.move_to_end(sig)
+    while len(self._captures) > self.max_captures:
+      evicted, _ = self._captures.popitem(last=False)
+      self.stats.pop(evicted, None)
+      self.evictions += 1
+      if DEBUG >= 1: print(f"JIT evicted capture, {len(self._captures)} captures remaining")
 
   def __reduce__(self):
     assert self.captured is not None, "can't pickle an uncaptured JIT"
@@ -305,7 +395,14 @@ class TinyJit(Generic[ReturnType]):
   def __get__(self, obj, objtype): return functools.partial(self.__call__, obj) # add support for instance methods
 
   def __call__(self, *args, **kwargs) -> ReturnType:
+    if self.buckets is not None:
+      args, kwargs = tuple(_pad_to_bucket(x, self.buckets) for x in args), {k:_pad_to_bucket(v, self.buckets) for k,v in kwargs.items()}
     input_buffers, var_vals, names, expected_input_info = _prepare_jit_inputs(args, kwargs)
+    sig: JitSignature = (tuple(names), tuple(expected_input_info))
+    if self.max_captures > 1: self._select_capture(sig)
+    stats = self.stats.setdefault(sig, JitSignatureStats())
+    if JIT and self.cnt >= 2: stats.hits += 1
+    else: stats.misses += 1
     if not JIT or self.cnt == 0:
       # jit ignore
       assert self.fxn is not None
@@ -373,4 +470,114 @@ class TinyJit(Generic[ReturnType]):
       ret = self.captured(input_buffers, var_vals)
 
     self.cnt += 1
+    if self.max_captures > 1: self._store_capture(sig)
     return ret
+
+# **************** export ****************
+
+# file layout: header | buffer table | pickled CapturedJit | weights, page aligned so they can be mmapped
+# header is magic, version, len(buffer table), len(CapturedJit)
+JIT_EXPORT_MAGIC, JIT_EXPORT_VERSION, JIT_EXPORT_ALIGN = b"TINYJIT\x00", 1, 0x1000
+_header = struct.Struct("<8sIQQ")
+
+# (device, size, dtype, options, uop_refcount, base index, offset, (data offset, nbytes) or None)
+ExportedBuffer = tuple[str, int, DType, Any, int, int|None, int, tuple[int, int]|None]
+
+def _stores_whole(ast:UOp, i:int, size:int) -> bool:
+  # an ungated store at sum(range*stride), where the strides are the running products of the range sizes, writes every element of buffer i
+  for st in ast.toposort():
+    if st.op is not Ops.STORE or (idx:=st.src[0]).op is not Ops.INDEX or idx.src[0].op is not Ops.DEFINE_GLOBAL or idx.src[0].arg != i: continue
+    if len(idx.src) != 2: continue
+    terms = [(t.src[1], t.src[0]) if t.op is Ops.MUL else (t.const_like(1), t) for t in idx.src[1].split_uop(Ops.ADD)]
+    if len({r for _,r in terms}) != len(terms) or not all(s.op is Ops.CONST and r.op is Ops.RANGE and r.src[0].op is Ops.CONST for s,r in terms):
+      continue
+    covered = 1
+    for stride, r in sorted(terms, key=lambda x: x[0].arg):
+      if stride.arg != covered: break
+      covered *= r.src[0].arg
+    else:
+      if covered == size: return True
+  return False
+
+def _written_before_read(jit_cache:list[ExecItem]) -> set[Buffer]:
+  # base buffers whose contents are fully overwritten before anything reads them don't need to be saved
+  # a write to part of a buffer (a slice assign into a kv cache) keeps the rest, so the buffer is saved unless the whole of it is stored
+  seen: set[Buffer] = set()
+  ret: set[Buffer] = set()
+  for ei in jit_cache:
+    outs = get_out_buffers_for_ei(ei)
+    for i,b in enumerate(ei.bufs):
+      if b is None or b.base in seen: continue
+      seen.add(b.base)
+      if b in outs and b._base is None and (isinstance(ei.prg, (BufferCopy, BufferXfer, EncDec)) or _stores_whole(ei.ast, i, b.size)): ret.add(b)
+  return ret
+
+class _ExportPickler(pickle.Pickler):
+  def __init__(self, file, no_data:set[Buffer]):
+    super().__init__(file)
+    self.no_data, self.data_sz = no_data, 0
+    self.buffers: dict[Buffer, int] = {}
+    self.table: list[tuple] = []
+    self.weights: list[Buffer] = []
+  def buffer_index(self, b:Buffer) -> int:
+    if (idx:=self.buffers.get(b)) is not None: return idx
+    base = self.buffer_index(b._base) if b._base is not None else None
+    data: tuple[int, int]|None = None
+    if b._base is None and b.is_allocated() and b not in self.no_data:
+      data = (self.data_sz, b.nbytes)
+      self.weights.append(b)
+      self.data_sz = round_up(self.data_sz + b.nbytes, JIT_EXPORT_ALIGN)
+    self.buffers[b] = idx = len(self.table)
+    self.table.append((b.device, b.size, b.dtype, b.options, b._uop_refcount if b._base is None else 0, base, b.offset, data))
+    return idx
+  def persistent_id(self, obj):  # pylint: disable=method-hidden
+    if isinstance(obj, Buffer): return ("buffer", self.buffer_index(obj))
+    # returned Tensors get a fresh BUFFER UOp on load, unpickled UOps are deduped with the ones already in this process
+    if isinstance(obj, Tensor) and obj.uop.base.op is Ops.BUFFER and isinstance(b:=obj.uop.base.buffer, Buffer):
+      return ("tensor", obj.uop, self.buffer_index(b))
+    return None
+
+class _ExportUnpickler(pickle.Unpickler):
+  def __init__(self, file, bufs:list[Buffer]):
+    super().__init__(file)
+    self.bufs = bufs
+  def persistent_load(self, pid):  # pylint: disable=method-hidden
+    if pid[0] == "buffer": return self.bufs[pid[1]]
+    uop, buf = pid[1], self.bufs[pid[2]]
+    buffers[new_base:=UOp.new_buffer(buf.device, buf.size, buf.dtype)] = buf
+    return Tensor(uop.substitute({uop.base:new_base}))
+
+def export_jit(jit:TinyJit|CapturedJit, fn:str):
+  """Writes a captured JIT (compiled kernels, buffer layout, weights and input bindings) to a file that load_jit can replay without compiling."""
+  captured = jit.captured if isinstance(jit, TinyJit) else jit
+  if captured is None: raise JitError("can't export an uncaptured JIT")
+  pickler = _ExportPickler(jit_data:=io.BytesIO(), _written_before_read(captured.jit_cache))
+  pickler.dump(captured)
+  table = pickle.dumps(pickler.table)
+  data_start = round_up(_header.size + len(table) + len(jit_data.getvalue()), JIT_EXPORT_ALIGN)
+  with open(fn, "wb") as f:
+    f.write(_header.pack(JIT_EXPORT_MAGIC, JIT_EXPORT_VERSION, len(table), len(jit_data.getvalue())))
+    f.write(table)
+    f.write(jit_data.getvalue())
+    for b in pickler.weights:
+      f.seek(data_start + unwrap(pickler.table[pickler.buffers[b]][7])[0])
+      f.write(b.as_buffer())
+  if DEBUG >= 1: print(f"JIT exported {len(captured.jit_cache)} kernels and {pickler.data_sz/1e6:.2f} MB of weights to {fn}")
+
+def load_jit(fn:str) -> TinyJit:
+  """Loads a JIT written by export_jit. The kernels are already compiled, so the first call goes straight to graph replay."""
+  # NOTE: the mmap isn't closed here, copyin can still hold views of it. it's unmapped when collected
+  with open(fn, "rb") as f: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+  magic, version, table_sz, jit_sz = _header.unpack_from(mm)
+  if magic != JIT_EXPORT_MAGIC: raise JitError(f"{fn} is not an exported JIT")
+  if version != JIT_EXPORT_VERSION: raise JitError(f"{fn} has export version {version}, expected {JIT_EXPORT_VERSION}")
+  table: list[ExportedBuffer] = pickle.loads(mm[_header.size:_header.size+table_sz])
+  data_start = round_up(_header.size + table_sz + jit_sz, JIT_EXPORT_ALIGN)
+  bufs: list[Buffer] = []
+  for device, size, dtype, options, uop_refcount, base, offset, data in table:
+    b = Buffer(device, size, dtype, base=bufs[base], offset=offset) if base is not None else \
+        Buffer(device, size, dtype, options=options, uop_refcount=uop_refcount)
+    bufs.append(b)
+    if data is not None: b.ensure_allocated().copyin(memoryview(mm)[data_start+data[0]:data_start+data[0]+data[1]])
+  captured: CapturedJit = _ExportUnpickler(io.BytesIO(mm[_header.size+table_sz:_header.size+table_sz+jit_sz]), bufs).load()
+  return TinyJit(None, captured)
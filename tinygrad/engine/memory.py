@@ -1,5 +1,7 @@
-from typing import cast
+from __future__ import annotations
+from typing import cast, ClassVar
 from collections import defaultdict
+import contextlib
 from tinygrad.engine.realize import ExecItem
 from tinygrad.device import Device, Buffer
 from tinygrad.helpers import NO_MEMORY_PLANNER, dedup, DEBUG, round_up
@@ -9,7 +11,32 @@ from tinygrad.runtime.support.memory import TLSFAllocator
 
 # **************** memory planning ****************
 
-def _internal_memory_planner(buffers:list[list[Buffer]], noopt_buffers=None, ignore_checks=False, debug_prefix="") -> dict[Buffer, Buffer]:
+class MemoryPlanStep(contextlib.ContextDecorator):
+  """
+  Shares the memory planner's storage for intermediates between all the schedules made inside it, like the realizes of one training step.
+  The intermediates of a schedule are dead once it ran, so every schedule plans into the same per device buffer, grown to the largest one.
+  The schedules have to run in the order they are made, which is what realize does.
+  """
+  active: ClassVar[MemoryPlanStep|None] = None
+  def __enter__(self):
+    self.prev, MemoryPlanStep.active = MemoryPlanStep.active, self
+    self.buffers: dict[str, Buffer] = {}
+    self.planned, self.allocated, self.schedules = 0, 0, 0
+    return self
+  def __exit__(self, *args):
+    MemoryPlanStep.active = self.prev
+    if DEBUG >= 1 and self.planned != self.allocated:
+      print(f"step memory reduced from {self.planned/1e6:.2f} MB -> {self.allocated/1e6:.2f} MB, {self.schedules} schedules")
+    self.buffers.clear()
+  def buffer(self, device:str, size:int) -> Buffer:
+    self.planned += size
+    if (buf:=self.buffers.get(device)) is None or buf.size < size:
+      buf = self.buffers[device] = Buffer(device, size, dtypes.int8)
+      self.allocated += size
+    return buf
+
+def _internal_memory_planner(buffers:list[list[Buffer]], noopt_buffers=None, ignore_checks=False, debug_prefix="",
+                             step:MemoryPlanStep|None=None) -> dict[Buffer, Buffer]:
   if NO_MEMORY_PLANNER: return {}
   first_appearance, last_appearance, buf_to_opt = {}, {}, set()
   for i,u in enumerate(buffers):
@@ -42,7 +69,9 @@ def _internal_memory_planner(buffers:list[list[Buffer]], noopt_buffers=None, ign
       else: reuse_buffers[key].append(cast(Buffer, buffer_replace[buf][0]))
 
   # Allocate global buffers based on the memory planner.
-  global_buffers = {dev: Buffer(dev, round_up(sz, 0x1000), dtypes.int8) for dev, (sz, _) in global_planner.items()}
+  global_buffers = {dev: Buffer(dev, round_up(sz, 0x1000), dtypes.int8) if step is None else step.buffer(dev, round_up(sz, 0x1000))
+                    for dev, (sz, _) in global_planner.items()}
+  if step is not None and len(global_buffers): step.schedules += 1
   buffer_resolve:dict[Buffer, tuple[Buffer, int|None]] = {buf: (base or global_buffers[buf.device], off) for buf,(base,off) in buffer_replace.items()}
 
   # Assign buffers. First, assign full buffers (not sub-buffers).
@@ -56,15 +85,17 @@ def _internal_memory_planner(buffers:list[list[Buffer]], noopt_buffers=None, ign
     if buf._base is not None:
       assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=(pbuf:=assigned.get(buf.base, buf.base)).base, offset=pbuf.offset+buf.offset)
 
-  if DEBUG >= 1:
+  # a step reports its own total when it ends
+  if DEBUG >= 1 and step is None:
     ak, av = dedup(x for x in assigned.keys() if x._base is None),dedup(x for x in assigned.values() if x._base is None)+list(global_buffers.values())
     omem, nmem = sum([x.nbytes for x in ak])/1e6, sum([x.nbytes for x in av])/1e6
     if omem != nmem: print(f"{debug_prefix}memory reduced from {omem:.2f} MB -> {nmem:.2f} MB,", f"{len(ak)} -> {len(av)} bufs")
 
   return assigned
 
-def memory_planner(schedule:list[ExecItem]) -> list[ExecItem]:
+def memory_planner(schedule:list[ExecItem], step:MemoryPlanStep|None=None) -> list[ExecItem]:
   # Exclude buffers involved in load ops (e.g transfers) to preserve parallelism in graphs.
   assigned = _internal_memory_planner([[b for b in si.bufs if b is not None] for si in schedule],
-                                      noopt_buffers={b for si in schedule if si.ast.op is not Ops.SINK for b in si.bufs if b is not None})
+                                      noopt_buffers={b for si in schedule if si.ast.op is not Ops.SINK for b in si.bufs if b is not None},
+                                      step=step)
   return [ExecItem(si.ast, [assigned.get(x, x) if x is not None else None for x in si.bufs], si.metadata, si.fixedvars) for si in schedule]
@@ -1,12 +1,13 @@
-from typing import cast, Callable
-import time, pprint, random, itertools, math
+from typing import cast, Callable, Generator
+import time, pprint, random, itertools, math, multiprocessing, atexit, threading, queue
+from multiprocessing.pool import AsyncResult
 from dataclasses import dataclass, replace, field
 from tinygrad.helpers import all_same, colored, DEBUG, GlobalCounters, ansilen, BEAM, NOOPT, all_int, CAPTURING, Metadata, TRACEMETA, TracingKey
 from tinygrad.helpers import DEVECTORIZE, time_to_str, VALIDATE_WITH_CPU, cpu_profile, PROFILE, ProfilePointEvent, cpu_events, prod, Context, unwrap
-from tinygrad.helpers import EMULATED_DTYPES
+from tinygrad.helpers import EMULATED_DTYPES, LRUCache, METHOD_CACHE_SIZE, METHOD_CACHE_MB, PARALLEL_COMPILE, LOWER_AHEAD
 from tinygrad.uop.ops import Ops, PatternMatcher, UOp, UPat, sym_infer
-from tinygrad.device import Device, Buffer
-from tinygrad.renderer import ProgramSpec, Estimates
+from tinygrad.device import Device, Buffer, Compiler
+from tinygrad.renderer import Renderer, ProgramSpec, Estimates
 from tinygrad.codegen import get_program
 
 # **************** Runners ****************
@@ -107,17 +108,28 @@ class EncDec(Runner):
 
 # **************** method cache ****************
 
-method_cache: dict[tuple[str, type, bytes, tuple, bool], CompiledRunner] = {}
-def get_runner(device:str, ast:UOp) -> CompiledRunner:
+method_cache: LRUCache[tuple[str, type, bytes, tuple, bool], CompiledRunner] = \
+  LRUCache(METHOD_CACHE_SIZE, METHOD_CACHE_MB, sizeof=lambda r: len(r.p.lib or b""))
+MethodCacheKey = tuple[str, type, bytes, tuple, bool]
+def _method_cache_keys(device:str, ast:UOp) -> tuple[MethodCacheKey, MethodCacheKey]:
   # TODO: this should be all context relevant to rendering
   context = (BEAM.value, NOOPT.value, DEVECTORIZE.value, EMULATED_DTYPES.value)
-  ckey = (device, type(Device[device].compiler), ast.key, context, False)
+  key = (type(Device[device].compiler), ast.key, context)
+  return (device, *key, False), (device.split(":")[0], *key, True)
+
+def get_runner(device:str, ast:UOp) -> CompiledRunner:
+  ckey, bkey = _method_cache_keys(device, ast)
   if cret:=method_cache.get(ckey): return cret
-  bkey = (device.split(":")[0], type(Device[device].compiler), ast.key, context, True)
   if bret:=method_cache.get(bkey):
     method_cache[ckey] = ret = CompiledRunner(replace(bret.p, device=device))
   else:
-    prg: ProgramSpec = get_program(ast, Device[device].renderer)
+    prg: ProgramSpec|None = None
+    if (pending:=pending_programs.pop(bkey, None)) is not None:
+      # if the compile pool failed, compile here so the error is raised with the usual context
+      try: prg = pending.get()
+      except Exception as e:
+        if DEBUG >= 2: print(f"parallel compile failed, compiling {ast.arg.name if ast.arg is not None else ''} in process: {e}")
+    if prg is None: prg = get_program(ast, Device[device].renderer)
     method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, device=device))
   return ret
 
@@ -186,13 +198,78 @@ class ExecItem:
       self.prg.first_run = False
     return et
 
+# **************** parallel compile ****************
+
+compile_pool = None
+pending_programs: dict[MethodCacheKey, AsyncResult] = {}
+
+def _compile_program(ast:UOp, renderer:Renderer, compiler:Compiler, context:tuple) -> ProgramSpec:
+  with Context(BEAM=context[0], NOOPT=context[1], DEVECTORIZE=context[2], EMULATED_DTYPES=context[3]): p = get_program(ast, renderer)
+  return p if p.lib is not None else replace(p, lib=compiler.compile_cached(p.src))
+
+def precompile(schedule:list[ExecItem]):
+  """Start rendering and compiling the kernels of the schedule missing from the method cache in the compile pool, deduped by ast.key."""
+  global compile_pool
+  # BEAM search uses its own pool and needs the device
+  if BEAM: return
+  todo: dict[MethodCacheKey, tuple[UOp, str]] = {}
+  for ei in schedule:
+    if ei.prg is not None or ei.ast.op is not Ops.SINK or not len(ei.bufs) or ei.bufs[0] is None: continue
+    ckey, bkey = _method_cache_keys(device:=ei.bufs[0].device, ei.ast)
+    if ckey in method_cache or bkey in method_cache or bkey in pending_programs: continue
+    todo[bkey] = (ei.ast, device)
+  if len(todo) < 2: return
+  if compile_pool is None:
+    from tinygrad.codegen.opt.search import _init_worker
+    compile_pool = multiprocessing.get_context("spawn").Pool(PARALLEL_COMPILE.value, _init_worker)
+    atexit.register(compile_pool.close)
+  if DEBUG >= 2: print(f"compiling {len(todo)} kernels with {PARALLEL_COMPILE.value} processes")
+  for bkey, (ast, device) in todo.items():
+    pending_programs[bkey] = compile_pool.apply_async(_compile_program, (ast, Device[device].renderer, Device[device].compiler, bkey[3]))
+
 # **************** main run function ****************
 
 capturing: list = []  # put classes with an add method in here
 
-def run_schedule(schedule:list[ExecItem], var_vals:dict[str, int]|None=None, do_update_stats=True):
+def _needs_compile(ei:ExecItem) -> bool:
+  if ei.prg is not None or ei.ast.op not in (Ops.SINK, Ops.PROGRAM): return False
+  ckey, bkey = _method_cache_keys(unwrap(ei.bufs[0]).device, ei.ast)
+  return ckey not in method_cache and bkey not in method_cache
+
+def _lower_ahead(schedule:list[ExecItem], q:queue.Queue, stop:threading.Event):
+  try:
+    while len(schedule) and not stop.is_set() and not _needs_compile(schedule[0]): q.put(schedule.pop(0).lower())
+    q.put(None)
+  except Exception as e: q.put(e)
+
+def lower_schedule(schedule:list[ExecItem], lookahead:int=0) -> Generator[ExecItem, None, None]:
+  """Pop and lower the items of the schedule in order. With lookahead, up to that many items are lowered ahead on a background thread."""
+  if lookahead <= 0:
+    while len(schedule): yield schedule.pop(0).lower()
+    return
   while len(schedule):
-    ei = schedule.pop(0).lower()
+    # compiling changes the global Context, so kernels missing from the method cache are lowered on this thread with nothing running beside it
+    if _needs_compile(schedule[0]):
+      yield schedule.pop(0).lower()
+      continue
+    q: queue.Queue[ExecItem|Exception|None] = queue.Queue(lookahead)
+    stop = threading.Event()
+    (t:=threading.Thread(target=_lower_ahead, args=(schedule, q, stop), daemon=True)).start()
+    try:
+      # items are run in schedule order, so copies and transfers stay ordered with the kernels around them
+      while (ei:=q.get()) is not None:
+        if isinstance(ei, Exception): raise ei
+        yield ei
+    finally:
+      stop.set()
+      while t.is_alive():
+        try: q.get(timeout=0.01)
+        except queue.Empty: pass
+
+def run_schedule(schedule:list[ExecItem], var_vals:dict[str, int]|None=None, do_update_stats=True):
+  if PARALLEL_COMPILE: precompile(schedule)
+  # VALIDATE_WITH_CPU lowers on this thread too
+  for ei in lower_schedule(schedule, 0 if VALIDATE_WITH_CPU else LOWER_AHEAD.value):
     if len(capturing) and CAPTURING: capturing[0].add(ei)
     if VALIDATE_WITH_CPU and ei.ast.op is Ops.SINK:
       # copy in allocated buffers from the GPU
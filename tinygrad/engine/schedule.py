@@ -1,11 +1,12 @@
-import time
+import time, pickle, hashlib, functools, pathlib
 from typing import cast
 from collections import deque
 from tinygrad.uop.ops import UOp, Ops, buffers, UOpMetaClass, track_rewrites, PatternMatcher, UPat, graph_rewrite, graph_rewrite_map
 from tinygrad.uop.spec import type_verify, tensor_spec
 from tinygrad.device import Buffer, MultiBuffer
-from tinygrad.helpers import DEBUG, cpu_profile, TracingKey, SPEC, flatten, pluralize, SCACHE
-from tinygrad.engine.realize import ExecItem
+from tinygrad.helpers import DEBUG, cpu_profile, TracingKey, SPEC, flatten, pluralize, SCACHE, DISK_SCACHE, PCONTIG, SPLIT_REDUCEOP, RING, ALL2ALL
+from tinygrad.helpers import diskcache_get, diskcache_put, diskcache_prune, LRUCache, SCACHE_SIZE, getenv
+from tinygrad.engine.realize import ExecItem, capturing
 
 # **** schedule linearizer
 
@@ -89,7 +90,7 @@ def create_schedule(sched_sink:UOp) -> tuple[list[ExecItem], UOp]:
       sched_ptr += 1
   return pre_schedule, UOp.sink(*buf_uops_list)
 
-from tinygrad.engine.memory import memory_planner
+from tinygrad.engine.memory import memory_planner, MemoryPlanStep
 from tinygrad.schedule.rangeify import get_rangeify_map
 from tinygrad.schedule.multi import get_multi_map
 
@@ -132,7 +133,37 @@ pm_post_sched_cache = PatternMatcher([
   (UPat(Ops.BIND, src=(UPat(Ops.DEFINE_VAR),), name="b"), lambda ctx,b: ctx.get(b)),
 ])
 
-schedule_cache: dict[bytes, tuple[list[ExecItem], UOp]] = {}
+schedule_cache: LRUCache[bytes, tuple[list[ExecItem], UOp]] = LRUCache(SCACHE_SIZE)
+
+# **** on disk schedule cache
+
+@functools.cache
+def _schedule_source_hash() -> str:
+  # a stored schedule is only valid for the code that made it, editing the scheduler or the rewrites it runs drops the old entries
+  root = pathlib.Path(__file__).parent.parent
+  return hashlib.sha256(b"".join(f.read_bytes() for d in ("schedule", "uop") for f in sorted((root/d).glob("*.py")))+
+                        pathlib.Path(__file__).read_bytes()).hexdigest()
+
+def _disk_schedule_key(sched_cache_key:bytes) -> dict[str, str]:
+  # the context that changes what rangeify/multi produce for the same graph
+  knobs = [getenv(k, "") for k in ("REDUCEOP_SPLIT_THRESHOLD", "REDUCEOP_SPLIT_SIZE", "MAX_KERNEL_BUFFERS", "REDUCE_LEADERS",
+                                   "RING_ALLREDUCE_THRESHOLD")]
+  context = (PCONTIG.value, SPLIT_REDUCEOP.value, RING.value, ALL2ALL.value, *knobs, _schedule_source_hash())
+  return {"key": sched_cache_key.hex(), "context": str(context)}
+
+def disk_schedule_get(sched_cache_key:bytes) -> tuple[list[ExecItem], UOp]|None:
+  return diskcache_get("schedule", _disk_schedule_key(sched_cache_key))
+
+def disk_schedule_put(sched_cache_key:bytes, sc_ret:tuple[list[ExecItem], UOp]):
+  # CustomKernel functions can't be pickled
+  if any(u.op is Ops.CUSTOM_KERNEL for u in sc_ret[1].toposort()): return
+  try: val = pickle.dumps(sc_ret)
+  except RecursionError:
+    if DEBUG >= 2: print("schedule too deep to store in the disk cache")
+    return
+  diskcache_put("schedule", _disk_schedule_key(sched_cache_key), val, prepickled=True)
+  diskcache_prune("schedule", int(DISK_SCACHE.value*1e6))
+
 @track_rewrites(lambda _,ret: f"Schedule {pluralize('Kernel', len(ret[1]))}")
 def complete_create_schedule_with_vars(big_sink:UOp) -> tuple[dict[UOp, UOp], list[ExecItem], dict[str, int]]:
   # big_sink srcs are all the Tensors
@@ -144,7 +175,11 @@ def complete_create_schedule_with_vars(big_sink:UOp) -> tuple[dict[UOp, UOp], li
   big_sink_cache = graph_rewrite(big_sink, pm_pre_sched_cache, ctx=(input_buffers, var_vals), name="rewrite for sched cache")
   sched_cache_key = big_sink_cache.key
 
-  if not SCACHE or (sc_ret:=schedule_cache.get(sched_cache_key, None)) is None:
+  sc_ret = schedule_cache.get(sched_cache_key, None) if SCACHE else None
+  if sc_ret is None and SCACHE and DISK_SCACHE and (sc_ret:=disk_schedule_get(sched_cache_key)) is not None:
+    schedule_cache[sched_cache_key] = sc_ret
+
+  if sc_ret is None:
     # verify Tensors match the spec (on big_sink, we only need to do this if cache misses)
     if SPEC: type_verify(big_sink, tensor_spec)
 
@@ -169,6 +204,7 @@ def complete_create_schedule_with_vars(big_sink:UOp) -> tuple[dict[UOp, UOp], li
     tensor_map_sink = UOp.sink(*flatten([(k,v) for k,v in tensor_map.items()]), *flatten(after_map))
     combined_sink = UOp.sink(tensor_map_sink, buf_uops_sink)
     if SCACHE: schedule_cache[sched_cache_key] = (pre_schedule, combined_sink)
+    if SCACHE and DISK_SCACHE: disk_schedule_put(sched_cache_key, (pre_schedule, combined_sink))
   else:
     # schedule cache hit
     del big_sink_cache
@@ -199,7 +235,9 @@ def complete_create_schedule_with_vars(big_sink:UOp) -> tuple[dict[UOp, UOp], li
     else:
       # ONE -> ONE
       schedule.append(ExecItem(si.ast, list(ubufs), si.metadata, si.fixedvars))
-  with cpu_profile(TracingKey("memory planner")): schedule = memory_planner(schedule)
+  # a MemoryPlanStep plans the schedule once its map is applied to the tensors, the uops here still hold every buffer
+  if MemoryPlanStep.active is None or len(capturing):
+    with cpu_profile(TracingKey("memory planner")): schedule = memory_planner(schedule)
 
   if (DEBUG >= 1 and len(schedule) > 1) or DEBUG >= 3:
     print(f"scheduled {len(schedule):4d} kernels in {(time.perf_counter()-st)*1000:8.2f} ms"+\
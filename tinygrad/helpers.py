@@ -1,6 +1,6 @@
 from __future__ import annotations
 import os, functools, platform, time, re, contextlib, operator, hashlib, pickle, sqlite3, tempfile, pathlib, string, ctypes, sys, gzip, getpass, gc
-import subprocess, shutil, math, types, copyreg, inspect, importlib, decimal, itertools
+import subprocess, shutil, math, types, copyreg, inspect, importlib, decimal, itertools, collections, threading
 from dataclasses import dataclass, field
 from typing import ClassVar, Iterable, Any, TypeVar, Callable, Sequence, TypeGuard, Iterator, Generic, Generator, cast, overload
 
@@ -204,6 +204,21 @@ CCACHE = ContextVar("CCACHE", 1)
 ALLOW_TF32 = ContextVar("ALLOW_TF32", 0)
 # set to 0 to disable the scheduler cache
 SCACHE = ContextVar("SCACHE", 1)
+# set to a size in MB to also persist the scheduler cache to the disk cache
+DISK_SCACHE = ContextVar("DISK_SCACHE", 0)
+# number of processes used to compile the kernels of a schedule ahead of running it, 0 compiles each kernel when it's lowered
+PARALLEL_COMPILE = ContextVar("PARALLEL_COMPILE", 0)
+# number of schedule items lowered ahead on a background thread while the current one runs, 0 lowers each item right before it runs
+LOWER_AHEAD = ContextVar("LOWER_AHEAD", 0)
+# round cached device allocations up to LRU_SIZE_CLASS classes per power of two (1 is power of two), and keep at most LRU_MB MB of freed buffers
+LRU_SIZE_CLASS, LRU_MB = ContextVar("LRU_SIZE_CLASS", 0), ContextVar("LRU_MB", 0)
+# lower scatter and scatter_reduce with at least SCATTER_NATIVE lines along dim to a kernel that stores along the index instead of a one-hot
+# masked reduce, 0 never does. each line is walked by one thread, so a GPU wants enough lines to fill it (~1024)
+SCATTER_NATIVE = ContextVar("SCATTER_NATIVE", 0)
+# carve eager allocations of devices that support it out of ARENA MB slabs instead of allocating each buffer from the device
+ARENA = ContextVar("ARENA", 0)
+# bound the in process caches, 0 is unbounded. SCACHE_SIZE and METHOD_CACHE_SIZE are entries, METHOD_CACHE_MB is compiled program bytes
+SCACHE_SIZE, METHOD_CACHE_SIZE, METHOD_CACHE_MB = ContextVar("SCACHE_SIZE", 0), ContextVar("METHOD_CACHE_SIZE", 0), ContextVar("METHOD_CACHE_MB", 0)
 
 @dataclass(frozen=True)
 class Metadata:
@@ -224,6 +239,53 @@ class GlobalCounters:
   @staticmethod
   def reset(): GlobalCounters.global_ops, GlobalCounters.global_mem, GlobalCounters.time_sum_s, GlobalCounters.kernel_count = 0,0,0.0,0
 
+# **************** bounded caches ****************
+
+@dataclass
+class CacheStats:
+  hits: int
+  misses: int
+  evictions: int
+  entries: int
+  nbytes: int
+
+class LRUCache(collections.OrderedDict[T, U]):
+  """
+  A dict that evicts the least recently used entries once it holds more than `max_entries` or `max_bytes` (0 means unbounded).
+  A value stored under several keys is counted in the bytes once, until its last key is gone.
+  """
+  def __init__(self, max_entries:ContextVar[int], max_mb:ContextVar[int]|None=None, sizeof:Callable[[U], int]=lambda _: 0):
+    super().__init__()
+    self.max_entries, self.max_mb, self.sizeof = max_entries, max_mb, sizeof
+    self.hits, self.misses, self.evictions, self.nbytes = 0, 0, 0, 0
+    self.keys_of: dict[int, int] = {}
+  def _hold(self, val:U):
+    if (n:=self.keys_of.get(id(val), 0)) == 0: self.nbytes += self.sizeof(val)
+    self.keys_of[id(val)] = n+1
+  def _release(self, val:U):
+    if (n:=self.keys_of.pop(id(val))) > 1: self.keys_of[id(val)] = n-1
+    else: self.nbytes -= self.sizeof(val)
+  def get(self, key:T, default:Any=None) -> Any:  # type: ignore[override]
+    if (ret:=super().get(key)) is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self.move_to_end(key)
+    return ret
+  def __setitem__(self, key:T, val:U):
+    if key in self: self._release(self.pop(key))
+    super().__setitem__(key, val)
+    self._hold(val)
+    max_bytes = int(self.max_mb.value*1e6) if self.max_mb is not None else 0
+    while len(self) > 1 and ((self.max_entries.value and len(self) > self.max_entries.value) or (max_bytes and self.nbytes > max_bytes)):
+      self._release(self.popitem(last=False)[1])
+      self.evictions += 1
+  def clear(self):
+    super().clear()
+    self.keys_of.clear()
+    self.nbytes = 0
+  def stats(self) -> CacheStats: return CacheStats(self.hits, self.misses, self.evictions, len(self), self.nbytes)
+
 # **************** timer and profiler ****************
 
 class Timing(contextlib.ContextDecorator):
@@ -317,17 +379,17 @@ cache_dir: str = os.path.join(getenv("XDG_CACHE_HOME", os.path.expanduser("~/Lib
 CACHEDB: str = getenv("CACHEDB", os.path.abspath(os.path.join(cache_dir, "cache.db")))
 
 VERSION = 22
-_db_connection = None
+# sqlite connections can't be shared between threads, each thread that uses the cache gets its own
+_db_connections = threading.local()
 def db_connection():
-  global _db_connection
-  if _db_connection is None:
+  if (conn:=getattr(_db_connections, "conn", None)) is None:
     os.makedirs(CACHEDB.rsplit(os.sep, 1)[0], exist_ok=True)
-    _db_connection = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    conn = _db_connections.conn = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
     # another connection has set it already or is in the process of setting it
     # that connection will lock the database
-    with contextlib.suppress(sqlite3.OperationalError): _db_connection.execute("PRAGMA journal_mode=WAL").fetchone()
-    if DEBUG >= 8: _db_connection.set_trace_callback(print)
-  return _db_connection
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    if DEBUG >= 8: conn.set_trace_callback(print)
+  return conn
 
 def diskcache_clear():
   cur = db_connection().cursor()
@@ -362,6 +424,18 @@ def diskcache_put(table:str, key:dict|str|int, val:Any, prepickled=False):
   cur.close()
   return val
 
+def diskcache_prune(table:str, max_bytes:int):
+  # drop the oldest entries of a table until the stored values fit in max_bytes
+  conn = db_connection()
+  try: rows = conn.execute(f"SELECT rowid, length(val) FROM '{table}_{VERSION}' ORDER BY rowid DESC").fetchall()
+  except sqlite3.OperationalError: return  # table doesn't exist
+  total = 0
+  for rowid, sz in rows:
+    if (total:=total+sz) > max_bytes:
+      conn.execute(f"DELETE FROM '{table}_{VERSION}' WHERE rowid <= ?", (rowid,))
+      conn.commit()
+      return
+
 def diskcache(func:Callable[..., T]):
   def wrapper(*args, **kwargs) -> T:
     table, key = f"cache_{func.__name__}", hashlib.sha256(pickle.dumps((args, kwargs))).hexdigest()
@@ -35,9 +35,38 @@ def fix_assign_hazard(dest:UOp, src:UOp, assign:UOp):
     if any(s is dest.base for s in h.toposort(gate=lambda s:s.op not in ALWAYS_CONTIGUOUS-{Ops.BUFFER})):
       return assign.replace(src=(dest, src.contiguous()))
 
+def used_axes(x:UOp, rngs:list[UOp]) -> set[int]:
+  # the axes of x that index its base, x is expanded along the others
+  return {r.arg[0] for r in x.index(*rngs).substitute({x.base:UOp(Ops.NOOP)}, extra_pm=pm_mops).ranges}
+
+def _uncast(u:UOp) -> UOp: return _uncast(u.src[0]) if u.op is Ops.CAST else u
+def _const(u:UOp) -> UOp: return _const(u.src[0]) if u.op is Ops.CAST or u.op in GroupOp.Movement else u
+
+def one_hot_mask(m:UOp, axes:tuple[int, ...], rngs:list[UOp]) -> bool|None:
+  # True for (idx == arange) where idx is broadcast along axes, False for (idx != arange), None for anything else. the arange side can't load,
+  # the idx side can be any tensor. == is != with True, so every compare with True flips it
+  if (m:=_uncast(m)).op is not Ops.CMPNE: return None
+  for a,b in (m.src, m.src[::-1]):
+    if (c:=_const(a)).op is Ops.CONST and c.arg is True: return None if (r:=one_hot_mask(b, axes, rngs)) is None else not r
+  idx, ar = [_uncast(s) for s in m.src]
+  for idx, ar in ((idx, ar), (ar, idx)):
+    if not used_axes(idx, rngs) & set(axes) and set(axes) <= used_axes(ar, rngs) and not ar.op_in_backward_slice_with_self(Ops.BUFFER): return False
+  return None
+
+def is_one_hot_select(x:UOp, axes:tuple[int, ...], rngs:list[UOp]) -> bool:
+  # x picks one element along axes with (idx == arange).where(v, 0) or v * (idx == arange), like gather and embedding. codegen collapses the
+  # reduce of it into a load at idx, so it's one kernel with no reduce loop. any other use of the compare is a real reduce
+  def is_zero(u:UOp) -> bool: return (c:=_const(u)).op is Ops.CONST and c.arg == 0
+  if (x:=_uncast(x)).op is Ops.WHERE:
+    return (m:=one_hot_mask(x.src[0], axes, rngs)) is not None and is_zero(x.src[2] if m else x.src[1])
+  return x.op is Ops.MUL and any(one_hot_mask(s, axes, rngs) is True for s in x.src)
+
 def split_reduceop(reduce:UOp, x:UOp):
   if prod(reduce.shape) == 0: return None
   if not SPLIT_REDUCEOP or not all_int(x.shape) or (prod(x.shape)//prod(reduce.shape))<getenv("REDUCEOP_SPLIT_THRESHOLD", 32768): return None
+  # indexing by a tensor isn't a reduce once it's a load, splitting it would loop over the partials
+  rngs = [UOp.range(s, i) if resolve(s>1) else UOp.const(dtypes.index, 0) for i,s in enumerate(x.shape)]
+  if reduce.arg[0] is Ops.ADD and is_one_hot_select(x, reduce.arg[1], rngs): return None
   # if there are few globals, make some reduces into globals by splitting into two kernels
   # cap output buffer to 2**22: heuristic number of global outputs to achieve max occupancy with enough locals+upcasts for gemm
   #   ~2**10 should be enough if GROUP is used
@@ -66,7 +95,9 @@ mop_cleanup = PatternMatcher([
 
 def resolve_custom_kernel(ck:UOp) -> UOp:
   placeholders = [UOp.placeholder_like(s, slot=i) for i,s in enumerate(ck.src)]
-  return UOp(Ops.KERNEL, src=ck.src, arg=Kernel(ck.arg.fxn(*placeholders)))
+  # a realized input is passed as its BUFFER, the RESHAPE on it is shared with the other consumers and is rangeified with them
+  srcs = tuple(s.base if s.op is Ops.RESHAPE and s.base.op is Ops.BUFFER else s for s in ck.src)
+  return UOp(Ops.KERNEL, src=srcs, arg=Kernel(ck.arg.fxn(*placeholders)))
 
 earliest_rewrites = mop_cleanup+PatternMatcher([
   # just removing it works...
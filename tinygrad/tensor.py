@@ -5,17 +5,19 @@ from contextlib import ContextDecorator
 from typing import Any, Callable, ClassVar, Sequence, cast, get_args, Literal, SupportsIndex, ParamSpec, TypeVar, Generic, TYPE_CHECKING
 if TYPE_CHECKING: import numpy
 from tinygrad.dtype import DType, DTypeLike, dtypes, ImageDType, ConstType, least_upper_float, least_upper_dtype, sum_acc_dtype, to_dtype, truncate
-from tinygrad.dtype import _from_np_dtype, _to_np_dtype, PyConst
+from tinygrad.dtype import _from_np_dtype, _to_np_dtype, PyConst, AddrSpace
 from tinygrad.helpers import argfix, make_tuple, flatten, prod, all_int, round_up, merge_dicts, argsort, getenv, all_same, fully_flatten
 from tinygrad.helpers import IMAGE, WINO, Metadata, TRACEMETA, ceildiv, fetch, polyN, is_numpy_ndarray, TracingKey, cpu_profile
-from tinygrad.helpers import suppress_finalizing, disable_gc
+from tinygrad.helpers import suppress_finalizing, disable_gc, strides_for_shape, SCATTER_NATIVE
 from tinygrad.gradient import compute_gradient
 from tinygrad.mixin import OpMixin
 from tinygrad.mixin.movement import _align_left
 from tinygrad.uop.ops import smax, smin, resolve, UOp, Ops, sint, identity_element, all_metadata, _index_to_concrete_int, sint_to_uop, Variable
+from tinygrad.uop.ops import KernelInfo, AxisType, CustomKernel
 from tinygrad.engine.schedule import ExecItem, complete_create_schedule_with_vars
 from tinygrad.device import Device, Buffer
-from tinygrad.engine.realize import run_schedule
+from tinygrad.engine.realize import run_schedule, capturing
+from tinygrad.engine.memory import memory_planner, MemoryPlanStep
 
 # TODO: this should be the only usage of Device
 def canonicalize_device(device:str|tuple|list|None) -> str|tuple[str, ...]:
@@ -93,6 +95,52 @@ def _masked_setitem(target:Tensor, values:Tensor, mask:Tensor, axes:tuple[int, .
   # select from values for each True element in mask else select from target
   return mask.where(values, target)
 
+def _copy_kernel(out:UOp, x:UOp) -> UOp:
+  i = UOp.range(x.size, 0)
+  return out[i].store(x.flatten()[i]).end(i).sink(arg=KernelInfo(name=f"copy_{x.size}"))
+
+def _scatter_kernel(out:UOp, x:UOp, index:UOp, src:UOp, dim:int, reduce:str|None, include_self:bool) -> UOp:
+  # out starts as a copy of x, one thread per line of x along dim stores index and src of that line in order so repeated indices need no atomics
+  xs, ids = x.shape, index.shape
+  outer = [UOp.range(s, i) for i,s in enumerate(xs) if i != dim]
+  def at(shape:tuple[sint, ...], i:UOp) -> UOp:
+    return functools.reduce(UOp.__add__, [c*st for c,st in zip(outer[:dim]+[i]+outer[dim:], strides_for_shape(shape))])
+  in_index = functools.reduce(UOp.__and__, [r < s for r,s in zip(outer, ids[:dim]+ids[dim+1:])], UOp.const(dtypes.bool, True))
+  def target(n:UOp) -> UOp:
+    i = index[at(ids, n).valid(in_index)].cast(dtypes.index)
+    # out of bounds indices are skipped like the one-hot mask does
+    return at(xs, i).valid(in_index & (i >= 0) & (i < xs[dim]))
+  out, x, index, src = out.flatten(), x.flatten(), index.flatten(), src.flatten()
+  if not include_self:
+    n = UOp.range(ids[dim], len(outer)+1, axis_type=AxisType.REDUCE)
+    ident = {"sum": 0, "prod": 1, "amax": dtypes.min(x.dtype.base), "amin": dtypes.max(x.dtype.base)}[cast(str, reduce)]
+    out = out[target(n)].set(ident, end=n)
+  n = UOp.range(ids[dim], len(outer)+2, axis_type=AxisType.REDUCE)
+  val = src[at(ids, n).valid(in_index)]
+  if reduce is not None:
+    val = {"sum": UOp.__add__, "prod": UOp.__mul__, "amax": UOp.maximum, "amin": UOp.minimum}[reduce](out.after(n)[target(n)], val)
+  out = out[target(n)].set(val, end=n)
+  return out.end(*outer).sink(arg=KernelInfo(name=f"scatter_{reduce or 'store'}_{'_'.join(map(str, xs))}", opts_to_apply=()))
+
+def _scatter_backward(gradient:UOp, kernel:UOp, dim:int, reduce:str|None, include_self:bool) -> tuple[UOp|None, ...]:
+  _, x, index, src = kernel.src
+  gradient = gradient.reshape(x.shape)
+  if reduce == "sum" and include_self: return (None, gradient, None, Tensor(gradient).gather(dim, Tensor(index)).uop)
+  # the other reduces take the gradient of the one-hot scatter
+  grads = compute_gradient(Tensor(x)._one_hot_scatter(dim, Tensor(index), Tensor(src), reduce, include_self).uop, gradient, {x, src})
+  return (None, grads.get(x), None, grads.get(src))
+
+def _topk_kernel(out:UOp, flag:UOp, k:int) -> UOp:
+  # one thread per line stores the indices of the keys above the k-th in order, then the indices of the ties until the k slots are filled
+  line, cnt = UOp.range(flag.shape[0], 0), UOp.placeholder((1,), dtypes.int32, 0, addrspace=AddrSpace.REG)
+  cnt = cnt.after(line)[0].set(0)
+  for axis,want in ((1, 2), (2, 1)):
+    j = UOp.range(flag.shape[1], axis, axis_type=AxisType.REDUCE)
+    c, sel = cnt.after(j)[0], flag[line, j].eq(want)
+    store = out[(line*k + c.cast(dtypes.index)).valid(sel & (c < k))].store(j.cast(out.dtype.base))
+    cnt = cnt.after(UOp.group(store, cnt[0].store(c + sel.cast(dtypes.int32))).end(j))
+  return cnt.end(line).sink(arg=KernelInfo(name=f"topk_{k}_{flag.shape[1]}", opts_to_apply=()))
+
 #  `(padding_left, padding_right, padding_top, padding_bottom, ...)` ->  `(..., (padding_top, padding_bottom), (padding_left, padding_right))`
 def _flat_to_grouped(padding:Sequence[sint]) -> tuple[tuple[sint, sint], ...]: return tuple(zip(padding[-2::-2], padding[::-2]))
 
@@ -251,6 +299,11 @@ class Tensor(OpMixin):
     # this is where the schedule cache should go
     becomes_map, schedule, var_vals = complete_create_schedule_with_vars(big_sink)
     _apply_map_to_tensors(becomes_map, name="Apply Schedule Map")
+    # now only the schedule references its intermediates, so a step can plan them into the buffers it shares between schedules.
+    # this is the only planning of the schedule, complete_create_schedule_with_vars leaves it to the step
+    if MemoryPlanStep.active is not None and not len(capturing):
+      del big_sink, becomes_map
+      schedule = memory_planner(schedule, MemoryPlanStep.active)
     return schedule, var_vals
 
   def schedule(self, *lst:Tensor) -> list[ExecItem]:
@@ -2607,20 +2660,42 @@ class Tensor(OpMixin):
         x = x.gather(i, index)
     return x.cast(self.dtype)
 
-  def _pre_scatter(self, dim:int, index:Tensor, src:Tensor) -> tuple[Tensor, Tensor]:
+  def _pre_scatter(self, dim:int, index:Tensor, src:Tensor) -> tuple[int, Tensor, Tensor]:
     index, dim = index.to(self.device), self._resolve_dim(dim)
     assert index.ndim == self.ndim == src.ndim, f"self.ndim, index.ndim and src.ndim must all equal, {self.ndim=} {index.ndim=} {src.ndim=}"
     assert all((d == dim or self_ >= index_) and src_ >= index_ for d,(self_,index_,src_) in enumerate(zip(self.shape, index.shape, src.shape))), \
       f"All dimensions of {index.shape=} should be <= to all dimensions of {src.shape=} and all dimensions except dimension {dim} of {self.shape=}"
     if self.dtype != src.dtype: raise RuntimeError(f"expect {self.dtype=} to be equal to {src.dtype=}")
     # shrink src to index shape to shrink away the unused values
-    src = src.shrink(tuple((0,s) for s in index.shape))
+    return dim, index, src.shrink(tuple((0,s) for s in index.shape))
+
+  def _one_hot_scatter(self, dim:int, index:Tensor, src:Tensor, reduce:str|None, include_self:bool) -> Tensor:
     # prepare src and mask for reduce with respect to dim
     src = src.unsqueeze(-1).expand(*src.shape, self.shape[dim]).transpose(-1, dim)
     mask = index.unsqueeze(-1)._one_hot_along_dim(self.shape[dim]).transpose(-1, dim)
     # pad src and mask to self.shape so that reduce can be done with padded values as no-ops
     src, mask = (x.pad(tuple((0, self.shape[i] - x.shape[i]) if i != dim else None for i in range(self.ndim)) + (None,)) for x in (src, mask))
-    return src, mask
+    if reduce is None: return _masked_setitem(self, src, mask, (-1,))
+    def _inv_mask(a:Tensor|PyConst, b:Tensor|PyConst) -> Tensor: return mask.any(-1).logical_not().where(a, b)
+    if reduce == "sum": return mask.where(src, 0).sum(-1).add(self if include_self else _inv_mask(self, 0))
+    if reduce == "prod": return mask.where(src, 1).prod(-1).mul(self if include_self else _inv_mask(self, 1))
+    if reduce == "amax": return mask.where(src, m := dtypes.min(src.dtype)).max(-1).maximum(self if include_self else _inv_mask(self, m))
+    return mask.where(src, m := dtypes.max(src.dtype)).min(-1).minimum(self if include_self else _inv_mask(self, m))
+
+  def _scatter(self, dim:int, index:Tensor, src:Tensor, reduce:str|None, include_self:bool=True) -> Tensor:
+    dim, index, src = self._pre_scatter(dim, index, src)
+    # the one-hot mask is self.shape[dim] times the size of index, the native kernel reads and writes every element once
+    if not SCATTER_NATIVE or not isinstance(self.device, str) or not all_int(self.shape+index.shape) or index.numel() == 0 or \
+       self.numel() // self.shape[dim] < SCATTER_NATIVE.value or (reduce is not None and self.dtype == dtypes.bool):
+      return self._one_hot_scatter(dim, index, src, reduce, include_self)
+    # the output buffer is flat so the output doesn't start with a movement op, it's reshaped after the kernel. x is copied into it in
+    # parallel first so only the walk along the index is one thread per line, the gradient of x is the one of the scatter kernel
+    out = Tensor.empty(self.numel(), dtype=self.dtype, device=self.device).custom_kernel(self, fxn=_copy_kernel, grad_fxn=lambda *_: (None, None))[0]
+    # the copy is only seen by the scatter kernel, so it writes that buffer in place instead of custom_kernel realizing it to a new one
+    kernel = UOp(Ops.CUSTOM_KERNEL, src=(out.uop, *[t.uop.contiguous() for t in (self, index, src)]),
+                 arg=CustomKernel(fxn=functools.partial(_scatter_kernel, dim=dim, reduce=reduce, include_self=include_self),
+                                  grad_fxn=functools.partial(_scatter_backward, dim=dim, reduce=reduce, include_self=include_self)))
+    return Tensor(out.uop.after(kernel), device=self.device).reshape(self.shape)
 
   def scatter(self, dim:int, index:Tensor, src:Tensor|PyConst, reduce:Literal['multiply', 'add']|None=None) -> Tensor:
     """
@@ -2653,8 +2728,7 @@ class Tensor(OpMixin):
     if not isinstance(src, Tensor): src = index.full_like(src, device=self.device, dtype=self.dtype)
     if reduce == "add": return self.scatter_reduce(dim, index, src, "sum", include_self=True)
     if reduce == "multiply": return self.scatter_reduce(dim, index, src, "prod", include_self=True)
-    src, mask = self._pre_scatter(dim, index, src)
-    return _masked_setitem(self, src, mask, (-1,))
+    return self._scatter(dim, index, src, None)
 
   def scatter_reduce(self, dim:int, index:Tensor, src:Tensor, reduce:Literal["sum", "prod", "mean", "amax", "amin"],
                      include_self:bool=True) -> Tensor:
@@ -2686,16 +2760,11 @@ class Tensor(OpMixin):
     print(Tensor([[-10, 20, 0, 5, 10]], dtype=src.dtype).scatter_reduce(0, index, src, reduce='amin').numpy())
     ```
     """
-    src, mask = self._pre_scatter(dim, index, src)
-    def _inv_mask(a:Tensor|PyConst, b:Tensor|PyConst) -> Tensor: return mask.any(-1).logical_not().where(a, b)
-    if reduce == "sum": return mask.where(src, 0).sum(-1).add(self if include_self else _inv_mask(self, 0))
-    if reduce == "prod": return mask.where(src, 1).prod(-1).mul(self if include_self else _inv_mask(self, 1))
-    if reduce == "amax": return mask.where(src, m := dtypes.min(src.dtype)).max(-1).maximum(self if include_self else _inv_mask(self, m))
-    if reduce == "amin": return mask.where(src, m := dtypes.max(src.dtype)).min(-1).minimum(self if include_self else _inv_mask(self, m))
+    if reduce not in {"sum", "prod", "mean", "amax", "amin"}: raise RuntimeError(f"{reduce=} must be one of 'sum', 'prod', 'mean', 'amax', 'amin'")
     if reduce == "mean":
-      count = mask.where(1, 0).sum(-1).add(1 if include_self else _inv_mask(1, 0))
-      return mask.where(src, 0).sum(-1).add(self if include_self else _inv_mask(self, 0)).div(count)
-    raise RuntimeError(f"{reduce=} must be one of 'sum', 'prod', 'mean', 'amax', 'amin'")
+      count = self.zeros_like(dtype=dtypes.int32)._scatter(dim, index, src.ones_like(dtype=dtypes.int32), "sum")
+      return self._scatter(dim, index, src, "sum", include_self).div(count.add(1 if include_self else count.eq(0)))
+    return self._scatter(dim, index, src, reduce, include_self)
 
   def sort(self, dim:int=-1, descending:bool=False) -> tuple[Tensor, Tensor]:
     """
@@ -2717,36 +2786,35 @@ class Tensor(OpMixin):
     """
     x, dim = self, self._resolve_dim(dim)
     if (orig_len:= x.shape[dim]) <= 1: return x, x.zeros_like(dtype=dtypes.default_int)
-    # pad to power of 2
+    # pad to power of 2, the padded indices are past orig_len so they sort after the padded values of the input
     n_stages = (orig_len-1).bit_length()
     pads = tuple((0, 2**n_stages - orig_len) if i == dim else None for i in range(x.ndim))
     x = x.pad(pads, value=dtypes.min(x.dtype) if descending else dtypes.max(x.dtype)).unflatten(dim, (2,)*n_stages)
+    # the indices are carried through the network with the values
+    idx = Tensor.arange(2**n_stages, device=self.device).reshape(tuple(2**n_stages if i == dim else 1 for i in range(self.ndim)))
+    idx = idx.expand(tuple(2**n_stages if i == dim else s for i,s in enumerate(self.shape))).unflatten(dim, (2,)*n_stages)
     # https://en.wikipedia.org/wiki/Bitonic_sorter#/media/File:BitonicSort1.svg
     for stage in range(1, n_stages+1):
       if stage != n_stages:
         # flip so arrows of green boxes point the same way as blue boxes
         crossover_dim = dim + n_stages - stage - 1
-        blue_box, green_box = x.split(1, crossover_dim)
         flip_dims = tuple(-i for i in range(1, stage+1+(self.ndim-dim)))
-        x = (blue_box.cat(green_box.flip(flip_dims), dim=crossover_dim)).contiguous()
+        def crossover(t:Tensor) -> Tensor:
+          blue_box, green_box = t.split(1, crossover_dim)
+          return blue_box.cat(green_box.flip(flip_dims), dim=crossover_dim)
+        x, idx = crossover(x).contiguous(), crossover(idx).contiguous()
       for substage in range(stage-1, -1, -1):
         partner_dim = dim + n_stages - substage - 1
-        x_top, x_bottom = x.split(1, partner_dim)
-        x_larger, x_smaller = x_top.maximum(x_bottom), x_top.minimum(x_bottom)
-        x = (x_larger.cat(x_smaller, dim=partner_dim) if descending else x_smaller.cat(x_larger, dim=partner_dim)).contiguous()
+        (x_top, x_bottom), (idx_top, idx_bottom) = x.split(1, partner_dim), idx.split(1, partner_dim)
+        # ties are ordered by index, this keeps the sort stable
+        swap = ((x_bottom > x_top) if descending else (x_bottom < x_top)) | ((x_bottom == x_top) & (idx_bottom < idx_top))
+        x = swap.where(x_bottom, x_top).cat(swap.where(x_top, x_bottom), dim=partner_dim).contiguous()
+        idx = swap.where(idx_bottom, idx_top).cat(swap.where(idx_top, idx_bottom), dim=partner_dim).contiguous()
       if stage != n_stages:
         # flip wires back to undo the crossover
-        blue_box, flipped_green_box = x.split(1, crossover_dim)
-        x = blue_box.cat(flipped_green_box.flip(flip_dims), dim=crossover_dim)
-    x = x.flatten(dim, dim+n_stages-1).shrink(tuple((0, s) for s in self.shape))
-    # compute indices for sorted values
-    mask = Tensor.ones(orig_len, orig_len, dtype=dtypes.bool, device=self.device).tril().reshape((None, None) + (1,)*(self.ndim-dim-1))
-    def compute_counts(t:Tensor): return (mask & (t.unsqueeze(dim) == t.unsqueeze(dim+1))).sum(dim+1)
-    count_orig, count_sorted = compute_counts(self), compute_counts(x)
-    cond = (self.unsqueeze(dim+1) == x.unsqueeze(dim)) & (count_orig.unsqueeze(dim+1) == count_sorted.unsqueeze(dim))
-    idx = Tensor.arange(orig_len, device=self.device).reshape(tuple(orig_len if i == dim else 1 for i in range(x.ndim)))
-    idx = (cond * idx.unsqueeze(dim+1)).sum(dim)
-    return x, idx
+        x, idx = crossover(x), crossover(idx)
+    shrink_to_orig = tuple((0, s) for s in self.shape)
+    return x.flatten(dim, dim+n_stages-1).shrink(shrink_to_orig), idx.flatten(dim, dim+n_stages-1).shrink(shrink_to_orig)
 
   def argsort(self, dim:int=-1, descending:bool=False) -> Tensor:
     """
@@ -2763,6 +2831,7 @@ class Tensor(OpMixin):
     """
     Computes the top-k elements of the tensor along the specified `dim`.
 
+    The k-th element is found with a radix select, only the k selected elements are sorted.
     Order of indices for equivalent elements is always preserved.
 
     ```python exec="true" source="above" session="tensor" result="python"
@@ -2775,11 +2844,37 @@ class Tensor(OpMixin):
     print(topk_indices.numpy())
     ```
     """
-    if not sorted_: raise NotImplementedError("topk with sorted_=False is not supported")
     if k > self.shape[dim:=self._resolve_dim(dim)]: raise ValueError(f"selected index {k=} is out of range")
-    x, idx = self.sort(dim, descending=largest)
-    shrink_to_k = tuple((0, k) if i == dim else None for i in range(self.ndim))
-    return x.shrink(shrink_to_k), idx.shrink(shrink_to_k)
+    k_shape = self.shape[:dim] + (k,) + self.shape[dim+1:]
+    if k == 0: return self.shrink_to(k_shape), Tensor.zeros(k_shape, device=self.device, dtype=dtypes.default_int)
+    if not isinstance(self.device, str) or not all_int(self.shape):
+      x, idx = self.sort(dim, descending=largest)
+      return x.shrink_to(k_shape), idx.shrink_to(k_shape)
+    # map the values to unsigned keys with the same order, floats flip all bits when negative and the sign bit otherwise.
+    # -0.0 is made 0.0 first so the two zeros are ties
+    nbits, udt = 8 * self.dtype.itemsize, {1: dtypes.uint8, 2: dtypes.uint16, 4: dtypes.uint32, 8: dtypes.uint64}[self.dtype.itemsize]
+    if self.dtype == dtypes.bool: key = self.cast(udt)
+    elif dtypes.is_unsigned(self.dtype): key = self
+    elif dtypes.is_int(self.dtype): key = self.bitcast(udt) ^ (1 << nbits-1)
+    else: key = ((bits:=(self == 0).where(0, self).bitcast(udt)) >= (1 << nbits-1)).where(~bits, bits | (1 << nbits-1))
+    if not largest: key = ~key
+    # every radix pass reads the keys
+    key = key.contiguous()
+    # radix select the k-th largest key, RADIX bits at a time from the top, the keys at or above every value of the digit are counted at once
+    kth = Tensor.zeros(self.shape[:dim] + (1,) + self.shape[dim+1:], device=self.device, dtype=udt)
+    digits = Tensor.arange(1, 2**(RADIX:=4), device=self.device).cast(udt)
+    for shift in range(nbits-RADIX, -RADIX, -RADIX):
+      counts = (key.unsqueeze(-1) >= (kth.unsqueeze(-1) | (digits << shift))).sum(dim, keepdim=True, dtype=dtypes.int32)
+      kth = kth | ((counts >= k).sum(-1, dtype=udt) << shift)
+    # the keys above the k-th and the first ties are compacted into k slots, one thread per line instead of a cumsum over dim
+    flag = ((key >= kth).cast(dtypes.uint8) + (key > kth).cast(dtypes.uint8)).transpose(dim, -1)
+    idx = Tensor.empty(prod(flag.shape[:-1]) * k, device=self.device, dtype=dtypes.default_int)
+    idx = idx.custom_kernel(flag.reshape(-1, flag.shape[-1]), fxn=functools.partial(_topk_kernel, k=k))[0]
+    idx = idx.reshape(*flag.shape[:-1], k).transpose(dim, -1)
+    if sorted_:
+      x, order = self.gather(dim, idx).sort(dim, descending=largest)
+      return x, idx.gather(dim, order)
+    return self.gather(dim, idx), idx
 
   # ***** unary ops *****
 